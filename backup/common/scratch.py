@@ -0,0 +1,113 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+from backup.common.logger import configure_logger
+from backup.multi.backpressure import BackpressureManager
+
+logger = configure_logger(logging.getLogger(__name__))
+
+
+class ScratchFile:
+    """Temporary file allocated from a ScratchSpace, removed on close (compatible to NamedTemporaryFile)."""
+
+    def __init__(self, space, name: str):
+        self._space = space
+        self.name = name
+
+    def close(self):
+        if self.name is None:
+            return
+
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass  # already moved or removed
+
+        self._space._forget(self)
+        self.name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ScratchSpace(BackpressureManager):
+    """
+    Hands out the temporary files of all backup stages and limits the space they may use.
+
+    Producers register the bytes they will need (see BackpressureManager) and block while the budget is exhausted,
+    the storage unregisters them after the archive has been stored. Files are created in a private directory inside
+    one of the scratch directories. Files up to small_file_size go to the first directory (e.g. a tmpfs), larger ones to
+    the directory with the most free space of the remaining ones (e.g. an SSD). close() removes everything that is left,
+    also after a failure.
+    """
+
+    def __init__(self, directories: [str] = None, budget: int = None, small_file_size: int = None):
+        super().__init__(budget if budget else float('inf'))
+        self.directories = list(directories or [tempfile.gettempdir()])
+        self.budget = budget
+        """Maximum bytes that can be registered, None = unlimited"""
+        self.small_file_size = small_file_size
+        """Files up to this size are put into the first directory, None = no distinction"""
+
+        self._lock = threading.Lock()
+        self._private_dirs = dict()
+        self._files = dict()
+        self._finalizer = weakref.finalize(self, ScratchSpace._remove_dirs, self._private_dirs)
+
+    def create_file(self, size_hint: int = 0) -> ScratchFile:
+        """Creates an empty temporary file, the size hint selects the scratch directory."""
+        directory = self._private_dir(self._select_directory(size_hint))
+        fd, name = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+
+        f = ScratchFile(self, name)
+        with self._lock:
+            self._files[id(f)] = f
+        return f
+
+    def close(self):
+        """Removes all files that are still allocated and the private directories."""
+        with self._lock:
+            files = list(self._files.values())
+        for f in files:
+            f.close()
+
+        self._finalizer()
+
+    def _select_directory(self, size_hint: int) -> str:
+        candidates = self.directories
+        if self.small_file_size is not None and len(self.directories) > 1:
+            if size_hint <= self.small_file_size:
+                return self.directories[0]
+            candidates = self.directories[1:]
+
+        if len(candidates) == 1:
+            return candidates[0]
+        return max(candidates, key=lambda d: shutil.disk_usage(d).free)
+
+    def _private_dir(self, directory: str) -> str:
+        with self._lock:
+            if directory not in self._private_dirs:
+                self._private_dirs[directory] = tempfile.mkdtemp(prefix="pybutcherbackup-", dir=directory)
+            return self._private_dirs[directory]
+
+    def _forget(self, f: ScratchFile):
+        with self._lock:
+            self._files.pop(id(f), None)
+
+    @staticmethod
+    def _remove_dirs(private_dirs: dict):
+        for d in private_dirs.values():
+            shutil.rmtree(d, ignore_errors=True)
+        private_dirs.clear()
+
+
+DEFAULT_SCRATCH = ScratchSpace()
+"""Used if no scratch space is given, the default temp directory without budget."""
@@ -1,6 +1,8 @@
 import hashlib
+import multiprocessing
 import os
 from enum import Enum
+from math import ceil
 from tqdm import tqdm
 
 from backup.common.progressbar import ProgressBar
@@ -29,14 +31,40 @@ def auto_str(cls):
     return cls
 
 
-def calculate_file_hash(filename):
-    sha256_hash = hashlib.sha256()
+def calculate_file_hash(filename, algorithm="sha256", block_size=1024 * 1024):
+    file_hash = hashlib.new(algorithm)
     with open(filename, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
+        # Read and update hash string value in blocks of 1M (hashlib releases the GIL for large blocks, so the other
+        # threads of the pipeline run while hashing)
+        for byte_block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(byte_block)
 
-        return sha256_hash.hexdigest()
+        return file_hash.hexdigest()
+
+
+class HashingWriter:
+    """Passes everything to the wrapped file and hashes it on the way, so the written file doesn't have to be read."""
+
+    def __init__(self, fileobj, algorithm="sha512"):
+        self._fileobj = fileobj
+        self._hash = hashlib.new(algorithm)
+        self.size = 0
+        """Bytes written so far"""
+
+    def write(self, data) -> int:
+        self._fileobj.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
 
 
 def try_parse_int(value):
@@ -57,3 +85,41 @@ def copy_with_progress(src_file: str, dest_file: str, t: ProgressBar, length=16
                     return
                 fdst.write(buf)
                 t.update(length)
+
+
+def available_cpu_count(cgroup_root='/sys/fs/cgroup') -> int:
+    """Number of CPUs this process is allowed to use, honoring the CPU affinity and the cgroup CPU quota (docker)."""
+    if hasattr(os, 'sched_getaffinity'):
+        count = len(os.sched_getaffinity(0))
+    else:
+        count = multiprocessing.cpu_count()
+
+    quota = cgroup_cpu_quota(cgroup_root)
+    if quota is not None:
+        count = min(count, int(ceil(quota)))
+
+    return max(1, count)
+
+
+def cgroup_cpu_quota(cgroup_root='/sys/fs/cgroup'):
+    """Returns the CPU quota of the cgroup in CPUs (e.g. 1.5) or None if there is no limit."""
+    try:  # cgroup v2
+        with open(os.path.join(cgroup_root, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:  # cgroup v1
+        with open(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+
+    return None
@@ -1,3 +1,4 @@
+import contextlib
 import os
 import tarfile
 import dataclasses
@@ -5,8 +6,9 @@ import logging
 from math import ceil
 
 from backup.common.logger import configure_logger
+from backup.common.util import HashingWriter
+from backup.common.scratch import ScratchSpace, ScratchFile, DEFAULT_SCRATCH
 from backup.core.luke import FileEntryDTO
-import tempfile
 
 from backup.common.progressbar import create_pg
 
@@ -59,18 +61,31 @@ class DefaultArchiver:
     - 'w:gz'	Open for gzip compressed writing.
     - 'w:bz2'	Open for bzip2 compressed writing.
     - 'w:xz'	Open for lzma compressed writing.
+
+    The compress methods return the SHA-512 (hex) of the written archive.
     """
 
     def __init__(self, open_spec='w:bz2'):
         self.open_spec = open_spec
 
-    def compress_file(self, override_file, file_entry: FileEntryDTO, output_archive):
-        with tarfile.open(output_archive, self.open_spec) as tar:
+    def compress_file(self, override_file, file_entry: FileEntryDTO, output_archive) -> str:
+        with self._open(output_archive) as (tar, out):
             bck_path = file_entry.relative_file
             tar.add(override_file, arcname=bck_path)
-
-    def compress_files(self, input_files: [FileEntryDTO], output_archive):
-        with tarfile.open(output_archive, self.open_spec) as tar:
+        return out.hexdigest()
+
+    def compress_file_part(self, file_entry: FileEntryDTO, offset: int, length: int, output_archive) -> str:
+        """Compresses length bytes starting at offset of the file, without copying the part to a separate file."""
+        with self._open(output_archive) as (tar, out):
+            with open(file_entry.original_file, 'rb') as src:
+                info = tar.gettarinfo(arcname=file_entry.relative_file, fileobj=src)
+                info.size = length
+                src.seek(offset)
+                tar.addfile(info, src)
+        return out.hexdigest()
+
+    def compress_files(self, input_files: [FileEntryDTO], output_archive) -> str:
+        with self._open(output_archive) as (tar, out):
             with create_pg(total=len(input_files), leave=False, unit='file', desc='Compressing files') as t:
                 for file in input_files:
                     src_path = file.original_file
@@ -79,6 +94,15 @@ class DefaultArchiver:
                     t.set_postfix(file=file.relative_file)
                     tar.add(src_path, arcname=bck_path)
                     t.update(1)
+        return out.hexdigest()
+
+    @contextlib.contextmanager
+    def _open(self, output_archive):
+        """Tar file for writing and the hashing writer below it"""
+        with open(output_archive, 'wb') as f:
+            out = HashingWriter(f)
+            with tarfile.open(fileobj=out, mode=self.open_spec) as tar:
+                yield tar, out
 
     def decompress_files(self, source_archive: str, relative_files: [str], output_dir: str):
         with tarfile.open(source_archive, 'r:*') as tar:
@@ -103,14 +127,18 @@ class ArchivePackage:
     file_extension: str
     archive_file: str
     part_number: int = -1
+    tempfile: ScratchFile = None
+    """Owner of archive_file, closed after the archive has been stored."""
+    sha512: str = None
+    """Checksum of archive_file, calculated while it was written (None if the writer doesn't provide one)"""
 
 
 class ArchiveManager:
-    def __init__(self, file_bulker: FileBulker, archiver: DefaultArchiver):
+    def __init__(self, file_bulker: FileBulker, archiver: DefaultArchiver, scratch: ScratchSpace = None):
         self.file_bulker = file_bulker
         self.max_size = file_bulker.max_size
-        self.temp_archive_file = tempfile.NamedTemporaryFile().name
         self.archiver = archiver
+        self.scratch = scratch or DEFAULT_SCRATCH
 
     def archive_package_iter(self) -> (FileEntryDTO, str, int):
         """
@@ -134,16 +162,18 @@ class ArchiveManager:
                     for split_file in self.split_file(file.original_file):
                         t.set_postfix(file=file.relative_file)
                         t.unpause()
-                        self.archiver.compress_file(split_file, file, self.temp_archive_file)
+                        temp_file = self.scratch.create_file(self.max_size)
+                        sha512 = self.archiver.compress_file(split_file, file, temp_file.name)
                         t.update(1)
-                        yield ArchivePackage(file_package, ext, self.temp_archive_file, i)
+                        yield ArchivePackage(file_package, ext, temp_file.name, i, temp_file, sha512)
 
                     i += 1
 
             else:
-                # normal package
-                self.archiver.compress_files(file_package, self.temp_archive_file)
-                yield ArchivePackage(file_package, ext, self.temp_archive_file, -1)
+                # normal package, every package gets its own file as it might be stored asynchronously
+                temp_file = self.scratch.create_file(sum(f.size for f in file_package))
+                sha512 = self.archiver.compress_files(file_package, temp_file.name)
+                yield ArchivePackage(file_package, ext, temp_file.name, -1, temp_file, sha512)
 
     def split_file(self, input_file, buffer=1024) -> str:
         """
@@ -155,7 +185,7 @@ class ArchiveManager:
                        desc='Splitting file') as t:
             with open(input_file, 'rb') as src:
                 while True:
-                    with tempfile.NamedTemporaryFile() as f:
+                    with self.scratch.create_file(self.max_size) as f:
                         with open(f.name, 'wb') as dest:
                             written = 0
                             while written < self.max_size:
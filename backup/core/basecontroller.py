@@ -1,3 +1,5 @@
+import contextlib
+import copy
 import os
 import re
 import tempfile
@@ -5,21 +7,25 @@ import shutil
 import logging
 
 from backup.common.logger import configure_logger
-from backup.common.util import copy_with_progress
+from backup.common.scratch import ScratchSpace
+from backup.common.util import copy_with_progress, calculate_file_hash
 from backup.core.luke import LukeFilewalker
 from backup.core.archive import FileBulker, DefaultArchiver, ArchiveManager
 from backup.core.encryptor import GpgEncryptor, Encryptor, EncryptionManager
+from backup.db.cache import create_index_cache
 from backup.db.db import DatabaseManager, BackupDatabaseReader, BackupType, FileState, ArchiveEntry, FileEntry, \
     DiscEntry
-from backup.multi.archive import ThreadingFileBulker, ThreadingArchiveManager
+from backup.multi.archive import PipelineArchiveManager
 from backup.db.disc_id import DiscId
-from backup.multi.threadpool import ThreadPool
-
-from backup.multi.encryptor import ThreadingEncryptionManager
-from backup.multi.backpressure import BackpressureManager, NopBackpressureManager
+from backup.multi.backpressure import NopBackpressureManager
 from backup.core.parameters import GeneralSettings, BackupParameters, RestoreParameters
 from backup.common.progressbar import create_pg
+from backup.storage.base import BaseStorageController
 from backup.storage.directory import DirectoryStorageController, DirectoryStorageBackupParameters
+from backup.storage.fanout import BackupDestination, SharedArchive
+from backup.storage.iso import IsoStorageController, IsoStorageBackupParameters
+from backup.storage.s3 import S3StorageController, S3StorageBackupParameters
+from backup.storage.stream import StreamStorageController, StreamStorageBackupParameters
 
 logger = configure_logger(logging.getLogger(__name__))
 
@@ -53,6 +59,29 @@ class BaseController:
 
         return db_loc
 
+    def _create_storage(self, parameters) -> BaseStorageController:
+        if isinstance(parameters.backup_parameters, StreamStorageBackupParameters):
+            return StreamStorageController()
+        if isinstance(parameters.backup_parameters, S3StorageBackupParameters):
+            return S3StorageController()
+        if isinstance(parameters.backup_parameters, IsoStorageBackupParameters):
+            return IsoStorageController()
+        return DirectoryStorageController()
+
+    def _plain_index(self, parameters, encryptor: Encryptor) -> (str, object):
+        """Location of the index for reading, an encrypted index is decrypted via the index cache or into a temporary
+        file (second value, None with the cache). The temporary file has to be kept open while the index is used."""
+        db_location = self._find_database(parameters)
+        if encryptor and self._valid_database_file(db_location) and db_location.endswith(encryptor.extension):
+            cache = create_index_cache(self.general_settings)
+            if cache:
+                return cache.decrypted(db_location, encryptor), None
+
+            db_tmp_file = tempfile.NamedTemporaryFile()
+            encryptor.decrypt_file(db_location, db_tmp_file.name)
+            return db_tmp_file.name, db_tmp_file
+        return db_location, None
+
     def _valid_database_file(self, file):
         # TODO this is very primitive, but can handle encrypted databases simply.
         return os.path.exists(file) and os.path.getsize(file) > 0
@@ -60,96 +89,166 @@ class BaseController:
 
 class BackupController(BaseController):
     def execute(self, params: BackupParameters):
+        scratch = self._create_scratch(params)
+        try:
+            self._execute(params, scratch)
+        finally:
+            scratch.close()  # removes all temporary files, also if the backup failed
+
+    def _create_scratch(self, params: BackupParameters) -> ScratchSpace:
+        budget = params.scratch_budget
+        if budget is None and params.use_threading:
+            budget = 5 * params.single_archive_size
+            if params.encryption_key:
+                budget *= 2
+
+        return ScratchSpace(params.scratch_directories, budget, params.scratch_small_file_size)
+
+    def _execute(self, params: BackupParameters, scratch: ScratchSpace):
         # Init/decrypt database
         encryptor = self._create_encryptor(params)
+        encrypted_location = None
         db_location = self._find_database(params)
 
+        cache = create_index_cache(self.general_settings)
         if encryptor and self._valid_database_file(db_location):
-            db_tmp_file = tempfile.NamedTemporaryFile()
-            encryptor.decrypt_file(db_location, db_tmp_file.name)
+            encrypted_location = db_location
+            db_tmp_file = scratch.create_file(os.path.getsize(db_location))
+            if cache:  # the backup changes the index, work on a copy
+                shutil.copyfile(cache.decrypted(db_location, encryptor), db_tmp_file.name)
+            else:
+                encryptor.decrypt_file(db_location, db_tmp_file.name)
             db_location = db_tmp_file.name
 
         db = DatabaseManager(db_location)
 
         with db.transaction() as txn:
-            backup_reader = db.read_backup(None)
-            first_backup = len(backup_reader.all_files) == 0
+            backup_reader = db.read_backup(None, params.lazy_index)
 
-            archive_manager, archiver, backup_db_writer, file_filter, pressure, storage \
-                = self._factory(backup_reader, db, encryptor, first_backup, params)
+            archive_manager, archiver, backup_db_writer, file_filter, pressure, destinations \
+                = self._factory(backup_reader, db, encryptor, params, scratch)
 
-            disc_domain = None
             for archive_package in archive_manager.archive_package_iter():
-                if storage.next_medium_needed() or disc_domain is None:
-                    if disc_domain is not None:  # if there is no entity, it's the first iteration
-                        storage.finish_medium(params, disc_domain)  # finish previous disc
+                for destination in destinations:  # every destination has its own mediums
+                    self._prepare_medium(destination, backup_db_writer)
 
-                    # create new disc
-                    disc_domain = backup_db_writer.create_disc()
-                    storage.create_next_medium(disc_domain)
-
-                archive_domain = backup_db_writer.create_archive(disc_domain)
+                archive_domain = backup_db_writer.create_archive(destinations[0].disc_domain)
+                for destination in destinations[1:]:
+                    backup_db_writer.map_archive_to_disc(archive_domain, destination.disc_domain)
                 self._update_archive_domain_from_package(archive_domain, archive_package, backup_db_writer,
                                                          backup_reader)
 
                 archive_package.final_file_extension = archive_package.file_extension
-
-                storage.store_archive(archive_package, disc_domain, archive_domain, pressure)
-
-            if disc_domain is not None:  # finish last disc
-                storage.finish_medium(params, disc_domain)  # -> storagecontroller
-
-            # find out which files where deleted
-            for key in backup_reader.all_files:
-                file = backup_reader.all_files[key]
-                fr = file.relative_file
-                if fr in file_filter.filtered_files:
-                    pass  # file not changed, don't record it
-                elif fr not in file_filter.handled_files:
-                    backup_db_writer.create_file(
-                        file.sha_sum,
-                        file.modified_time,
-                        file.relative_file,
-                        file.size,
-                        FileState.DELETED
-                    )
-
+                self._record_archive(archive_domain, archive_package)
+
+                self._store_archive(destinations, archive_package, archive_domain, pressure)
+
+            for destination in destinations:
+                if destination.disc_domain is not None:  # finish last disc
+                    destination.storage.finish_medium(destination.params, destination.disc_domain)
+
+            # find out which files where deleted: in the index, but neither unchanged nor backed up
+            deleted = [relative_file for relative_file in backup_reader.relative_files()
+                       if relative_file not in file_filter.filtered_files
+                       and relative_file not in file_filter.handled_files]
+            for relative_file in deleted:
+                file = backup_reader.find_relative_file(relative_file)
+                backup_db_writer.create_file(
+                    file.sha_sum,
+                    file.modified_time,
+                    file.relative_file,
+                    file.size,
+                    FileState.DELETED
+                )
+
+            db.update_current_state(backup_db_writer.backup_root)
             txn.commit()
 
         db.close_database()
-        storage.finish_backup(db, params, encryptor)
-
-    def _factory(self, backup_reader, db, encryptor, first_backup, params):
+        for destination in destinations:
+            destination.storage.finish_backup(db, destination.params, encryptor)
+
+        if encrypted_location:  # the mediums only carry shards, the full index has to be written back
+            self._write_encrypted_index(db.file_name, encrypted_location, encryptor, cache)
+
+    def _prepare_medium(self, destination: BackupDestination, backup_db_writer):
+        storage = destination.storage
+        if storage.next_medium_needed() or destination.disc_domain is None:
+            if destination.disc_domain is not None:  # if there is no entity, it's the first iteration
+                storage.finish_medium(destination.params, destination.disc_domain)  # finish previous disc
+
+            # create new disc
+            destination.disc_domain = backup_db_writer.create_disc(destination.entry)
+            storage.create_next_medium(destination.disc_domain)
+
+    def _record_archive(self, archive_domain, archive_package):
+        """Size, checksum and codec of the final archive, the checksum is calculated by the archiver/encryptor."""
+        archive_domain.size = os.path.getsize(archive_package.archive_file)
+        archive_domain.sha512 = getattr(archive_package, "sha512", None) \
+            or calculate_file_hash(archive_package.archive_file, "sha512")
+        archive_domain.codec = archive_package.final_file_extension
+        archive_domain.save()
+
+    def _store_archive(self, destinations: [BackupDestination], archive_package, archive_domain, pressure):
+        if len(destinations) == 1:
+            destinations[0].storage.store_archive(archive_package, destinations[0].disc_domain, archive_domain,
+                                                  pressure)
+            return
+
+        # tee the archive, it is released after every destination has written its copy
+        shared = SharedArchive(archive_package, pressure, len(destinations))
+        for destination in destinations:
+            destination.storage.store_archive(shared.package(), destination.disc_domain, archive_domain, shared)
+
+    def _write_encrypted_index(self, db_file: str, encrypted_location: str, encryptor: Encryptor, cache):
+        tmp_location = encrypted_location + ".tmp"
+        encryptor.encrypt_file(db_file, tmp_location)
+        os.replace(tmp_location, encrypted_location)  # the old index stays intact if the encryption fails
+
+        if cache:  # the next command can use the index without decrypting it
+            cache.store(encrypted_location, encryptor, db_file)
+
+    def _factory(self, backup_reader, db, encryptor, params, scratch):
         """Create all needed instances for the backup process"""
-        calculate_sha = not params.use_threading
-        if not first_backup:
-            calculate_sha = True
-        file_filter = FileFilter(
-            backup_reader,
-            LukeFilewalker().walk_directory(params.source, calculate_sha)
-        )
+        # with threading the sha is calculated by the hash stage of the pipeline, ahead of the file filter
+        file_walker = LukeFilewalker().walk_directory(params.source, not params.use_threading)
+        file_filter = FileFilter(backup_reader, file_walker)
         if backup_reader.is_empty:
             params.backup_type = BackupType.FULL
         archiver = self._create_archiver(params)
         pressure = NopBackpressureManager()
         if params.use_threading:
-            pool = params.use_threading if None else ThreadPool(params.threads)
-            pressure = BackpressureManager(5)
-            if first_backup:
-                # if first backup we can use threading, otherwise sha has to be calculated inside the walker TODO check how to solve.
-                file_bulker = ThreadingFileBulker(file_filter.iterator(), params.single_archive_size, pool)
-            else:
-                file_bulker = FileBulker(file_filter.iterator(), params.single_archive_size)
-            archive_manager = ThreadingArchiveManager(file_bulker, archiver, pool, pressure)
-            archive_manager = ThreadingEncryptionManager(archive_manager, encryptor, pool, pressure)
+            pressure = scratch
+            archive_manager = PipelineArchiveManager(
+                file_walker, params.single_archive_size, archiver, encryptor, scratch,
+                params.stage_threads_for(), params.stage_queue_sizes, params.threads if params.use_processes else 0,
+                file_filter.filter, 2 * params.threads if params.autotune else 0
+            )
         else:
             file_bulker = FileBulker(file_filter.iterator(), params.single_archive_size)
-            archive_manager = ArchiveManager(file_bulker, archiver)
-            archive_manager = EncryptionManager(archive_manager, encryptor)
+            archive_manager = ArchiveManager(file_bulker, archiver, scratch)
+            archive_manager = EncryptionManager(archive_manager, encryptor, scratch)
         backup_db_writer = db.create_backup(params.backup_type, params.backup_name)
-        # TODO create parameters and pass it
-        storage = DirectoryStorageController().start_backup(params, self.general_settings)
-        return archive_manager, archiver, backup_db_writer, file_filter, pressure, storage
+        destinations = self._create_destinations(db, params)
+        return archive_manager, archiver, backup_db_writer, file_filter, pressure, destinations
+
+    def _create_destinations(self, db, params: BackupParameters) -> [BackupDestination]:
+        """The destination of the parameters first, then the additional destinations"""
+        all_params = [params]
+        for destination, backup_parameters in params.additional_destinations:
+            destination_params = copy.copy(params)
+            destination_params.destination = destination
+            destination_params.backup_parameters = backup_parameters
+            destination_params.additional_destinations = list()
+            all_params.append(destination_params)
+
+        destinations = list()
+        for destination_params in all_params:
+            # TODO create parameters and pass it
+            storage = self._create_storage(destination_params).start_backup(destination_params, self.general_settings)
+            destinations.append(BackupDestination(destination_params, db.destination(destination_params.destination),
+                                                  storage))
+        return destinations
 
     def _update_archive_domain_from_package(self, archive_domain, archive_package, backup_db_writer, backup_reader):
         """Maps files from the archive package to the domain (db)."""
@@ -171,15 +270,7 @@ class RestoreController(BaseController):
     def _filter_files(self, backup_reader: BackupDatabaseReader, file_glob):
         regex = re.compile(file_glob)
 
-        ret = list()
-        all_files = backup_reader.all_files
-        for key in all_files:
-            file = all_files[key]
-            m = regex.match(file.relative_file)
-            if m:
-                ret.append(file.relative_file)
-
-        return ret
+        return [relative_file for relative_file in backup_reader.relative_files() if regex.match(relative_file)]
 
     def _group_by_archive(self, backup_reader: BackupDatabaseReader, available_files: [str]) \
             -> {int: (ArchiveEntry, [str])}:
@@ -219,22 +310,17 @@ class RestoreController(BaseController):
         # Init / decrypt database
         encryptor = self._create_encryptor(params)
 
-        db_location = self._find_database(params)
-        if encryptor and self._valid_database_file(db_location) and db_location.endswith(encryptor.extension):
-            db_tmp_file = tempfile.NamedTemporaryFile()
-            encryptor.decrypt_file(db_location, db_tmp_file.name)
-            db_location = db_tmp_file.name
-
-        db = DatabaseManager(db_location)
+        db_location, db_tmp_file = self._plain_index(params, encryptor)
+        db = DatabaseManager(db_location, read_only=True)
 
         # TODO remove, needs to be given in from the outside
-        params.backup_parameters = DirectoryStorageBackupParameters()
+        params.backup_parameters = params.backup_parameters or DirectoryStorageBackupParameters()
         # TODO create parameters and pass it
-        storage = DirectoryStorageController().start_restore(self.general_settings, params)
+        storage = self._create_storage(params).start_restore(self.general_settings, params)
         # source_locator = self._create_source_locator(params)
 
-        with db.transaction() as txn:
-            backup_reader = db.read_backup(None)
+        with db.transaction() as txn, contextlib.closing(storage):
+            backup_reader = db.read_backup(None, params.lazy_index)
 
             restore_files = self._filter_files(backup_reader, params.restore_glob)
             archiver = self._create_archiver(params)
@@ -250,18 +336,24 @@ class RestoreController(BaseController):
             endless_loop_counter = len(restore_files) * 10
             while len(restore_files) > 0:
                 available_files, list_of_archives = storage.available_sources(backup_reader, restore_files, archive_ext)
+                if params.skip_unavailable:
+                    available = set(available_files)
+                    unavailable = [rf for rf in restore_files if rf not in available]
+                    if len(unavailable) > 0:
+                        logger.warning("Skipping %i files, their archives are not available" % len(unavailable))
+                        restore_files = [rf for rf in restore_files if rf in available]
                 file_map = self._group_by_archive(backup_reader, available_files)
 
-                for archive_id in file_map:  # ( archive.id, [relative_file] )
+                # ( archive.id, local path of the archive ), sequential mediums hand them out in medium order
+                for archive_id, archive_path in storage.open_archives(list(file_map), list_of_archives):
                     archive_entry, relative_files_count = file_map[archive_id]  # archive, {relative_file: part_count}
 
-                    archive_path = list_of_archives[archive_id]
                     # Files can occur in multiple archives, check if this archive is available
                     if os.path.exists(archive_path):
                         relative_files = self._convert_to_archive_path(params, backup_reader,
                                                                        relative_files_count.keys())
-                        self._decrypt_and_decompress(archive_path, archiver, params, relative_files,
-                                                     encryptor)  # -> storagecontroller??
+                        self._restore_archive(storage, archive_entry, archive_path, archiver, params, relative_files,
+                                              encryptor)
 
                         # if the file is a partial file, we need to move it to the temp directory and mark it as such
                         # do not remove it from restore_files, as we need the other parts, before quitting
@@ -301,6 +393,32 @@ class RestoreController(BaseController):
         db.close_database()
         # TODO sanity check for the restored files?
 
+    def _restore_archive(self, storage, archive_entry, archive_path, archiver, params, relative_files, encryptor):
+        try:
+            self._verify_archive(params, archive_entry, archive_path)
+            self._decrypt_and_decompress(archive_path, archiver, params, relative_files,
+                                         encryptor)  # -> storagecontroller??
+        except Exception as e:
+            repaired = storage.repair_archive(archive_entry.id) if params.repair_archives else None
+            if repaired is None:
+                raise
+            logger.warning("Archive %i is damaged (%s), restoring from the repaired archive" % (archive_entry.id, e))
+            with repaired:
+                self._verify_archive(params, archive_entry, repaired.name)
+                self._decrypt_and_decompress(repaired.name, archiver, params, relative_files, encryptor)
+
+    def _verify_archive(self, params: RestoreParameters, archive_entry: ArchiveEntry, archive_path: str):
+        """Rejects damaged archives before they are decrypted. Archives of older indexes have no size or checksum."""
+        if not params.verify_archives:
+            return
+
+        if archive_entry.size is not None and os.path.getsize(archive_path) != archive_entry.size:
+            raise RuntimeError("Archive %i has %i bytes instead of %i" % (archive_entry.id,
+                                                                         os.path.getsize(archive_path),
+                                                                         archive_entry.size))
+        if archive_entry.sha512 is not None and calculate_file_hash(archive_path, "sha512") != archive_entry.sha512:
+            raise RuntimeError("Archive %i doesn't match its checksum" % archive_entry.id)
+
     def _decrypt_and_decompress(self, archive_path, archiver, params, relative_files, encryptor: Encryptor):
         with tempfile.NamedTemporaryFile() as decrypted_file:
             src_archive = archive_path
@@ -339,21 +457,20 @@ class FileFilter:
     def __init__(self, backup_reader: BackupDatabaseReader, file_iterator):
         self._backup_reader = backup_reader
         self._file_iterator = file_iterator
-        self.filtered_files = dict()
-        self.handled_files = dict()
+        self.filtered_files = set()
+        """Relative files that are unchanged since the last backup"""
+        self.handled_files = set()
+        """Relative files that are new or changed"""
 
     def iterator(self):
-        br = self._backup_reader
-        for file in self._file_iterator:
-            fp = br.find_relative_file(file.relative_file)
-
-            fs = False
-            if fp:
-                fs = fp.sha_sum == file.sha_sum
+        return self.filter(self._file_iterator)
 
-            if fp and fs:
-                self.filtered_files[file.relative_file] = file
+    def filter(self, file_iterator):
+        """Yields all files of file_iterator that are new or changed. The sha sum has to be calculated already."""
+        for file, sha_sum in self._backup_reader.join_sha_sums(file_iterator):
+            if sha_sum is not None and sha_sum == file.sha_sum:
+                self.filtered_files.add(file.relative_file)
                 continue
 
-            self.handled_files[file.relative_file] = file
+            self.handled_files.add(file.relative_file)
             yield file
@@ -1,10 +1,10 @@
 import os
 import platform
 import shlex
+import shutil
 import subprocess
 
 import codecs
-import tempfile
 import threading
 
 import sys
@@ -13,12 +13,15 @@ import locale
 import struct
 from Crypto.Cipher import AES
 
+from backup.common.scratch import ScratchSpace, DEFAULT_SCRATCH
+from backup.common.util import HashingWriter
 from backup.core.archive import ArchiveManager, ArchivePackage
 
 
 class Encryptor:
     """'Abstract' base class for all encryption related tasks."""
     def encrypt_file(self, in_filename, out_filename):
+        """Returns the SHA-512 (hex) of the encrypted file, if the encryptor calculates it while writing."""
         pass
 
     def decrypt_file(self, in_filename, out_filename):
@@ -39,6 +42,8 @@ class GpgEncryptor(Encryptor):
             self.stderr = None
             self.data = None
             self.retval = None
+            self.error = None
+            """Exception of the stdout reader thread, raised again by _collect_output"""
 
     def __init__(self, key, gpg_location=None):
         if not gpg_location:
@@ -68,7 +73,7 @@ class GpgEncryptor(Encryptor):
         cmd.append("--batch")
         cmd.append("--yes")  # needed for unit tests, as the file already exists
         cmd.append("--symmetric")
-        cmd.append("--output %s" % out_filename)
+        cmd.append("--output -")  # written by us, so the checksum is calculated on the way
         cmd.append("-c")
         cmd.append("--cipher-algo AES256")
         cmd.append("--passphrase")
@@ -79,12 +84,14 @@ class GpgEncryptor(Encryptor):
 
         result = GpgEncryptor.ResultDTO()
 
-        self._collect_output(process, result)
+        with open(out_filename, 'wb') as f:
+            out = HashingWriter(f)
+            self._collect_output(process, result, sink=out)
         result.retval = process.wait()
 
         assert result.retval == 0, "GPG aborted with an error for file <%s>" % in_filename
 
-        return result
+        return out.hexdigest()
 
     def decrypt_file(self, in_filename, out_filename):
         #  gpg --passphrase 1234 --batch --symmetric --cipher-algo AES256 XXX
@@ -151,12 +158,22 @@ class GpgEncryptor(Encryptor):
                                 stderr=subprocess.PIPE,
                                 env=environment)
 
-    def _read_data(self, stream, result):
+    def _read_data(self, stream, result, sink=None):
         """Incrementally read from ``stream`` and store read data.
         All data gathered from calling ``stream.read()`` will be concatenated and written to result.data.
 
         :param stream: An open file-like object to read() from.
+        :param sink: If given, the data is written to this file-like object instead of result.data.
         """
+        if sink is not None:
+            try:
+                shutil.copyfileobj(stream, sink, 64 * 1024)
+            except Exception as e:  # e.g. a full disk, GPG still has to finish writing into the pipe
+                result.error = e
+                while stream.read(64 * 1024):
+                    pass
+            return
+
         chunks = []
         # log.debug("Reading data from stream %r..." % stream.__repr__())
 
@@ -172,11 +189,12 @@ class GpgEncryptor(Encryptor):
         # log.debug("Finishing reading from stream %r..." % stream.__repr__())
         # log.debug("Read %4d bytes total" % len(result.data))
 
-    def _collect_output(self, process, result, writer=None, stdin=None):
+    def _collect_output(self, process, result, writer=None, stdin=None, sink=None):
         """Drain the subprocesses output streams, writing the collected output
-        to the result. If a writer thread (writing to the subprocess) is given,
-        make sure it's joined before returning. If a stdin stream is given,
-        close it before returning.
+        to the result (stdout to the sink, if one is given). If a writer thread
+        (writing to the subprocess) is given, make sure it's joined before
+        returning. If a stdin stream is given, close it before returning. An
+        error of writing to the sink is raised once the process finished.
         """
         stderr = codecs.getreader(self._encoding)(process.stderr)
         rr = threading.Thread(target=self._read_response,
@@ -186,7 +204,7 @@ class GpgEncryptor(Encryptor):
         rr.start()
 
         stdout = process.stdout
-        dr = threading.Thread(target=self._read_data, args=(stdout, result))
+        dr = threading.Thread(target=self._read_data, args=(stdout, result, sink))
         dr.setDaemon(True)
         # log.debug('stdout reader: %r', dr)
         dr.start()
@@ -203,6 +221,8 @@ class GpgEncryptor(Encryptor):
                 pass
         stderr.close()
         stdout.close()
+        if result.error is not None:
+            raise result.error
 
     def _read_response(self, stream, result):
         """Reads all the stderr output from GPG, taking notice only of lines
@@ -331,7 +351,8 @@ class PyCryptoEncryptor(Encryptor):
         filesize = os.path.getsize(in_filename)
 
         with open(in_filename, 'rb') as infile:
-            with open(out_filename, 'wb') as outfile:
+            with open(out_filename, 'wb') as f:
+                outfile = HashingWriter(f)
                 outfile.write(struct.pack('<Q', filesize))
                 outfile.write(iv)
 
@@ -344,6 +365,8 @@ class PyCryptoEncryptor(Encryptor):
 
                     outfile.write(encryptor.encrypt(chunk))
 
+        return outfile.hexdigest()
+
     def decrypt_file(self, in_filename, out_filename):
         """ Decrypts a file using AES (CBC mode) with the
             given key. Parameters are similar to encrypt_file.
@@ -367,10 +390,10 @@ class PyCryptoEncryptor(Encryptor):
 
 class EncryptionManager:
 
-    def __init__(self, archive_iterator: ArchiveManager, encryptor: Encryptor):
+    def __init__(self, archive_iterator: ArchiveManager, encryptor: Encryptor, scratch: ScratchSpace = None):
         self.archive_manager = archive_iterator
         self.encryptor = encryptor
-        self.temp_archive_file = tempfile.NamedTemporaryFile()
+        self.scratch = scratch or DEFAULT_SCRATCH
 
     def archive_package_iter(self) -> ArchivePackage:
 
@@ -379,7 +402,12 @@ class EncryptionManager:
                 yield archive_package
         else:
             for archive_package in self.archive_manager.archive_package_iter():
-                self.encryptor.encrypt_file(archive_package.archive_file, self.temp_archive_file.name)
-                archive_package.archive_file = self.temp_archive_file.name
+                temp_file = self.scratch.create_file(os.path.getsize(archive_package.archive_file))
+                archive_package.sha512 = self.encryptor.encrypt_file(archive_package.archive_file, temp_file.name)
+                if archive_package.tempfile:
+                    archive_package.tempfile.close()
+
+                archive_package.archive_file = temp_file.name
+                archive_package.tempfile = temp_file
                 archive_package.file_extension += "." + self.encryptor.extension
                 yield archive_package
@@ -62,8 +62,14 @@ class LukeFilewalker:
         return original_file_path[len(backup_dir):]
 
     def file_generator(self, directory: str) -> (str, str):
+        """
+        Yields the files directory by directory, sorted by name. The directories are sorted with their trailing
+        separator, so the files come in the order of their (directory path, name) like the sorted cursor of the lazy
+        index reader.
+        """
         for subdir, dirs, files in os.walk(directory):
-            for file in files:
+            dirs.sort(key=lambda name: name + os.sep)
+            for file in sorted(files):
                 yield subdir, file
 
     def count_files(self, directory: str) -> int:
@@ -1,5 +1,4 @@
-import multiprocessing
-
+from backup.common.util import available_cpu_count
 from backup.db.domain import BackupType
 
 DEFAULT_DATABASE_FILENAME = "index.sqlite"
@@ -11,6 +10,8 @@ class GeneralSettings:
         self.index_filename = "disc_id.yml"
         self.hook_dir = "./hooks/"
         self.dummy = False
+        self.index_cache_directory = None
+        """Keeps decrypted indexes between commands (see IndexCache), None = decrypt on every command"""
 
 
 class BackupParameters:
@@ -21,12 +22,35 @@ class BackupParameters:
         self.backup_type = BackupType.INCREMENTAL
         self.encryption_key = None
         self.use_threading = False
-        self.threads = multiprocessing.cpu_count()
+        self.threads = available_cpu_count()
+        self.use_processes = False
+        """Compress and encrypt in a process pool instead of threads (only with use_threading)"""
+        self.stage_threads = dict()
+        """Worker threads per pipeline stage (hash, compress, encrypt), stages not listed here use threads"""
+        self.stage_queue_sizes = dict()
+        """Input queue size per pipeline stage, stages not listed here use a multiple of their workers"""
+        self.autotune = False
+        """Adjust the workers per stage while the backup runs, between 1 and 2 * threads"""
+        self.scratch_directories = None
+        """Directories for temporary files, None = system temp directory"""
+        self.scratch_budget = None
+        """Maximum bytes of temporary archives in flight (with threading), None = 5 archives (10 if encrypted)"""
+        self.scratch_small_file_size = None
+        """Temporary files up to this size are put into the first scratch directory (e.g. tmpfs)"""
         self.backup_name = None  # User identifiable name, only stored with the very first backup
+        self.lazy_index = False
+        """Query the index per directory instead of loading it into memory (for very large indexes)"""
 
         self.single_archive_size = 1024 * 1024 * 1024  # 1 GB
         """Single Archive size in bytes"""
         self.backup_parameters = None  # TODO create defaults
+        self.additional_destinations = list()
+        """Further destinations that get a copy of every archive, each with its own mediums
+        [(destination, storage parameters)]"""
+
+    def stage_threads_for(self, stages=("hash", "compress", "encrypt")) -> {str: int}:
+        """Worker threads for every stage, filled up with the general thread count."""
+        return {stage: self.stage_threads.get(stage, self.threads) for stage in stages}
 
 
 class RestoreParameters:
@@ -36,3 +60,31 @@ class RestoreParameters:
         self.destination = None
         self.encryption_key = None
         self.restore_glob = ".*"
+        self.skip_unavailable = False
+        """Skip files with archives that are not available (e.g. restore from the index shard of one medium)"""
+        self.verify_archives = True
+        """Check size and checksum of every archive before it is decrypted, False tries to restore damaged archives"""
+        self.repair_archives = True
+        """Storages with parity archives rebuild damaged archives transparently"""
+        self.lazy_index = False
+        """Query the index per directory instead of loading it into memory (for very large indexes)"""
+        self.backup_parameters = None
+        """Parameters of the storage the backup is restored from, None = directory"""
+
+
+class VerifyParameters(RestoreParameters):
+    """Reads the archives of a source like a restore, but only checks them (nothing is written)."""
+
+    def __init__(self):
+        super(VerifyParameters, self).__init__()
+        self.repair_archives = False  # damaged archives have to show up in the report
+        self.deep = False
+        """Decrypt and decompress every archive and compare every file with its sha sum in the index"""
+        self.sample = 1.0
+        """Fraction of the archives that is verified, e.g. 0.05 = 5% per run"""
+        self.sample_round = 0
+        """Selects the sampled archives, consecutive rounds verify different archives until all have been verified"""
+        self.parallel_mediums = 4
+        """Mediums that are read at the same time, archives of one medium are read one after the other"""
+        self.report_file = None
+        """JSON report of the verification, None = no report file"""
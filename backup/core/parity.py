@@ -0,0 +1,177 @@
+import functools
+import logging
+import os
+
+from backup.common.logger import configure_logger
+
+logger = configure_logger(logging.getLogger(__name__))
+
+_PRIMITIVE_POLYNOMIAL = 0x11d
+
+
+def _gf_tables() -> ([int], [int]):
+    exp, log = [0] * 512, [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= _PRIMITIVE_POLYNOMIAL
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+
+_EXP, _LOG = _gf_tables()
+
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def gf_inv(a: int) -> int:
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return _EXP[255 - _LOG[a]]
+
+
+@functools.lru_cache(maxsize=256)
+def _mul_table(c: int) -> bytes:
+    """Translation table that multiplies every byte with c."""
+    return bytes(gf_mul(c, v) for v in range(256))
+
+
+def coefficient(parity: int, index: int) -> int:
+    """Cauchy matrix 1 / (x_parity + y_index) with x = 255, 254, ... and y = 0, 1, ... (disjoint while they fit)."""
+    return gf_inv((255 - parity) ^ index)
+
+
+def _mul_add(acc: int, block: bytes, c: int) -> int:
+    """acc + c * block, blocks are little endian integers: shorter blocks are padded with zeros at the end."""
+    if c == 0:
+        return acc
+    if c != 1:
+        block = block.translate(_mul_table(c))  # one table lookup per byte, in C
+    return acc ^ int.from_bytes(block, 'little')
+
+
+def _invert(matrix: [[int]]) -> [[int]]:
+    """Gauss-Jordan elimination over GF(256)."""
+    n = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col] != 0), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor != 0:
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+class ParityEncoder:
+    """
+    Systematic Reed-Solomon (Cauchy) erasure code over GF(256), the data shards are the archives of a parity group.
+
+    Archives are added one after the other, as they are stored, and each one is folded into the parity files block by
+    block: parity_j += coefficient(j, i) * archive_i. Shorter archives count as padded with zeros, so every parity file
+    is as large as the largest archive. Any len(parity_files) missing or damaged archives of the group can be
+    reconstructed from the others and the parity files (see reconstruct). A group has at most 256 - parity archives.
+    """
+
+    def __init__(self, parity_files: [str], block_size: int = 1024 * 1024):
+        if not 0 < len(parity_files) < 256:
+            raise ValueError("Between 1 and 255 parity files are supported")
+        self.parity_files = parity_files
+        self.block_size = block_size
+        self.count = 0
+        """Archives that have been added"""
+        self.size = 0
+        """Size of the parity files (largest archive)"""
+
+        self._fds = [os.open(name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666) for name in parity_files]
+
+    @property
+    def max_count(self) -> int:
+        return 256 - len(self.parity_files)
+
+    def add(self, archive_file: str) -> int:
+        """Folds the archive into the parity files, returns the index of the archive in the group."""
+        index = self.count
+        if index >= self.max_count:
+            raise ValueError("A parity group holds at most %i archives" % self.max_count)
+
+        coefficients = [coefficient(j, index) for j in range(len(self._fds))]
+        offset = 0
+        with open(archive_file, 'rb') as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+
+                for fd, c in zip(self._fds, coefficients):
+                    acc = int.from_bytes(os.pread(fd, len(block), offset), 'little')
+                    os.pwrite(fd, _mul_add(acc, block, c).to_bytes(len(block), 'little'), offset)
+                offset += len(block)
+
+        self.count += 1
+        self.size = max(self.size, offset)
+        return index
+
+    def close(self, fsync: bool = False):
+        for fd in self._fds:
+            try:
+                if fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._fds = list()
+
+
+def reconstruct(count: int, archive_files: {int: str}, parity_files: {int: str}, targets: {int: (str, int)},
+                block_size: int = 1024 * 1024):
+    """
+    Rebuilds archives of a parity group.
+
+    :param count: number of archives in the group
+    :param archive_files: intact archives {index in group: file}
+    :param parity_files: intact parity files {parity number: file}
+    :param targets: archives to rebuild {index in group: (output file, size of the archive)}
+    """
+    sources = [(index, archive_files[index]) for index in sorted(archive_files) if index < count]
+    rows = [[1 if i == index else 0 for i in range(count)] for index, _ in sources]
+    for j in sorted(parity_files):
+        if len(rows) >= count:
+            break
+        sources.append((None, parity_files[j]))
+        rows.append([coefficient(j, i) for i in range(count)])
+
+    if len(rows) < count:
+        raise ValueError("Not enough intact archives and parity files: %i of %i" % (len(rows), count))
+    sources, rows = sources[:count], rows[:count]
+
+    inverse = _invert(rows)
+    fds = [os.open(name, os.O_RDONLY) for _, name in sources]
+    try:
+        length = max(os.fstat(fd).st_size for fd in fds)
+        for index, (out_file, size) in targets.items():
+            factors = inverse[index]
+            with open(out_file, 'wb') as out:
+                for offset in range(0, min(size, length), block_size):
+                    n = min(block_size, size - offset)
+                    acc = 0
+                    for fd, c in zip(fds, factors):
+                        acc = _mul_add(acc, os.pread(fd, n, offset), c)
+                    out.write(acc.to_bytes(n, 'little'))
+            logger.info("Reconstructed archive %i of the parity group (%i bytes)" % (index, size))
+    finally:
+        for fd in fds:
+            os.close(fd)
@@ -0,0 +1,241 @@
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+from math import ceil
+
+from peewee import fn
+
+from backup.common.logger import configure_logger
+from backup.common.progressbar import create_pg
+from backup.common.util import calculate_file_hash
+from backup.core.basecontroller import BaseController
+from backup.core.encryptor import Encryptor
+from backup.core.parameters import VerifyParameters
+from backup.db.db import DatabaseManager
+from backup.db.domain import ArchiveEntry, ArchiveFileMap, FileEntry, DirectoryEntry
+from backup.storage.base import BaseRestoreStorageController
+from backup.storage.directory import DirectoryStorageBackupParameters
+
+logger = configure_logger(logging.getLogger(__name__))
+
+STATUS_OK = "ok"
+STATUS_DAMAGED = "damaged"
+STATUS_MISSING = "missing"
+STATUS_UNCHECKED = "unchecked"
+"""Archive of an older index without checksum, only the size was checked"""
+
+_SAMPLE_SPACE = 2 ** 32
+_READ_SIZE = 1024 * 1024
+_QUERY_CHUNK = 500
+"""Archive ids per query, SQLite limits the number of variables"""
+
+
+def sample_archives(archive_ids: [int], sample: float, sample_round: int) -> [int]:
+    """
+    Archives verified in the sample round. The ids are scattered over 32 bit and every round takes the next window of
+    the sample size, so ceil(1 / sample) consecutive rounds verify every archive (and new archives join the rotation).
+    """
+    if sample >= 1:
+        return list(archive_ids)
+
+    width = max(1, int(ceil(sample * _SAMPLE_SPACE)))
+    start = (sample_round * width) % _SAMPLE_SPACE
+    return [archive_id for archive_id in archive_ids
+            if ((archive_id * 2654435761) % _SAMPLE_SPACE - start) % _SAMPLE_SPACE < width]
+
+
+def month_round(day: datetime.date = None) -> int:
+    """Sample round that advances every month, e.g. to verify 5% of the archives per month."""
+    day = day or datetime.date.today()
+    return day.year * 12 + day.month - 1
+
+
+class VerifyController(BaseController):
+    """
+    Checks that the archives of a source are still readable, without restoring anything.
+
+    Every archive is read once and compared with size and checksum of the index. A deep verification also decrypts
+    and decompresses it and compares every file with its sha sum. The mediums are read in parallel (see
+    BaseRestoreStorageController.medium_groups), the archives of one medium one after the other, so reading is
+    sequential per medium. Damaged archives are reported, not repaired.
+    """
+
+    def execute(self, params: VerifyParameters) -> dict:
+        encryptor = self._create_encryptor(params)
+        db_location, db_tmp_file = self._plain_index(params, encryptor)
+        db = DatabaseManager(db_location, read_only=True)
+
+        params.backup_parameters = params.backup_parameters or DirectoryStorageBackupParameters()
+        storage = self._create_storage(params).start_restore(self.general_settings, params)
+
+        started = datetime.datetime.now(datetime.timezone.utc)
+        with db.transaction() as txn:
+            ext = self._create_archiver(params).extension
+            if encryptor:
+                ext = ext + "." + encryptor.extension
+            _, sources = storage.available_sources(db.read_backup(None, True), [], ext)
+
+            archives = {archive.id: archive for archive in
+                        ArchiveEntry.select(ArchiveEntry.id, ArchiveEntry.name, ArchiveEntry.size, ArchiveEntry.sha512,
+                                            ArchiveEntry.codec, ArchiveEntry.disc)
+                        .where(ArchiveEntry.name.is_null(False))}
+            candidates = sorted(archives)
+            if params.skip_unavailable:
+                candidates = [archive_id for archive_id in candidates if archive_id in sources]
+            selected = sample_archives(candidates, params.sample, params.sample_round)
+            members = self._expected_members(selected) if params.deep else dict()
+            txn.rollback()
+        db.close_database()  # the workers don't need the index
+
+        results = {archive_id: self._result(archives[archive_id], STATUS_MISSING)
+                   for archive_id in selected if archive_id not in sources}
+        with contextlib.closing(storage):
+            results.update(self._verify_mediums(storage, [a for a in selected if a in sources], sources, archives,
+                                                members, encryptor, params))
+
+        report = self._report(params, started, len(candidates), [results[a] for a in sorted(results)])
+        if params.report_file:
+            with open(params.report_file, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+    def _find_database(self, parameters):
+        db_loc = str(parameters.database_location)
+        if not os.path.isabs(db_loc):  # like the index of a backup without --index, next to the mediums
+            db_loc = os.path.join(parameters.source, db_loc)
+        return db_loc
+
+    def _expected_members(self, archive_ids: [int]) -> {int: {str: str}}:
+        """Files of every archive {archive id: {member name: sha sum, None for parts of split files}}"""
+        parts = ArchiveFileMap.alias()
+        part_count = parts.select(fn.COUNT(parts.id)).where(parts.file == FileEntry.id)
+
+        members = {archive_id: dict() for archive_id in archive_ids}
+        for i in range(0, len(archive_ids), _QUERY_CHUNK):
+            query = ArchiveFileMap.select(ArchiveFileMap.archive, FileEntry.sha_sum, DirectoryEntry.path,
+                                          FileEntry.name, part_count) \
+                .join(FileEntry).join(DirectoryEntry) \
+                .where(ArchiveFileMap.archive.in_(archive_ids[i:i + _QUERY_CHUNK])).tuples()
+            for archive_id, sha_sum, path, name, count in query.iterator():
+                members[archive_id][(path + name).lstrip("/")] = sha_sum if count == 1 else None  # like tarfile
+        return members
+
+    def _verify_mediums(self, storage: BaseRestoreStorageController, archive_ids: [int], sources: {int: str},
+                        archives: {int: ArchiveEntry}, members: {int: {str: str}}, encryptor: Encryptor,
+                        params: VerifyParameters) -> {int: dict}:
+        groups = storage.medium_groups(archive_ids, sources)
+        lock = threading.Lock()
+        t = create_pg(total=len(archive_ids), leave=False, unit='archive', desc='Verifying archives')
+
+        def verify_group(group: [int]) -> {int: dict}:
+            results = dict()
+            try:
+                for archive_id, path in storage.open_archives(group, sources):
+                    results[archive_id] = self._verify_archive(archives[archive_id], path, members.get(archive_id),
+                                                               encryptor, params)
+                    with lock:
+                        t.update(1)
+            except Exception as e:  # the medium can't be read any further
+                logger.error("Reading the medium failed: %s" % e)
+                for archive_id in group:
+                    if archive_id not in results:
+                        results[archive_id] = self._result(archives[archive_id], STATUS_DAMAGED, str(e))
+
+            for archive_id in group:
+                if archive_id not in results:  # the storage doesn't hand it out
+                    results[archive_id] = self._result(archives[archive_id], STATUS_MISSING)
+            return results
+
+        all_results = dict()
+        with t, concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(params.parallel_mediums,
+                                                                             len(groups)))) as executor:
+            for results in executor.map(verify_group, groups):
+                all_results.update(results)
+        return all_results
+
+    def _verify_archive(self, archive: ArchiveEntry, path: str, members: {str: str}, encryptor: Encryptor,
+                        params: VerifyParameters) -> dict:
+        try:
+            size = os.path.getsize(path)
+            if archive.size is not None and size != archive.size:
+                return self._result(archive, STATUS_DAMAGED, "%i bytes instead of %i" % (size, archive.size))
+            if archive.sha512 is not None and calculate_file_hash(path, "sha512", _READ_SIZE) != archive.sha512:
+                return self._result(archive, STATUS_DAMAGED, "Checksum doesn't match")
+
+            if not params.deep:
+                return self._result(archive, STATUS_OK if archive.sha512 is not None else STATUS_UNCHECKED)
+
+            checked, bad_files = self._verify_members(path, members or dict(), encryptor)
+            result = self._result(archive, STATUS_DAMAGED if bad_files else STATUS_OK,
+                                  "%i files don't match the index" % len(bad_files) if bad_files else None)
+            result["files"] = checked
+            if bad_files:
+                result["bad_files"] = bad_files
+            return result
+        except Exception as e:
+            return self._result(archive, STATUS_DAMAGED, str(e))
+
+    def _verify_members(self, path: str, members: {str: str}, encryptor: Encryptor) -> (int, [str]):
+        """Decompresses the archive as stream, returns the number of checked files and the files that don't match."""
+        expected = dict(members)
+        checked, bad_files = 0, list()
+        with tempfile.NamedTemporaryFile() as decrypted_file:
+            src_archive = path
+            if encryptor:
+                encryptor.decrypt_file(path, decrypted_file.name)
+                src_archive = decrypted_file.name
+
+            with tarfile.open(src_archive, 'r|*') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+
+                    sha = hashlib.sha256()
+                    f = tar.extractfile(member)
+                    for block in iter(lambda: f.read(_READ_SIZE), b""):
+                        sha.update(block)
+
+                    checked += 1
+                    sha_sum = expected.pop(member.name, None)
+                    if sha_sum is not None and sha.hexdigest() != sha_sum:
+                        bad_files.append("/" + member.name)
+
+        bad_files.extend("/" + name for name in expected)  # not in the archive at all
+        return checked, bad_files
+
+    @staticmethod
+    def _result(archive: ArchiveEntry, status: str, error: str = None) -> dict:
+        result = {"archive": archive.id, "name": archive.name, "disc": archive.disc_id, "size": archive.size,
+                  "status": status}
+        if error:
+            result["error"] = error
+        return result
+
+    @staticmethod
+    def _report(params: VerifyParameters, started: datetime.datetime, total: int, results: [dict]) -> dict:
+        finished = datetime.datetime.now(datetime.timezone.utc)
+        summary = {status: 0 for status in (STATUS_OK, STATUS_DAMAGED, STATUS_MISSING, STATUS_UNCHECKED)}
+        for result in results:
+            summary[result["status"]] += 1
+
+        return {
+            "source": params.source,
+            "started": started.isoformat(),
+            "finished": finished.isoformat(),
+            "seconds": round((finished - started).total_seconds(), 3),
+            "deep": params.deep,
+            "sample": params.sample,
+            "sample_round": params.sample_round,
+            "archives": total,
+            "verified": len(results),
+            "bytes": sum(result["size"] or 0 for result in results if result["status"] != STATUS_MISSING),
+            "summary": summary,
+            "results": results,
+        }
@@ -0,0 +1,131 @@
+import contextlib
+import hashlib
+import hmac
+import logging
+import os
+import shutil
+import tempfile
+
+from backup.common.logger import configure_logger
+from backup.core.encryptor import Encryptor
+
+logger = configure_logger(logging.getLogger(__name__))
+
+DEFAULT_INDEX_CACHE_DIRECTORY = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'pybutcherbackup', 'index'
+)
+
+
+class IndexCache:
+    """
+    Keeps decrypted copies of encrypted indexes between commands, so the index is only decrypted once.
+
+    An entry is named by the hash of the encrypted file, so a changed index never hits an old entry. The passphrase is
+    not part of the name (that would allow checking guesses against the encrypted index at hash speed), a sidecar file
+    holds a salted PBKDF2 tag of it instead. Without a matching tag the index is decrypted again, so a wrong
+    passphrase fails like without the cache. The cache directory is only accessible by the owner (it holds the
+    plaintext index) and can be put on a tmpfs. Only the max_entries most recently used entries are kept.
+    """
+
+    extension = ".sqlite"
+    tag_extension = ".key"
+    kdf_iterations = 600000
+    """PBKDF2-HMAC-SHA256 iterations of the passphrase tag"""
+
+    def __init__(self, directory: str = DEFAULT_INDEX_CACHE_DIRECTORY, max_entries: int = 4):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def decrypted(self, encrypted_file: str, encryptor: Encryptor) -> str:
+        """Returns the location of the decrypted index, decrypts it only if it isn't cached yet."""
+        entry = self._entry(encrypted_file)
+        if os.path.exists(entry) and self._matches_tag(entry, encryptor):
+            logger.debug("Index cache hit <%s>" % entry)
+            os.utime(entry)  # mark as recently used
+            return entry
+
+        with self._new_entry(entry, encryptor) as tmp_name:
+            encryptor.decrypt_file(encrypted_file, tmp_name)
+        return entry
+
+    def store(self, encrypted_file: str, encryptor: Encryptor, decrypted_file: str):
+        """Registers the decrypted counterpart of a freshly encrypted index, e.g. after a backup."""
+        entry = self._entry(encrypted_file)
+        with self._new_entry(entry, encryptor) as tmp_name:
+            shutil.copyfile(decrypted_file, tmp_name)
+
+    def clear(self):
+        for name in self._entries():
+            self._remove(name)
+
+    def _entry(self, encrypted_file: str) -> str:
+        key = hashlib.sha256()
+        with open(encrypted_file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                key.update(block)
+
+        return os.path.join(self.directory, key.hexdigest() + self.extension)
+
+    def _tag_file(self, entry: str) -> str:
+        return entry[:-len(self.extension)] + self.tag_extension
+
+    def _tag(self, encryptor: Encryptor, salt: bytes) -> bytes:
+        passphrase = str(getattr(encryptor, 'key', '')).encode('utf-8')
+        return hashlib.pbkdf2_hmac('sha256', passphrase, salt, self.kdf_iterations)
+
+    def _matches_tag(self, entry: str, encryptor: Encryptor) -> bool:
+        try:
+            with open(self._tag_file(entry), 'rb') as f:
+                salt, tag = f.read(16), f.read()
+        except FileNotFoundError:
+            return False
+        return hmac.compare_digest(self._tag(encryptor, salt), tag)
+
+    @contextlib.contextmanager
+    def _new_entry(self, entry: str, encryptor: Encryptor):
+        """Yields a temporary file that becomes the entry (with the tag of the passphrase) if the block succeeds."""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            yield tmp_name
+
+            salt = os.urandom(16)
+            with open(tmp_name + self.tag_extension, 'wb') as f:
+                f.write(salt + self._tag(encryptor, salt))
+            os.replace(tmp_name + self.tag_extension, self._tag_file(entry))
+            os.replace(tmp_name, entry)  # atomic, concurrent commands never see a partial entry
+        except BaseException:
+            for name in (tmp_name, tmp_name + self.tag_extension):
+                if os.path.exists(name):
+                    os.remove(name)
+            raise
+
+        self._evict()
+
+    def _entries(self) -> [str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith(self.extension)]
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda name: os.stat(name).st_mtime, reverse=True)
+        for name in entries[self.max_entries:] + [name for name in entries[:self.max_entries]
+                                                  if not os.path.exists(self._tag_file(name))]:  # older cache format
+            logger.debug("Evicting <%s> from the index cache" % name)
+            self._remove(name)
+
+    def _remove(self, entry: str):
+        for name in (entry, self._tag_file(entry)):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+def create_index_cache(general_settings) -> IndexCache:
+    """Index cache of the settings, None if the cache is disabled."""
+    if general_settings.index_cache_directory is None:
+        return None
+    return IndexCache(general_settings.index_cache_directory)
@@ -1,16 +1,32 @@
+import contextlib
+import logging
 import os
+import shutil
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from collections.abc import KeysView, Mapping
 
-from peewee import SqliteDatabase
+from peewee import JOIN, SqliteDatabase, Tuple, chunked, fn
 
 from backup.db.domain import *
 from enum import Enum
 
 from backup.core.luke import FileEntryDTO
+from backup.common.logger import configure_logger
 from backup.common.progressbar import create_pg
 
+logger = configure_logger(logging.getLogger(__name__))
+
 
 class BackupDatabaseWriter:
-    def __init__(self, backup_root):
+    """
+    Registers the files of one backup. File and mapping rows are buffered and written with multi row inserts, the IDs
+    of the files are allocated here, so they can be mapped to archives before they are written. The buffers are
+    flushed when they reach batch_size rows and before the transaction of the DatabaseManager commits.
+    """
+
+    def __init__(self, backup_root, batch_size: int = 10000):
         self.backup_root = backup_root
         self.files = dict()
         """Map of all registered files (relative_file, FileEntry)"""
@@ -18,6 +34,15 @@ class BackupDatabaseWriter:
         """Number of registered archives."""
         self.disc_number = 0
         """Number of registered discs."""
+        self.batch_size = batch_size
+        """Rows that are buffered before they are written"""
+
+        self._next_file_id = None
+        self._directories = None
+        """Cache of all directories (path, DirectoryEntry)"""
+        self._pending_files = list()
+        self._pending_backup_maps = list()
+        self._pending_archive_maps = list()
 
     def create_file_from_dto(self, file: FileEntryDTO, state: FileState) -> FileEntry:
         return self.create_file(
@@ -38,14 +63,21 @@ class BackupDatabaseWriter:
         if relative_file in self.files:
             return self.get_file(relative_file)
 
-        file = FileEntry.create(
+        if self._next_file_id is None:
+            self._next_file_id = (FileEntry.select(fn.MAX(FileEntry.id)).scalar() or 0) + 1
+            self._directories = {d.path: d for d in DirectoryEntry.select()}
+
+        path, name = split_relative_file(relative_file)
+        file = FileEntry(
+            id=self._next_file_id,
             sha_sum=sha_sum,
             modified_time=modified_time,
-            relative_file=relative_file,
-            size=size,
-            archive_map=None,
-            backup=None
+            directory=self._get_directory(path),
+            name=name,
+            size=size
         )
+        self._next_file_id += 1
+        self._pending_files.append((file.id, file.sha_sum, file.modified_time, file.size, file.directory.id, name))
 
         self.files[relative_file] = file
         self.map_file_to_backup(file, state)
@@ -55,53 +87,102 @@ class BackupDatabaseWriter:
     def get_file(self, original_file) -> FileEntry:
         return self.files[original_file]
 
-    def create_disc(self) -> DiscEntry:
+    def _get_directory(self, path: str) -> DirectoryEntry:
+        directory = self._directories.get(path)
+        if directory is None:  # directories are rare compared to files, they are written immediately
+            directory = self._directories[path] = DirectoryEntry.create(path=path)
+        return directory
+
+    def create_disc(self, destination: DestinationEntry = None) -> DiscEntry:
         no = self.disc_number
         self.disc_number += 1
 
         return DiscEntry.create(
             number=no,
-            backup=self.backup_root
+            backup=self.backup_root,
+            destination=destination
         )
 
     def create_archive(self, for_disc) -> ArchiveEntry:
         no = self.archive_number
         self.archive_number += 1
 
-        return ArchiveEntry.create(
+        archive = ArchiveEntry.create(
             number=no,
             disc=for_disc
         )
+        self.map_archive_to_disc(archive, for_disc)
+        return archive
+
+    def map_archive_to_disc(self, archive, disc) -> ArchiveDiscMap:
+        """Registers a copy of the archive on the disc (of another destination)."""
+        return ArchiveDiscMap.create(archive=archive, disc=disc)
 
     def map_file_to_archive(self, file, archive) -> ArchiveFileMap:
-        return ArchiveFileMap.create(
-            archive=archive,
-            file=file
-        )
+        """Buffers the mapping, it is written with the next flush."""
+        self._pending_archive_maps.append((archive.id, file.id))
+        self._flush_if_full()
+        return ArchiveFileMap(archive=archive, file=file)
 
     def map_file_to_backup(self, file, state: FileState):
         """
         Maps the file to the current backup. Automagically called when the file entity is created.
         """
-        return BackupFileMap.create(
-            backup=self.backup_root,
-            file=file,
-            state=state
-        )
+        self._pending_backup_maps.append((self.backup_root.id, file.id, state.value))
+        self._flush_if_full()
+        return BackupFileMap(backup=self.backup_root, file=file, state=state)
+
+    def flush(self):
+        """Writes all buffered rows, files first because the mappings reference them."""
+        self._insert(FileEntry, [FileEntry.id, FileEntry.sha_sum, FileEntry.modified_time, FileEntry.size,
+                                 FileEntry.directory, FileEntry.name], self._pending_files)
+        self._insert(BackupFileMap, [BackupFileMap.backup, BackupFileMap.file, BackupFileMap._state],
+                     self._pending_backup_maps)
+        self._insert(ArchiveFileMap, [ArchiveFileMap.archive, ArchiveFileMap.file], self._pending_archive_maps)
+
+    def _flush_if_full(self):
+        if max(len(self._pending_files), len(self._pending_backup_maps),
+               len(self._pending_archive_maps)) >= self.batch_size:
+            self.flush()
+
+    @staticmethod
+    def _insert(model, fields, rows: list):
+        # SQLite limits the variables per statement (32766 since 3.32, 999 before)
+        max_rows = (999 if sqlite3.sqlite_version_info < (3, 32) else 32766) // len(fields)
+        for batch in chunked(rows, max_rows):
+            model.insert_many(batch, fields=fields).execute()
+        rows.clear()
+
+
+class FileView(Mapping):
+    """Read-only view relative_file -> FileEntry on the state of a reader, nothing is copied."""
+
+    def __init__(self, file_infos: dict):
+        self._file_infos = file_infos
+
+    def __getitem__(self, relative_file) -> FileEntry:
+        return self._file_infos[relative_file].file
+
+    def __contains__(self, relative_file) -> bool:
+        return relative_file in self._file_infos
+
+    def __iter__(self):
+        return iter(self._file_infos)
+
+    def __len__(self) -> int:
+        return len(self._file_infos)
+
+    def keys(self) -> KeysView:
+        return self._file_infos.keys()
 
 
 class BackupDatabaseReader:
     class FileInfo:
-        def __init__(self, file: FileEntry, state: FileState, backup: BackupEntry):
+        def __init__(self, file: FileEntry, state: FileState, backup: BackupEntry, archives: [ArchiveEntry]):
             self.file = file
             self.state = state
             self.backup = backup
-
-            self.archives = list()
-            for afm in ArchiveFileMap.select().join(ArchiveEntry).join(DiscEntry).where(
-                    (ArchiveFileMap.file == file)
-                    & (DiscEntry.backup == backup)):
-                self.archives.append(afm.archive)
+            self.archives = archives
 
             if len(self.archives) == 0:
                 raise RuntimeError("Database corruption, can't find backup for file %s" % file)
@@ -122,40 +203,132 @@ class BackupDatabaseReader:
             # generate full file list
 
             # guess records to process
-            total_records = 0
-            for backup in backups:
-                total_records += len(backup.all_files)
+            total_records = BackupFileMap.select().where(BackupFileMap.backup.in_(backups)).count()
+            directories = BackupDatabaseReader._read_directories()
 
             with create_pg(total=total_records, leave=False, unit='records', desc='Reading backup information') as t:
                 for backup in backups:
-                    for backup_file_map in backup.all_files.select():
-                        f = backup_file_map.file
-                        if backup_file_map.state in (FileState.NEW, FileState.UPDATED):
+                    file_archives = BackupDatabaseReader._read_file_archives(
+                        BackupDatabaseReader._backup_archives_query(backup), {backup.id: backup}
+                    )
+
+                    for row in BackupDatabaseReader._backup_files_query(backup).iterator():
+                        f = BackupDatabaseReader._create_file(row, directories)
+                        state = FileState(row[-1])
+                        if state in (FileState.NEW, FileState.UPDATED):
                             info = BackupDatabaseReader.FileInfo(
-                                backup_file_map.file, backup_file_map.state, backup
+                                f, state, backup, file_archives.get(f.id, [])
                             )
                             file_relative_file[f.relative_file] = info
-                        elif backup_file_map.state == FileState.DELETED:
+                        elif state == FileState.DELETED:
                             del file_relative_file[f.relative_file]
 
                         t.update(1)
 
         return BackupDatabaseReader(file_relative_file, file_sha)
 
+    @staticmethod
+    def create_reader_from_current_state():
+        """Reads the materialized current state (see DatabaseManager.update_current_state)."""
+        file_relative_file = dict()
+        backups = {backup.id: backup for backup in BackupEntry.select()}
+        directories = BackupDatabaseReader._read_directories()
+
+        file_archives = BackupDatabaseReader._read_file_archives(
+            BackupDatabaseReader._current_archives_query(), backups
+        )
+
+        total_records = CurrentFileEntry.select().count()
+        with create_pg(total=total_records, leave=False, unit='records', desc='Reading backup information') as t:
+            for row in BackupDatabaseReader._current_files_query().iterator():
+                f = BackupDatabaseReader._create_file(row, directories)
+                file_relative_file[f.relative_file] = BackupDatabaseReader.FileInfo(
+                    f, FileState(row[-1]), backups[row[-2]], file_archives.get(f.id, [])
+                )
+                t.update(1)
+
+        return BackupDatabaseReader(file_relative_file, dict())
+
+    @staticmethod
+    def _read_directories() -> {int: DirectoryEntry}:
+        """All directories, shared by the files instead of one lookup per file."""
+        return {directory.id: directory for directory in DirectoryEntry.select()}
+
+    @staticmethod
+    def _create_file(row, directories: {int: DirectoryEntry}) -> FileEntry:
+        """Creates the file from the first columns of a files query row (see _FILE_COLUMNS)."""
+        return FileEntry(id=row[0], sha_sum=row[1], modified_time=row[2], size=row[3], directory=directories[row[4]],
+                         name=row[5])
+
+    # The queries are separate, so the tests can check their query plans. They return tuples, because building the
+    # joined models row by row takes longer than the query itself.
+
+    _FILE_COLUMNS = (FileEntry.id, FileEntry.sha_sum, FileEntry.modified_time, FileEntry.size, FileEntry.directory,
+                     FileEntry.name)
+
+    @staticmethod
+    def _archive_query():
+        return ArchiveFileMap.select(ArchiveFileMap.file, ArchiveEntry.id, ArchiveEntry.name, ArchiveEntry.size,
+                                     ArchiveEntry.sha512, DiscEntry.id, DiscEntry.backup) \
+            .join(ArchiveEntry).join(DiscEntry)
+
+    @staticmethod
+    def _backup_archives_query(backup: BackupEntry):
+        return BackupDatabaseReader._archive_query().where(DiscEntry.backup == backup).order_by(ArchiveFileMap.id) \
+            .tuples()
+
+    @staticmethod
+    def _backup_files_query(backup: BackupEntry):
+        return BackupFileMap.select(*BackupDatabaseReader._FILE_COLUMNS, BackupFileMap._state).join(FileEntry) \
+            .where(BackupFileMap.backup == backup).tuples()
+
+    @staticmethod
+    def _current_archives_query():
+        return BackupDatabaseReader._archive_query().join(
+            CurrentFileEntry,
+            on=((CurrentFileEntry.file == ArchiveFileMap.file) & (CurrentFileEntry.backup == DiscEntry.backup))
+        ).order_by(ArchiveFileMap.id).tuples()
+
+    @staticmethod
+    def _current_files_query():
+        return CurrentFileEntry.select(*BackupDatabaseReader._FILE_COLUMNS, CurrentFileEntry.backup,
+                                       CurrentFileEntry._state).join(FileEntry).tuples()
+
+    @staticmethod
+    def _read_file_archives(query, backups: {int: BackupEntry}) -> {int: [ArchiveEntry]}:
+        """Reads the archives of all files selected by the archive query in one pass: file id -> [archive]"""
+        archives = dict()
+        discs = dict()
+        file_archives = dict()
+
+        for file_id, archive_id, archive_name, size, sha512, disc_id, backup_id in query.iterator():
+            archive = archives.get(archive_id)
+            if archive is None:  # all files of an archive share the same instance
+                disc = discs.get(disc_id)
+                if disc is None:
+                    disc = discs[disc_id] = DiscEntry(id=disc_id, backup=backups[backup_id])
+                archive = archives[archive_id] = ArchiveEntry(id=archive_id, name=archive_name, size=size,
+                                                              sha512=sha512, disc=disc)
+
+            file_archives.setdefault(file_id, list()).append(archive)
+
+        return file_archives
+
     def __init__(self, file_relative_file: {str: FileInfo}, file_sha: {str: FileInfo}):
         self._all_files = file_relative_file
         self._all_sha = file_sha
+        self._all_files_view = FileView(file_relative_file)
 
     @property
-    def all_files(self) -> {str: FileEntry}:
+    def all_files(self) -> FileView:
         """
-        :return: relative_file() : FileEntry
+        :return: read-only view relative_file() : FileEntry
         """
-        ret = dict()
-        for key in self._all_files:
-            ret[key] = self._all_files[key].file
+        return self._all_files_view
 
-        return ret
+    def relative_files(self) -> KeysView:
+        """Set like view of all relative files, supports set operations (e.g. difference) without copying."""
+        return self._all_files.keys()
 
     def find_relative_file(self, relative_file) -> FileEntry:
         if relative_file not in self._all_files:
@@ -175,49 +348,408 @@ class BackupDatabaseReader:
         fi = self._all_files[file.relative_file]
         return fi.file, fi.state, fi.archives, fi.backup
 
+    def join_sha_sums(self, files):
+        """Yields (file, sha sum of the relative file in the index or None) for the files (FileEntryDTO)."""
+        for file in files:
+            fp = self.find_relative_file(file.relative_file)
+            yield file, fp.sha_sum if fp else None
+
     @property
     def is_empty(self) -> bool:
         return len(self._all_files) == 0
 
 
+class LazyFileView(Mapping):
+    """Read-only view relative_file -> FileEntry on a LazyBackupDatabaseReader, iterates sorted by path."""
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    def __getitem__(self, relative_file) -> FileEntry:
+        file = self._reader.find_relative_file(relative_file)
+        if file is None:
+            raise KeyError(relative_file)
+        return file
+
+    def __contains__(self, relative_file) -> bool:
+        return self._reader.find_relative_file(relative_file) is not None
+
+    def __iter__(self):
+        return self._reader.relative_files()
+
+    def __len__(self) -> int:
+        return CurrentFileEntry.select().count()
+
+    def items(self):
+        """Streams (relative_file, FileEntry) with one query, without filling the directory cache."""
+        directories = dict()
+        for row in LazyBackupDatabaseReader._sorted_files_query().iterator():
+            directory = directories.get(row[4])
+            if directory is None:  # the rows are sorted, only the current directory is kept
+                directories = {row[4]: DirectoryEntry(id=row[4], path=row[-1])}
+            f = BackupDatabaseReader._create_file(row, directories)
+            yield f.relative_file, f
+
+
+class LazyBackupDatabaseReader:
+    """
+    Reader for indexes that are too large to be held in memory. The current state is queried one directory at a time,
+    the last max_directories directories are kept in a LRU cache. Files should be looked up directory by directory
+    (like the file walker yields them), then every directory is queried once. Has the same interface as the
+    BackupDatabaseReader, iterating the files is sorted by directory and name.
+
+    join_sha_sums doesn't look up single files, it merges the files with one cursor sorted by directory and name.
+    """
+
+    def __init__(self, max_directories: int = 1024, file_name: str = None):
+        self.max_directories = max_directories
+        self.file_name = file_name
+        """Index file for the own connection of join_sha_sums, None to use the connection of the current thread"""
+        self._backups = {backup.id: backup for backup in BackupEntry.select()}
+        self._directories = OrderedDict()
+        """LRU cache path -> {name: FileInfo}"""
+        self._all_files_view = LazyFileView(self)
+
+    @property
+    def all_files(self) -> LazyFileView:
+        return self._all_files_view
+
+    def relative_files(self):
+        """Iterates all relative files, sorted by directory and name."""
+        for path, name in LazyBackupDatabaseReader._sorted_paths_query().iterator():
+            yield path + name
+
+    def find_relative_file(self, relative_file) -> FileEntry:
+        info = self._find_info(relative_file)
+        return info.file if info else None
+
+    def find_coordinates(self, file: FileEntry) -> (FileEntry, FileState, [ArchiveEntry], BackupEntry):
+        info = self._find_info(file.relative_file) if file else None
+        if info is None:
+            return None, None, None, None
+        return info.file, info.state, info.archives, info.backup
+
+    def join_sha_sums(self, files):
+        """
+        Yields (file, sha sum of the relative file in the index or None) for the files (FileEntryDTO), which have to be
+        sorted by directory and name like the file walker yields them. Merge join against one sorted cursor, files
+        that are out of order are treated as not in the index (so they are backed up again, never skipped).
+
+        The cursor has its own connection, opened and used only by the thread that iterates (e.g. the filter stage of
+        the pipeline), the connection of the DatabaseManager stays on its thread.
+        """
+        sql, params = LazyBackupDatabaseReader._sorted_sha_sums_query().sql()
+        if self.file_name is None:
+            yield from self._merge_sha_sums(files, database.execute_sql(sql, params))
+            return
+
+        with contextlib.closing(sqlite3.connect(self.file_name)) as connection:
+            yield from self._merge_sha_sums(files, connection.execute(sql, params))
+
+    @staticmethod
+    def _merge_sha_sums(files, cursor):
+        row = cursor.fetchone()
+        for file in files:
+            key = split_relative_file(file.relative_file)
+            while row is not None and (row[0], row[1]) < key:
+                row = cursor.fetchone()
+
+            if row is not None and (row[0], row[1]) == key:
+                yield file, row[2]
+            else:
+                yield file, None
+
+    @property
+    def is_empty(self) -> bool:
+        return not CurrentFileEntry.select().exists()
+
+    # sorted by the directory path and name index, no sorting in SQLite needed
+
+    @staticmethod
+    def _sorted_paths_query():
+        return CurrentFileEntry.select(DirectoryEntry.path, CurrentFileEntry.name).join(DirectoryEntry) \
+            .order_by(DirectoryEntry.path, CurrentFileEntry.name).tuples()
+
+    @staticmethod
+    def _sorted_sha_sums_query():
+        return DirectoryEntry.select(DirectoryEntry.path, CurrentFileEntry.name, FileEntry.sha_sum) \
+            .join(CurrentFileEntry, JOIN.CROSS).join(FileEntry, JOIN.CROSS) \
+            .where((CurrentFileEntry.directory == DirectoryEntry.id) & (CurrentFileEntry.file == FileEntry.id)) \
+            .order_by(DirectoryEntry.path, CurrentFileEntry.name).tuples()
+
+    @staticmethod
+    def _sorted_files_query():
+        # SQLite keeps the table order of cross joins, so the directories drive and the order comes from the indexes
+        return DirectoryEntry.select(*BackupDatabaseReader._FILE_COLUMNS, DirectoryEntry.path) \
+            .join(CurrentFileEntry, JOIN.CROSS).join(FileEntry, JOIN.CROSS) \
+            .where((CurrentFileEntry.directory == DirectoryEntry.id) & (CurrentFileEntry.file == FileEntry.id)) \
+            .order_by(DirectoryEntry.path, CurrentFileEntry.name).tuples()
+
+    def _find_info(self, relative_file) -> BackupDatabaseReader.FileInfo:
+        path, name = split_relative_file(relative_file)
+        return self._directory(path).get(name)
+
+    def _directory(self, path: str) -> {str: BackupDatabaseReader.FileInfo}:
+        files = self._directories.get(path)
+        if files is not None:
+            self._directories.move_to_end(path)
+            return files
+
+        files = self._directories[path] = self._load_directory(path)
+        if len(self._directories) > self.max_directories:
+            self._directories.popitem(last=False)
+        return files
+
+    def _load_directory(self, path: str) -> {str: BackupDatabaseReader.FileInfo}:
+        directory = DirectoryEntry.get_or_none(DirectoryEntry.path == path)
+        if directory is None:
+            return dict()
+
+        file_archives = BackupDatabaseReader._read_file_archives(
+            BackupDatabaseReader._current_archives_query().where(CurrentFileEntry.directory == directory),
+            self._backups
+        )
+
+        files = dict()
+        directories = {directory.id: directory}
+        query = BackupDatabaseReader._current_files_query().where(CurrentFileEntry.directory == directory)
+        for row in query.iterator():
+            f = BackupDatabaseReader._create_file(row, directories)
+            files[f.name] = BackupDatabaseReader.FileInfo(
+                f, FileState(row[-1]), self._backups[row[-2]], file_archives.get(f.id, [])
+            )
+        return files
+
+
+_MODELS = [BackupsEntry, BackupEntry, DestinationEntry, DiscEntry, ArchiveEntry, ParityGroupEntry, ParityEntry,
+           ArchiveDiscMap, ArchiveFileMap, DirectoryEntry, FileEntry, BackupFileMap, CurrentFileEntry]
+
+
 class DatabaseManager:
-    _database_version = 1
+    """
+    Opens the index with a tuned SQLite profile: WAL journal, synchronous=NORMAL, a large page cache and memory mapped
+    I/O while the database is open. Instead of a full VACUUM the index uses auto_vacuum=INCREMENTAL and is compacted
+    when enough pages are free. close_database checkpoints and switches back to a rollback journal, so the index is a
+    single self-contained file again (e.g. for copying it to the media).
+
+    A read_only database (restore, listing) is never written: it keeps its journal mode and isn't compacted. An old
+    index version (e.g. a shard on a burned medium) is migrated in a temporary copy, which is removed again by
+    close_database.
+    """
+    _database_version = 7
+
+    page_size = 8192
+    """Page size of new (or converted) indexes in bytes"""
+    cache_size = 64 * 1024
+    """Page cache in KiB"""
+    mmap_size = 256 * 1024 * 1024
+    """Memory mapped I/O in bytes"""
+    vacuum_threshold = 0.1
+    """Fraction of free pages which triggers an incremental vacuum when the database is closed"""
 
     # Note that the database manager is static because of the "static" proxy to peewee.database
-    def __init__(self, file_name):
+    def __init__(self, file_name, read_only: bool = False):
         if file_name is None:
             raise RuntimeError("Database file can't be None.")
 
         self.file_name = file_name
+        self.read_only = read_only
         self.database = database
+        self._writers = list()
+        self._migrated_copy = None
+        """Temporary copy of an old read_only index, it's migrated instead of the index"""
         self.open_database(file_name)
 
+    @contextlib.contextmanager
     def transaction(self):
-        return self.database.transaction()
+        """Database transaction, the buffered rows of the backup writers are flushed at its end."""
+        with self.database.transaction() as txn:
+            yield txn
+            self.flush_writers()
+
+    def flush_writers(self):
+        for writer in self._writers:
+            writer.flush()
 
     def open_database(self, file_name):
-        db = SqliteDatabase(file_name, pragmas={'foreign_keys': 1})
+        self._connect(file_name)
+
+        if not self.read_only:
+            self._convert_storage()
+            self.database.execute_sql('PRAGMA journal_mode = WAL')
+
+        version = self.database.execute_sql('PRAGMA user_version').fetchone()[0]
+        if version > self._database_version:
+            raise RuntimeError("Unknown database version %i" % version)
+
+        if self.read_only and version < self._database_version:
+            logger.info("Index <%s> has version %i, migrating a temporary copy" % (file_name, version))
+            self.database.close()
+            self._migrated_copy = tempfile.NamedTemporaryFile(suffix=".sqlite")
+            shutil.copyfile(file_name, self._migrated_copy.name)
+            self.file_name = self._migrated_copy.name
+            self._connect(self.file_name)
+
+        if version == 0:
+            self.create_tables()
+            self.database.execute_sql("PRAGMA user_version = %i" % self._database_version)
+        elif version < self._database_version:
+            self._migrate(version)
+
+    def _connect(self, file_name):
+        db = SqliteDatabase(file_name, pragmas=[
+            ('foreign_keys', 1),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -self.cache_size),
+            ('mmap_size', self.mmap_size),
+            ('temp_store', 'MEMORY'),
+        ])
         self.database.initialize(db)
         self.database.connect()
 
-        version = self.database.execute_sql('PRAGMA user_version').fetchone()
-        if version[0] == 0:
+    def create_tables(self):
+        with self.database:
+            self.database.create_tables(_MODELS)
+
+    def _migrate(self, version: int):
+        """
+        Upgrades the database from version to the current version in one transaction. The steps only change the
+        existing tables, new tables and indexes are created afterwards and the current state is rebuilt if a step
+        asked for it.
+        """
+        self._rebuild_current_state = False
+        with self.database.atomic():
+            for next_version in range(version + 1, self._database_version + 1):
+                logger.info("Migrating index to version %i" % next_version)
+                getattr(self, "_migrate_to_%i" % next_version)()
+
+            self.database.create_tables(_MODELS)
+            if self._rebuild_current_state:
+                self.rebuild_current_state()
+            self.database.execute_sql('ANALYZE')
             self.database.execute_sql("PRAGMA user_version = %i" % self._database_version)
-        elif version[0] != self._database_version:
-            raise "Unknown database version %i" % self._database_version
 
-        self.create_tables()
+    def _migrate_to_2(self):
+        # new current state table
+        self._rebuild_current_state = True
 
-    def create_tables(self):
-        with self.database:
-            self.database.create_tables(
-                [BackupsEntry, BackupEntry, DiscEntry, ArchiveEntry,
-                 ArchiveFileMap, FileEntry, BackupFileMap]
+    def _migrate_to_3(self):
+        # indexes for path and hash lookups, created with the new tables
+        pass
+
+    def _migrate_to_4(self):
+        # paths are split into a directory table and the file name, modified times are stored in microseconds
+        columns = [row[1] for row in self.database.execute_sql('PRAGMA table_info(file_entry)')]
+        if 'relative_file' not in columns:
+            return
+
+        self.database.execute_sql('DROP TABLE IF EXISTS current_file_entry')
+        self._rebuild_current_state = True
+
+        self.database.create_tables([DirectoryEntry])
+        self.database.execute_sql('DROP INDEX IF EXISTS file_entry_relative_file')
+        self.database.execute_sql(
+            'ALTER TABLE file_entry ADD COLUMN directory_id INTEGER REFERENCES directory_entry (id)'
+        )
+        self.database.execute_sql('ALTER TABLE file_entry ADD COLUMN name TEXT')
+
+        directories = dict()
+        last_id = 0
+        while True:
+            rows = self.database.execute_sql(
+                'SELECT id, relative_file FROM file_entry WHERE id > ? ORDER BY id LIMIT 10000', (last_id,)
+            ).fetchall()
+            if len(rows) == 0:
+                break
+
+            updates = list()
+            for file_id, relative_file in rows:
+                path, name = split_relative_file(relative_file)
+                if path not in directories:
+                    directories[path] = self.database.execute_sql(
+                        'INSERT INTO directory_entry (path) VALUES (?)', (path,)
+                    ).lastrowid
+                updates.append((directories[path], name, file_id))
+            self.database.cursor().executemany('UPDATE file_entry SET directory_id = ?, name = ? WHERE id = ?', updates)
+            last_id = rows[-1][0]
+
+        self.database.execute_sql('ALTER TABLE file_entry DROP COLUMN relative_file')
+
+        # datetime strings (only written by tests) are interpreted as UTC
+        self.database.execute_sql(
+            "UPDATE file_entry SET modified_time = CASE typeof(modified_time) "
+            "WHEN 'text' THEN CAST(ROUND((julianday(modified_time) - 2440587.5) * 86400000000) AS INTEGER) "
+            "ELSE CAST(ROUND(modified_time * 1000000) AS INTEGER) END"
+        )
+
+    def _migrate_to_5(self):
+        # mediums belong to a destination, archives can have copies on the mediums of several destinations
+        columns = [row[1] for row in self.database.execute_sql('PRAGMA table_info(disc_entry)')]
+        if 'destination_id' in columns:
+            return
+
+        # the model has the parity columns of version 6 already, they reference the parity groups
+        self.database.create_tables([DestinationEntry, ParityGroupEntry, ArchiveDiscMap])
+        self.database.execute_sql(
+            'ALTER TABLE disc_entry ADD COLUMN destination_id INTEGER REFERENCES destination_entry (id)'
+        )
+        self.database.execute_sql(
+            'INSERT INTO archive_disc_map (archive_id, disc_id) SELECT id, disc_id FROM archive_entry'
+        )
+
+    def _migrate_to_6(self):
+        # archive sizes and parity groups, the parity tables are created with the new tables
+        columns = [row[1] for row in self.database.execute_sql('PRAGMA table_info(archive_entry)')]
+        if 'size' not in columns:
+            self.database.execute_sql('ALTER TABLE archive_entry ADD COLUMN size BIGINT')
+
+        columns = [row[1] for row in self.database.execute_sql('PRAGMA table_info(archive_disc_map)')]
+        if 'parity_group_id' not in columns:
+            self.database.create_tables([ParityGroupEntry])
+            self.database.execute_sql(
+                'ALTER TABLE archive_disc_map ADD COLUMN parity_group_id INTEGER REFERENCES parity_group_entry (id)'
             )
+            self.database.execute_sql('ALTER TABLE archive_disc_map ADD COLUMN parity_index INTEGER')
+
+    def _migrate_to_7(self):
+        # checksum and codec of the archives, older archives can't be verified
+        columns = [row[1] for row in self.database.execute_sql('PRAGMA table_info(archive_entry)')]
+        if 'sha512' not in columns:
+            self.database.execute_sql('ALTER TABLE archive_entry ADD COLUMN sha512 TEXT')
+        if 'codec' not in columns:
+            self.database.execute_sql('ALTER TABLE archive_entry ADD COLUMN codec TEXT')
+
+    def _convert_storage(self):
+        """Sets page size and incremental auto vacuum. Needs a full VACUUM once for indexes created without them."""
+        auto_vacuum = self.database.execute_sql('PRAGMA auto_vacuum').fetchone()[0]
+        page_size = self.database.execute_sql('PRAGMA page_size').fetchone()[0]
+        if auto_vacuum == 2 and page_size == self.page_size:  # 2 = INCREMENTAL
+            return
+
+        self.database.execute_sql('PRAGMA journal_mode = DELETE')  # the page size can't be changed in WAL mode
+        self.database.execute_sql('PRAGMA page_size = %i' % self.page_size)
+        self.database.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+        self.database.execute_sql('VACUUM main')
+
+    def compact(self, threshold: float = None):
+        """Gives free pages back to the file system if at least threshold (fraction) of the pages is free."""
+        threshold = self.vacuum_threshold if threshold is None else threshold
+        free = self.database.execute_sql('PRAGMA freelist_count').fetchone()[0]
+        total = self.database.execute_sql('PRAGMA page_count').fetchone()[0]
+        if total > 0 and free > 0 and free / total >= threshold:
+            # executescript steps the pragma until it is done, a cursor stops after the first page
+            self.database.connection().executescript('PRAGMA incremental_vacuum')
 
     def close_database(self):
-        self.database.execute_sql('VACUUM main')
+        if not self.read_only:
+            self.compact()
+            # single file again: move the WAL content into the database and remove the WAL
+            self.database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.database.execute_sql('PRAGMA journal_mode = DELETE')
         self.database.close()
+        if self._migrated_copy is not None:
+            self._migrated_copy.close()
+            self._migrated_copy = None
 
     def all_backups(self):
         return BackupEntry.select()
@@ -232,18 +764,106 @@ class DatabaseManager:
         else:
             return s.first()
 
+    def destination(self, name: str) -> DestinationEntry:
+        """Destination with the name (e.g. the destination directory), created on first use."""
+        destination, _ = DestinationEntry.get_or_create(name=name)
+        return destination
+
     def create_backup(self, backup_type: BackupType, backup_name: str) -> BackupDatabaseWriter:
         backup = BackupEntry.create(
             backups=self.backups_root(backup_name),
             type=backup_type
         )
 
-        return BackupDatabaseWriter(backup)
+        writer = BackupDatabaseWriter(backup)
+        self._writers.append(writer)
+        return writer
 
-    def read_backup(self, backup) -> BackupDatabaseReader:
+    def read_backup(self, backup, lazy: bool = False) -> BackupDatabaseReader:
         """
 
         :param backup: Backup to start from (not implemented), None to start from the latest
+        :param lazy: Query the files on demand instead of loading all of them (LazyBackupDatabaseReader)
         :return:
         """
+        if backup is None and lazy:
+            return LazyBackupDatabaseReader(file_name=self.file_name)
+        if backup is None:
+            return BackupDatabaseReader.create_reader_from_current_state()
         return BackupDatabaseReader.create_reader_from_backup(self.backups_root(None, False), backup)
+
+    def update_current_state(self, backup: BackupEntry):
+        """
+        Applies the files of the (just written) backup to the current state table. Has to be called inside of the
+        transaction of the backup.
+        """
+        self.flush_writers()
+        if backup.type == BackupType.FULL:
+            CurrentFileEntry.delete().execute()
+
+        changed = BackupFileMap \
+            .select(FileEntry.directory, FileEntry.name, FileEntry.id, BackupFileMap.backup, BackupFileMap._state) \
+            .join(FileEntry) \
+            .where((BackupFileMap.backup == backup)
+                   & (BackupFileMap._state.in_([FileState.NEW.value, FileState.UPDATED.value])))
+        CurrentFileEntry.insert_from(
+            changed, [CurrentFileEntry.directory, CurrentFileEntry.name, CurrentFileEntry.file, CurrentFileEntry.backup,
+                      CurrentFileEntry._state]
+        ).on_conflict_replace().execute()
+
+        deleted = BackupFileMap.select(FileEntry.directory, FileEntry.name).join(FileEntry) \
+            .where((BackupFileMap.backup == backup) & (BackupFileMap._state == FileState.DELETED.value))
+        CurrentFileEntry.delete().where(Tuple(CurrentFileEntry.directory, CurrentFileEntry.name).in_(deleted)).execute()
+
+    def rebuild_current_state(self):
+        """Recreates the current state table by replaying all backups since the last full backup."""
+        CurrentFileEntry.delete().execute()
+
+        backups = list()
+        for backup in BackupEntry.select().order_by(BackupEntry.created.desc()):
+            backups.append(backup)
+            if backup.type == BackupType.FULL:
+                break
+
+        for backup in reversed(backups):
+            self.update_current_state(backup)
+
+    @classmethod
+    def create_shard(cls, index_file: str, shard_file: str, discs: [int]):
+        """
+        Writes the part of the (closed) index that is needed to restore from the given discs into a new index: the
+        catalog of all backups, destinations, discs, archives (with their copies) and parity archives plus the files
+        with at least one archive on the discs. A file that also has parts on other discs keeps all of its archives, so
+        a restore knows which discs are missing.
+        """
+        with contextlib.closing(sqlite3.connect(shard_file, isolation_level=None)) as shard:
+            shard.execute('PRAGMA page_size = %i' % cls.page_size)
+            shard.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            shard.execute("ATTACH DATABASE ? AS idx", (index_file,))
+
+            version = shard.execute('PRAGMA idx.user_version').fetchone()[0]
+            schema = [sql for (sql,) in
+                      shard.execute("SELECT sql FROM idx.sqlite_master WHERE sql IS NOT NULL "
+                                    "AND name NOT LIKE 'sqlite_%' ORDER BY rowid")]  # e.g. sqlite_stat1 of ANALYZE
+            disc_params = ", ".join("?" * len(discs))
+
+            shard.execute("BEGIN")
+            for sql in schema:  # unqualified names are created in the shard
+                shard.execute(sql)
+
+            shard.execute("CREATE TEMP TABLE shard_file AS SELECT DISTINCT m.file_id AS id "
+                          "FROM idx.archive_file_map m JOIN idx.archive_disc_map d ON d.archive_id = m.archive_id "
+                          "WHERE d.disc_id IN (%s)" % disc_params, list(discs))
+            for table in ("backups_entry", "backup_entry", "destination_entry", "disc_entry", "archive_entry",
+                          "parity_group_entry", "parity_entry", "archive_disc_map"):
+                shard.execute("INSERT INTO main.%s SELECT * FROM idx.%s" % (table, table))
+            for table, column in (("file_entry", "id"), ("archive_file_map", "file_id"),
+                                  ("backup_file_map", "file_id"), ("current_file_entry", "file_id")):
+                shard.execute("INSERT INTO main.%s SELECT * FROM idx.%s WHERE %s IN (SELECT id FROM temp.shard_file)"
+                              % (table, table, column))
+            shard.execute("INSERT INTO main.directory_entry SELECT * FROM idx.directory_entry "
+                          "WHERE id IN (SELECT directory_id FROM main.file_entry)")
+            shard.execute("PRAGMA main.user_version = %i" % version)
+            shard.execute("COMMIT")
+
+            shard.execute("DETACH DATABASE idx")
@@ -12,4 +12,13 @@ class DiscId:
     @staticmethod
     def deserialize(in_file):
         with open(in_file, 'r') as stream:
-            return yaml.load(stream, Loader=yaml.FullLoader)
+            return yaml.load(stream, Loader=_DiscIdLoader)
+
+
+class _DiscIdLoader(yaml.SafeLoader):
+    """Safe loader that only knows the DiscId object (FullLoader doesn't construct python objects anymore)."""
+    pass
+
+
+_DiscIdLoader.add_constructor('tag:yaml.org,2002:python/object:backup.db.disc_id.DiscId',
+                              lambda loader, node: DiscId(**loader.construct_mapping(node)))
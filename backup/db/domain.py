@@ -53,24 +53,116 @@ class BackupEntry(BaseModel):
         self._type = value.value
 
 
+@auto_str
+class DestinationEntry(BaseModel):
+    """Storage destination (directory, stream, bucket) that receives a copy of the archives of a backup."""
+    name = TextField(unique=True)
+
+
 @auto_str
 class DiscEntry(BaseModel):
     backup = ForeignKeyField(BackupEntry, backref='discs')
+    destination = ForeignKeyField(DestinationEntry, null=True, backref='discs')
+    """Destination the medium belongs to, None for mediums written before destinations were recorded"""
 
 
 @auto_str
 class ArchiveEntry(BaseModel):
     disc = ForeignKeyField(DiscEntry, backref='archives')
+    """Medium of the first destination, all copies are in ArchiveDiscMap"""
     name = TextField(null=True)
+    size = BigIntegerField(null=True)
+    """Size of the stored archive in bytes"""
+    sha512 = TextField(null=True)
+    """SHA-512 (hex) of the stored archive, calculated while the archive was written"""
+    codec = TextField(null=True)
+    """Compression and encryption of the archive as file extension, e.g. tar.bz2.gpg"""
+
+
+@auto_str
+class ParityGroupEntry(BaseModel):
+    """Archives of a medium that are protected by the same parity archives (Reed-Solomon, see backup.core.parity)."""
+    disc = ForeignKeyField(DiscEntry, backref='parity_groups')
+
+
+@auto_str
+class ParityEntry(BaseModel):
+    group = ForeignKeyField(ParityGroupEntry, backref='parity')
+    number = IntegerField()
+    """Row of the parity archive in the code"""
+    name = TextField()
+
+
+@auto_str
+class ArchiveDiscMap(BaseModel):
+    """Every medium (of every destination) that holds a copy of the archive."""
+    archive = ForeignKeyField(ArchiveEntry, backref='copies')
+    disc = ForeignKeyField(DiscEntry, backref='archive_copies')
+    parity_group = ForeignKeyField(ParityGroupEntry, null=True, backref='archives')
+    """Parity group of the copy, None if the medium has no parity archives"""
+    parity_index = IntegerField(null=True)
+    """Index of the copy in its parity group"""
+
+    class Meta:
+        indexes = (
+            (('archive', 'disc'), True),
+        )
+
+
+class MicrosecondTimestampField(BigIntegerField):
+    """
+    Stores a timestamp (seconds since epoch, float or datetime) as integer microseconds, which takes 6 bytes in SQLite
+    instead of 8 for a real or 26 for a datetime string. Read back as float seconds.
+    """
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            value = value.timestamp()
+        return int(round(value * 1_000_000))
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return value / 1_000_000
+
+
+def split_relative_file(relative_file: str) -> (str, str):
+    """Splits the relative file into the directory (with trailing separator) and the file name."""
+    idx = relative_file.rfind("/") + 1
+    return relative_file[:idx], relative_file[idx:]
+
+
+@auto_str
+class DirectoryEntry(BaseModel):
+    """Every directory is stored once, files only reference it."""
+    path = TextField(unique=True)
 
 
 @auto_str
 class FileEntry(BaseModel):
-    sha_sum = TextField()
-    modified_time = DateTimeField()
+    sha_sum = TextField(index=True)
+    modified_time = MicrosecondTimestampField()
     size = IntegerField()
     """Size in bytes"""
-    relative_file = TextField()
+    directory = ForeignKeyField(DirectoryEntry, index=False)
+    name = TextField()
+    """File name inside of the directory"""
+
+    class Meta:
+        indexes = (
+            (('directory', 'name'), False),
+        )
+
+    @property
+    def relative_file(self) -> str:
+        return self.directory.path + self.name
+
+    @relative_file.setter
+    def relative_file(self, value: str):
+        path, self.name = split_relative_file(value)
+        self.directory, _ = DirectoryEntry.get_or_create(path=path)
 
 
 @auto_str
@@ -108,3 +200,27 @@ class BackupFileMap(BaseModel):
             # Every file can only be once in the same archive
             (('backup', 'file'), True),
         )
+
+
+@auto_str
+class CurrentFileEntry(BaseModel):
+    """
+    Materialized latest state of all files (deleted files are removed), updated at the end of every backup. Saves
+    replaying the backup chain from the last full backup.
+    """
+    directory = ForeignKeyField(DirectoryEntry, index=False)
+    name = TextField()
+    file = ForeignKeyField(FileEntry)
+    backup = ForeignKeyField(BackupEntry)
+    """Backup that stored the file, its discs contain the archives of the file"""
+    _state = TextField(null=False)  # NEW, UPDATED
+
+    @property
+    def state(self):
+        return FileState(self._state)
+
+    class Meta:
+        indexes = (
+            # path of the file
+            (('directory', 'name'), True),
+        )
@@ -1,68 +1,27 @@
-import os
+import concurrent.futures
 import dataclasses
 import logging
+import multiprocessing
+import os
 from math import ceil
 
+from backup.common import progressbar
 from backup.common.logger import configure_logger
+from backup.common.scratch import ScratchSpace, ScratchFile
+from backup.common.util import calculate_file_hash, available_cpu_count
 from backup.core.luke import FileEntryDTO
 from backup.core.archive import FileBulker, DefaultArchiver
-import tempfile
-from backup.multi.threadpool import ThreadPool
-import hashlib
-
-from backup.multi.backpressure import BackpressureManager
-from backup.common.progressbar import create_pg
+from backup.core.encryptor import Encryptor
+from backup.multi.autotune import ConcurrencyTuner
+from backup.multi.pipeline import Pipeline, PipelineStage
 
 logger = configure_logger(logging.getLogger(__name__))
 
-
-class ThreadingFileBulker(FileBulker):
-    """Bulks the list of files retrieved from the filewalker, into packages of size max_size."""
-
-    def __init__(self, file_iterator, max_size, pool):
-        super().__init__(file_iterator, max_size)
-        self.pool = pool
-
-    def file_package_iter(self):
-        """Gather max_size (bytes) in files and return the file entry objects as list."""
-        files = list()
-        futures = list()
-
-        amount = 0
-        for file in self.file_iterator:
-            if amount + self._estimate_file_size(file) > self.max_size:
-                if len(files) == 0:  # This file is too large for one archive, special handling
-                    self.pool.wait(futures)
-                    self._calculate_hash(file)
-                    yield self._finish_info_package([file])
-                    continue
-
-                self.pool.wait(futures)
-                yield self._finish_info_package(files)
-
-                files = list()
-                amount = 0
-
-            amount += file.size
-            files.append(file)
-            futures.append(self.pool.add_task(self._calculate_hash, file))  # todo calc small files in-thread?
-
-        if len(files) > 0:
-            yield self._finish_info_package(files)
-
-    @staticmethod
-    def _calculate_hash(file: FileEntryDTO):
-        sha256_hash = hashlib.sha256()
-        with open(file.original_file, "rb") as f:
-            # Read and update hash string value in blocks of 4K
-            block_size = 4096
-            for byte_block in iter(lambda: f.read(block_size), b""):
-                sha256_hash.update(byte_block)
-
-            file.sha_sum = sha256_hash.hexdigest()
-
-    def _finish_info_package(self, files):
-        return files
+STAGE_HASH = "hash"
+STAGE_FILTER = "filter"
+STAGE_BULK = "bulk"
+STAGE_COMPRESS = "compress"
+STAGE_ENCRYPT = "encrypt"
 
 
 @dataclasses.dataclass
@@ -70,106 +29,181 @@ class ArchivePackage:
     file_package: [FileEntryDTO]
     file_extension: str
     archive_file: str
-    tempfile: tempfile.NamedTemporaryFile
+    tempfile: ScratchFile
     part_number: int = -1
-
-
-class ThreadingArchiveManager:
-    def __init__(self, file_bulker: FileBulker, archiver: DefaultArchiver, pool: ThreadPool,
-                 pressure: BackpressureManager):
-        self.file_bulker = file_bulker
-        self.max_size = file_bulker.max_size
+    part_offset: int = 0
+    """Start of the part inside of the source file (only for split files)."""
+    part_size: int = 0
+    """Length of the part (only for split files)."""
+    pending_bytes: int = 0
+    """Bytes registered at the scratch space, released by the storage controller."""
+    sha512: str = None
+    """Checksum of archive_file, calculated while it was written (None if the writer doesn't provide one)"""
+
+
+class PipelineArchiveManager:
+    """
+    Runs the threaded backup as staged pipeline: hash -> filter -> bulk -> compress -> encrypt. The caller is the
+    store stage, it consumes archive_package_iter and releases the pressure of each stored package.
+
+    The bulk stage registers the scratch space a package needs for its whole lifetime (compressed and encrypted copy),
+    so the later stages never block on the budget and a full budget can't dead lock the pipeline.
+
+    Hashing is done in parallel before the (optional) file filter, which gets the files in walker order.
+
+    Packages are returned in completion order, only the parts of a split file keep their order.
+
+    With processes the compress and encrypt work is executed in a process pool, because the pure python parts of
+    tarfile hold the GIL. Work items are file lists plus byte ranges, the result is written to a temporary file owned
+    by this process, so only the path is handed back.
+    """
+
+    def __init__(self, file_iterator, max_size: int, archiver: DefaultArchiver, encryptor: Encryptor,
+                 scratch: ScratchSpace, stage_threads: {str: int}, stage_queue_sizes: {str: int} = None,
+                 processes: int = 0, file_filter=None, autotune_max_workers: int = 0):
+        self.file_iterator = file_iterator
+        self.max_size = max_size
         self.archiver = archiver
-        self.pool = pool
-        self.pressure = pressure
+        self.encryptor = encryptor
+        self.scratch = scratch
+        self.stage_threads = stage_threads
+        self.stage_queue_sizes = stage_queue_sizes or dict()
+        self.processes = processes
+        """Size of the process pool, 0 = execute in the stage threads"""
+        self.file_filter = file_filter
+        """Generator function that filters the stream of hashed files (see FileFilter.filter)"""
+        self.autotune_max_workers = autotune_max_workers
+        """Upper limit of workers per stage for the ConcurrencyTuner, 0 = fixed worker counts"""
+        self.pipeline = None
+        self._executor = None
+
+    def create_stages(self) -> [PipelineStage]:
+        stages = [self._create_stage(STAGE_HASH, self._hash_file, 16, True)]
+
+        if self.file_filter:
+            stages.append(PipelineStage(STAGE_FILTER, self.file_filter, 1,
+                                        self.stage_queue_sizes.get(STAGE_FILTER, 1024), True))
+
+        stages.append(PipelineStage(STAGE_BULK, self._bulk_packages, 1, self.stage_queue_sizes.get(STAGE_BULK, 1024),
+                                    True))
+        stages.append(self._create_stage(STAGE_COMPRESS, self._compress_package, 1))
+
+        if self.encryptor:
+            stages.append(self._create_stage(STAGE_ENCRYPT, self._encrypt_package, 1))
+
+        return stages
+
+    def _create_stage(self, name, func, queue_factor, ordered=False) -> PipelineStage:
+        workers = self.stage_threads.get(name, 1)
+        queue_size = self.stage_queue_sizes.get(name, workers * queue_factor)
+        return PipelineStage(name, func, workers, queue_size, ordered=ordered)
 
     def archive_package_iter(self) -> ArchivePackage:
-        """
+        self.pipeline = Pipeline(self.create_stages())
+        if self.processes > 0:
+            self._executor = create_process_pool(self.processes)
+
+        tuner = None
+        if self.autotune_max_workers > 0:
+            tuner = ConcurrencyTuner(self.pipeline, self.autotune_max_workers)
+            tuner.start()
+
+        try:
+            yield from self._ordered_packages()
+        finally:
+            if tuner:
+                tuner.stop()
+            if self._executor:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+    def _ordered_packages(self):
+        waiting_parts = dict()
+        """Parts that are completed before their predecessor {(relative_file, part_number): package}"""
+        next_part = dict()
+        """Next part number that may be handed out {relative_file: part_number}"""
+
+        for archive_package in self.pipeline.run(self.file_iterator):
+            if archive_package.part_number < 0:
+                yield archive_package
+                continue
+
+            relative_file = archive_package.file_package[0].relative_file
+            waiting_parts[(relative_file, archive_package.part_number)] = archive_package
+
+            part = next_part.get(relative_file, 0)
+            while (relative_file, part) in waiting_parts:
+                yield waiting_parts.pop((relative_file, part))
+                part += 1
+            next_part[relative_file] = part
+
+        assert len(waiting_parts) == 0, "Parts of split files are missing: %s" % list(waiting_parts.keys())
 
-        :return:
-            * File entry DTO
-            * path to the archive file
-            * number of the split package, or -1 if there is no source file split
-        """
+    @staticmethod
+    def _hash_file(file: FileEntryDTO) -> FileEntryDTO:
+        if file.sha_sum is None:
+            file.sha_sum = calculate_file_hash(file.original_file)
+        return file
 
-        queue = list()
-        futures = list()
+    def _bulk_packages(self, file_iterator):
         ext = self.archiver.extension
-
-        for file_package in self.file_bulker.file_package_iter():
+        for file_package in FileBulker(file_iterator, self.max_size).file_package_iter():
             if len(file_package) == 1 and file_package[0].size > self.max_size:
-
-                # in order to keep the order in the backup files, put a threading barrier here
-                # TODO make split_file multi threading able.
-                self.pool.wait(futures)
-                for q in futures:
-                    yield q.result(None)
-                    del q
-
-                # split file
                 file = file_package[0]
-
-                # guess parts
                 parts = int(ceil(file.size / self.max_size))
 
-                i = 0
-                for split_file in self.split_file(file.original_file):
-                    temp_file = tempfile.NamedTemporaryFile()
-                    self.archiver.compress_file(split_file, file, temp_file.name)
-                    yield ArchivePackage(file_package, ext, temp_file.name, temp_file, i)
-
-                    i += 1
+                for part in range(parts):
+                    offset = part * self.max_size
+                    size = min(self.max_size, file.size - offset)
+                    pending = self._register_pressure(size)
+                    yield ArchivePackage(file_package, ext, None, None, part, offset, size, pending)
             else:
-                while self.pressure.reached() and len(futures) > 0:
-                    yield futures[0].result(None)
-                    del futures[0]
-
-                # normal package
-                futures.append(self.pool.add_task(self._compress_file, file_package, queue, self.archiver))
-                self.pressure.register_pressure()
-
-                if futures[0].done():  # push already completed packages
-                    yield futures[0].result(None)
-                    del futures[0]
-
-        self.pool.wait(futures)
-        for q in futures:
-            yield q.result(None)
-            del q
-
-    @staticmethod
-    def _compress_file(file_package, queue, archiver: DefaultArchiver):
-        temp_file = tempfile.NamedTemporaryFile()
-        archiver.compress_files(file_package, temp_file.name)
-        dto = ArchivePackage(file_package, archiver.extension, temp_file.name, temp_file, -1)
-        queue.append(dto)
-
-        return dto
-
-    def split_file(self, input_file, buffer=1024) -> str:
-        """
-        Splits the file in multiple parts which have 'roughly' the size of self.max_size. The smallest size is
-        determined by the buffer size.
-        """
-        file_size = os.stat(input_file).st_size
-        with create_pg(total=file_size, leave=False, unit='B', unit_scale=True, unit_divisor=1024,
-                       desc='Splitting file') as t:
-
-            with open(input_file, 'rb') as src:
-                while True:
-                    with tempfile.NamedTemporaryFile() as f:
-                        with open(f.name, 'wb') as dest:
-                            written = 0
-                            while written < self.max_size:
-                                data = src.read(buffer)
-                                if data:
-                                    dest.write(data)
-                                    written += buffer
-                                    t.update(len(data))
-                                else:
-                                    if written == 0:
-                                        return  # file has ended on split size - don't yield
-
-                                    break
-
-                        yield f.name
+                size = sum(file.size for file in file_package)
+                pending = self._register_pressure(size)
+                yield ArchivePackage(file_package, ext, None, None, -1, 0, 0, pending)
+
+    def _register_pressure(self, size) -> int:
+        amount = size * 2 if self.encryptor else size  # compressed and encrypted file exist at the same time
+        while not self.scratch.register_pressure(amount, self.pipeline.poll_interval):
+            self.pipeline.check_abort()
+        return amount
+
+    def _compress_package(self, archive_package: ArchivePackage) -> ArchivePackage:
+        if archive_package.part_number < 0:
+            temp_file = self.scratch.create_file(sum(f.size for f in archive_package.file_package))
+            sha512 = self._execute(self.archiver.compress_files, archive_package.file_package, temp_file.name)
+        else:
+            temp_file = self.scratch.create_file(archive_package.part_size)
+            sha512 = self._execute(self.archiver.compress_file_part, archive_package.file_package[0],
+                                   archive_package.part_offset, archive_package.part_size, temp_file.name)
+
+        archive_package.archive_file = temp_file.name
+        archive_package.sha512 = sha512
+        archive_package.tempfile = temp_file
+        return archive_package
+
+    def _encrypt_package(self, archive_package: ArchivePackage) -> ArchivePackage:
+        temp_file = self.scratch.create_file(os.path.getsize(archive_package.archive_file))
+        sha512 = self._execute(self.encryptor.encrypt_file, archive_package.archive_file, temp_file.name)
+
+        archive_package.archive_file = temp_file.name
+        archive_package.sha512 = sha512
+        archive_package.tempfile.close()
+        archive_package.tempfile = temp_file
+        archive_package.file_extension += "." + self.encryptor.extension
+        return archive_package
+
+    def _execute(self, func, *args):
+        if self._executor is None:
+            return func(*args)
+        return self._executor.submit(func, *args).result()
+
+
+def create_process_pool(processes: int = None) -> concurrent.futures.ProcessPoolExecutor:
+    """Process pool sized against the available CPUs (cgroup quota), workers use the same progress bar type."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes or available_cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),  # forking a process with running threads is unsafe
+        initializer=progressbar.set_pg_type,
+        initargs=(progressbar.TYPE,)
+    )
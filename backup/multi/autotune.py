@@ -0,0 +1,172 @@
+import dataclasses
+import logging
+import os
+import threading
+import time
+
+from backup.common.logger import configure_logger
+from backup.multi.pipeline import Pipeline, PipelineStage
+
+logger = configure_logger(logging.getLogger(__name__))
+
+
+def read_cpu_times(stat_file='/proc/stat'):
+    """
+    Returns the system wide (busy, iowait, total) CPU time in jiffies or None if /proc/stat isn't available.
+    """
+    try:
+        with open(stat_file) as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+
+    # user nice system idle iowait irq softirq steal ...
+    total = sum(values[:8])
+    idle = values[3]
+    iowait = values[4] if len(values) > 4 else 0
+    return total - idle - iowait, iowait, total
+
+
+@dataclasses.dataclass
+class StageSample:
+    name: str
+    workers: int
+    throughput: float
+    """Items per second"""
+    utilization: float
+    """Fraction of the time the workers were busy (0..1)"""
+    queue_fill: float
+    """Fraction of the input queue that is filled (0..1)"""
+
+
+@dataclasses.dataclass
+class Sample:
+    cpu: float
+    """System wide CPU utilization (0..1)"""
+    iowait: float
+    """Fraction of the CPU time waiting for I/O (0..1)"""
+    stages: [StageSample]
+
+
+class ConcurrencyTuner:
+    """
+    Adjusts worker counts and queue depths of a running pipeline. Every interval it measures the throughput and
+    utilization of each stage, the CPU utilization and the I/O wait:
+
+    * If there is CPU left and little I/O wait, the busiest stage with a filled input queue gets another worker.
+    * If the I/O wait is high, the I/O bound hash stage loses a worker, as more readers only thrash the disk.
+    * Stages whose workers are mostly idle lose a worker.
+
+    Queue depths are scaled with the worker counts. The settled configuration is logged when the tuner is stopped, so
+    it can be pinned with the stage_threads / stage_queue_sizes parameters.
+    """
+
+    def __init__(self, pipeline: Pipeline, max_workers: int, interval: float = 5.0, io_stages=("hash",)):
+        self.pipeline = pipeline
+        self.max_workers = max(1, max_workers)
+        self.interval = interval
+        self.io_stages = io_stages
+
+        self.cpu_high = 0.85
+        self.iowait_high = 0.25
+        self.idle_utilization = 0.3
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+        self._sample_lock = threading.Lock()
+
+    def start(self):
+        self._last = self._measure_raw()
+        self._thread = threading.Thread(target=self._run, name="concurrency-tuner")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        logger.info("Concurrency settled on: %s" % self.configuration())
+
+    def configuration(self) -> str:
+        return ", ".join("%s=%i workers (queue %i)" % (s.name, s.workers, s.queue_size) for s in self.pipeline.stages)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.pipeline.aborted:
+                return
+
+            sample = self.sample()
+            if sample:
+                self.tune(sample)
+
+    def _measure_raw(self):
+        return time.perf_counter(), read_cpu_times(), os.times(), \
+               {s.name: (s.processed, s.busy_time) for s in self.pipeline.stages}
+
+    def sample(self) -> Sample:
+        """Measures the values since the last sample."""
+        with self._sample_lock:
+            last_time, last_cpu, last_times, last_stages = self._last
+            now, cpu_times, times, stages = self._last = self._measure_raw()
+
+        elapsed = now - last_time
+        if elapsed <= 0:
+            return None
+
+        if cpu_times and last_cpu and cpu_times[2] > last_cpu[2]:
+            total = cpu_times[2] - last_cpu[2]
+            cpu = (cpu_times[0] - last_cpu[0]) / total
+            iowait = (cpu_times[1] - last_cpu[1]) / total
+        else:  # no /proc/stat, use the CPU time of this process
+            used = (times.user + times.system) - (last_times.user + last_times.system)
+            cpu = used / (elapsed * (os.cpu_count() or 1))
+            iowait = 0.0
+        cpu = min(1.0, max(0.0, cpu))  # the counters have a coarse resolution
+
+        stage_samples = list()
+        for stage in self.pipeline.stages:
+            processed, busy = stages[stage.name]
+            last_processed, last_busy = last_stages.get(stage.name, (0, 0.0))
+            queue_fill = stage.input.qsize() / stage.queue_size if stage.input else 0.0
+            stage_samples.append(StageSample(
+                stage.name, stage.workers,
+                (processed - last_processed) / elapsed,
+                min(1.0, (busy - last_busy) / (elapsed * stage.workers)),
+                min(1.0, queue_fill)
+            ))
+
+        return Sample(cpu, iowait, stage_samples)
+
+    def tune(self, sample: Sample):
+        """Applies one tuning step based on the sample."""
+        stages = {s.name: s for s in self.pipeline.stages}
+        tunable = [s for s in sample.stages if not stages[s.name].generator]
+
+        if sample.iowait >= self.iowait_high:
+            for s in tunable:
+                if s.name in self.io_stages and s.workers > 1:
+                    self._set_workers(stages[s.name], s.workers - 1, "I/O wait %.0f%%" % (sample.iowait * 100))
+            return
+
+        if sample.cpu < self.cpu_high:
+            congested = [s for s in tunable if s.queue_fill >= 0.8 and s.workers < self.max_workers]
+            if congested:
+                bottleneck = max(congested, key=lambda s: s.utilization)
+                self._set_workers(stages[bottleneck.name], bottleneck.workers + 1,
+                                  "bottleneck, CPU %.0f%%" % (sample.cpu * 100))
+                return
+
+        for s in tunable:
+            if s.workers > 1 and s.utilization < self.idle_utilization and s.queue_fill < 0.2:
+                self._set_workers(stages[s.name], s.workers - 1, "idle %.0f%%" % ((1 - s.utilization) * 100))
+
+    def _set_workers(self, stage: PipelineStage, workers: int, reason: str):
+        old_workers = stage.workers
+        if self.pipeline.set_workers(stage, workers):
+            # the queue depth per worker stays the same
+            self.pipeline.set_queue_size(stage, max(1, stage.queue_size * workers // old_workers))
+            logger.debug("Stage <%s> now uses %i workers (%s)" % (stage.name, workers, reason))
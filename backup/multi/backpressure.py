@@ -1,12 +1,14 @@
+import threading
+
 
 class NopBackpressureManager:
     def __init__(self):
         pass
 
-    def register_pressure(self):
-        pass
+    def register_pressure(self, amount=1, timeout=None) -> bool:
+        return True
 
-    def unregister_pressure(self):
+    def unregister_pressure(self, amount=1):
         pass
 
     def reached(self) -> bool:
@@ -14,16 +16,38 @@ class NopBackpressureManager:
 
 
 class BackpressureManager:
+    """
+    Limits the amount (e.g. bytes of temporary archive space) that is in flight between the producers and the storage.
+    Thread safe, producers block in register_pressure until enough has been released.
+    """
 
     def __init__(self, max):
         self.max = max
         self.pressure = 0
+        self._condition = threading.Condition()
+
+    def register_pressure(self, amount=1, timeout=None) -> bool:
+        """
+        Waits until amount fits into the limit and registers it. A single amount larger than max is accepted if
+        nothing else is registered, otherwise it could never pass.
 
-    def register_pressure(self):
-        self.pressure += 1
+        :return: False if the timeout elapsed before the amount could be registered.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._fits(amount), timeout):
+                return False
 
-    def unregister_pressure(self):
-        self.pressure -= 1
+            self.pressure += amount
+            return True
+
+    def unregister_pressure(self, amount=1):
+        with self._condition:
+            self.pressure -= amount
+            self._condition.notify_all()
 
     def reached(self) -> bool:
-        return self.pressure >= self.max
+        with self._condition:
+            return self.pressure >= self.max
+
+    def _fits(self, amount) -> bool:
+        return self.pressure == 0 or self.pressure + amount <= self.max
@@ -0,0 +1,270 @@
+import logging
+import queue
+import threading
+import time
+
+from backup.common.logger import configure_logger
+
+logger = configure_logger(logging.getLogger(__name__))
+
+_END = object()
+"""Marks the end of the stream inside the stage queues."""
+
+
+class PipelineAbortedError(RuntimeError):
+    """Raised inside of stage threads to stop them after another part of the pipeline failed."""
+    pass
+
+
+class PipelineStage:
+    """
+    One step of the pipeline, executed by its own worker threads.
+
+    Every item of the input queue is handed to func and the result is passed to the next stage. Returning None drops
+    the item. A generator stage gets the whole input stream as iterator instead and can yield any amount of items,
+    this is only possible with one worker. An ordered stage hands out its results in input order, even though the
+    workers complete them in any order.
+    """
+
+    def __init__(self, name: str, func, workers: int = 1, queue_size: int = 1, generator: bool = False,
+                 ordered: bool = False):
+        if generator and workers != 1:
+            raise ValueError("Generator stage <%s> can only have one worker." % name)
+
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.generator = generator
+        self.ordered = ordered
+
+        self.input = None
+        """Bounded input queue, created when the pipeline is started."""
+        self.processed = 0
+        """Number of items processed by this stage."""
+        self.busy_time = 0.0
+        """Accumulated time (seconds) all workers spent inside of func."""
+
+        self._lock = threading.Lock()
+        self._running_workers = 0
+        self._retiring_workers = 0
+        self._finished = False
+
+        self._input_lock = threading.Lock()
+        self._order_lock = threading.Lock()
+        self._next_in = 0
+        self._next_out = 0
+        self._completed = dict()
+        """Results that wait for their predecessors {sequence: result}"""
+
+    def _record(self, duration: float):
+        with self._lock:
+            self.processed += 1
+            self.busy_time += duration
+
+    def __repr__(self):
+        return "<stage='%s' workers=%i queue_size=%i>" % (self.name, self.workers, self.queue_size)
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages. Every stage has a bounded input queue and its own amount of workers, so a
+    slow stage only blocks its producers and never the whole chain. Results are handed out in completion order.
+    """
+
+    def __init__(self, stages: [PipelineStage], poll_interval: float = 0.1):
+        self.stages = stages
+        self.poll_interval = poll_interval
+
+        self._output = None
+        self._outputs = dict()
+        self._threads = list()
+        self._threads_lock = threading.Lock()
+        self._abort = threading.Event()
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    @property
+    def aborted(self) -> bool:
+        return self._abort.is_set()
+
+    def check_abort(self):
+        """Raises PipelineAbortedError if the pipeline is shutting down. Can be used by long running stage code."""
+        if self._abort.is_set():
+            raise PipelineAbortedError()
+
+    def run(self, source):
+        """Feeds all items of the source iterator into the pipeline and yields the results of the last stage."""
+        self._output = queue.Queue()
+        for stage in self.stages:
+            stage.input = queue.Queue(maxsize=stage.queue_size)
+
+        self._start_thread("feeder", self._feed, source, self._first_queue())
+        for idx, stage in enumerate(self.stages):
+            output = self.stages[idx + 1].input if idx + 1 < len(self.stages) else self._output
+            self._outputs[stage.name] = output
+            stage._running_workers = stage.workers
+            for worker_no in range(stage.workers):
+                self._start_thread("%s-%i" % (stage.name, worker_no), self._work, stage, output)
+
+        finished = False
+        try:
+            while True:
+                item = self._get(self._output)
+                if item is _END:
+                    finished = True
+                    break
+                yield item
+        except PipelineAbortedError:
+            pass
+        finally:
+            if not finished:
+                self._abort.set()
+            self._join()
+
+        if self._error is not None:
+            raise self._error
+
+    def set_workers(self, stage: PipelineStage, workers: int) -> bool:
+        """
+        Changes the amount of workers of a running stage. Additional workers are started immediately, surplus workers
+        stop after their current item.
+
+        :return: False if the stage can't be changed (generator stage, not started or already finished)
+        """
+        workers = max(1, workers)
+        with stage._lock:
+            if stage.generator or stage._finished or stage.name not in self._outputs or self.aborted:
+                return False
+
+            added = workers - stage.workers
+            stage.workers = workers
+            if added < 0:
+                stage._retiring_workers -= added
+                return True
+
+            cancel_retire = min(added, stage._retiring_workers)  # workers that are still running are kept
+            stage._retiring_workers -= cancel_retire
+            added -= cancel_retire
+            stage._running_workers += added
+
+        for _ in range(added):
+            self._start_thread("%s-x" % stage.name, self._work, stage, self._outputs[stage.name])
+        return True
+
+    def set_queue_size(self, stage: PipelineStage, queue_size: int):
+        """Changes the size of the input queue of a running stage."""
+        stage.queue_size = max(1, queue_size)
+        q = stage.input
+        with q.mutex:
+            q.maxsize = stage.queue_size
+            q.not_full.notify_all()
+
+    def _first_queue(self):
+        return self.stages[0].input if len(self.stages) > 0 else self._output
+
+    def _start_thread(self, name, target, *args):
+        t = threading.Thread(target=self._guard, args=(target,) + args, name="pipeline-" + name)
+        t.daemon = True
+        with self._threads_lock:
+            self._threads.append(t)
+        t.start()
+
+    def _join(self):
+        while True:
+            with self._threads_lock:
+                if len(self._threads) == 0:
+                    return
+                t = self._threads.pop()
+            t.join()
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except PipelineAbortedError:
+            pass
+        except BaseException as e:
+            with self._error_lock:
+                if self._error is None:
+                    self._error = e
+                    logger.error("Pipeline thread <%s> failed: %s" % (threading.current_thread().name, e))
+            self._abort.set()
+
+    def _feed(self, source, output: queue.Queue):
+        for item in source:
+            self._put(output, item)
+        self._put(output, _END)
+
+    def _work(self, stage: PipelineStage, output: queue.Queue):
+        if stage.generator:
+            for result in stage.func(self._iter_input(stage)):
+                self._put(output, result)
+            self._put(output, _END)
+            return
+
+        while True:
+            with stage._lock:
+                if stage._retiring_workers > 0 and stage._running_workers > 1:  # the last one forwards the end
+                    stage._retiring_workers -= 1
+                    stage._running_workers -= 1
+                    return
+
+            with stage._input_lock:
+                item = self._get(stage.input)
+                sequence = stage._next_in
+                stage._next_in += 1
+
+            if item is _END:
+                self._put(stage.input, _END)  # let the other workers of this stage see the end, too
+                break
+
+            start = time.perf_counter()
+            result = stage.func(item)
+            stage._record(time.perf_counter() - start)
+
+            if stage.ordered:
+                self._put_ordered(stage, output, sequence, result)
+            elif result is not None:
+                self._put(output, result)
+
+        with stage._lock:
+            stage._running_workers -= 1
+            last = stage._running_workers == 0
+            if last:
+                stage._finished = True
+        if last:
+            self._put(output, _END)
+
+    def _put_ordered(self, stage: PipelineStage, output: queue.Queue, sequence: int, result):
+        with stage._order_lock:
+            stage._completed[sequence] = result
+            while stage._next_out in stage._completed:
+                result = stage._completed.pop(stage._next_out)
+                stage._next_out += 1
+                if result is not None:
+                    self._put(output, result)
+
+    def _iter_input(self, stage: PipelineStage):
+        while True:
+            item = self._get(stage.input)
+            if item is _END:
+                return
+            stage._record(0.0)
+            yield item
+
+    def _put(self, q: queue.Queue, item):
+        while True:
+            self.check_abort()
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q: queue.Queue):
+        while True:
+            self.check_abort()
+            try:
+                return q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
@@ -37,6 +37,25 @@ class BaseRestoreStorageController:
                           ext) -> [str]:
         pass
 
+    def open_archives(self, archive_ids: [int], sources: {int: str}):
+        """Yields (archive id, local path) of the archives, in the order the medium can read them best."""
+        for archive_id in archive_ids:
+            yield archive_id, sources[archive_id]
+
+    def medium_groups(self, archive_ids: [int], sources: {int: str}) -> [[int]]:
+        """Splits the archives into groups that can be opened at the same time, e.g. one per medium. open_archives is
+        called once per group. Storages that read everything through one device keep a single group."""
+        return [list(archive_ids)]
+
+    def repair_archive(self, archive_id: int):
+        """Rebuilds a damaged archive, returns a temporary file with it (closed by the caller) or None if the storage
+        can't repair it."""
+        return None
+
+    def close(self):
+        """Releases the mediums that are kept open between the calls of open_archives, at the end of the restore."""
+        pass
+
 
 class BaseStorageController:
     def start_backup(self, params: BackupParameters, general_settings: GeneralSettings) -> BaseBackupStorageController:
@@ -1,19 +1,29 @@
+import contextlib
+import logging
 import os
 import tempfile
 import shutil
 
 from backup.common.hookhelper import HookHelper
+from backup.common.logger import configure_logger
 from backup.common.progressbar import create_pg
-from backup.common.util import copy_with_progress, try_parse_int
+from backup.common.util import calculate_file_hash
 from backup.core.encryptor import GpgEncryptor
+from backup.core.parity import ParityEncoder, reconstruct
 from backup.core.parameters import BackupParameters, GeneralSettings, RestoreParameters
 from backup.db.db import DatabaseManager, BackupDatabaseReader
 from backup.db.disc_id import DiscId
-from backup.db.domain import DiscEntry, ArchiveEntry
+from backup.db.domain import DiscEntry, ArchiveEntry, ArchiveDiscMap, ParityGroupEntry, ParityEntry
 from backup.storage.base import BaseStorageController
 from backup.storage.base import BaseRestoreStorageController, BaseBackupStorageController
+from backup.storage.locator import ArchiveLocator, locator_state_file
+from backup.storage.placement import ArchivePlacer
+from backup.storage.writer import AsyncArchiveWriter
+
+logger = configure_logger(logging.getLogger(__name__))
 
 NUMBER_TO_FILE_FORMAT = "%010i"
+PARITY_EXTENSION = "par"
 
 
 def _create_disc_name(parameters, disc_domain):
@@ -40,6 +50,23 @@ class DirectoryStorageBackupParameters:
         self.slack_size = 1024 * 100  # 100 MB
         """The amount of space that is always left empty in each single medium/directory"""
 
+        self.write_buffers = 1
+        """Archives that can wait for or be in writing while the next one is produced, 0 = write synchronously"""
+
+        self.copy_buffer_size = 8 * 1024 * 1024
+        """Chunk size when archives have to be copied to the medium (they are moved if possible)"""
+        self.fsync = False
+        """Sync the archives of a medium to the disk when it is finished (before the finish_medium hook)"""
+
+        self.full_index_on_medium = False
+        """Copy the whole index to every medium, instead of the shard that covers the files of the medium"""
+
+        self.parity_archives = 0
+        """Reed-Solomon parity archives per parity group, that many damaged archives of a group can be repaired.
+        0 = no parity"""
+        self.parity_group_size = 16
+        """Archives of a medium that are protected together (at most 256 - parity_archives)"""
+
 
 class BackupDirectoryStorageController(BaseBackupStorageController):
     def __init__(self, parameters: BackupParameters, general_settings: GeneralSettings):
@@ -50,8 +77,21 @@ class BackupDirectoryStorageController(BaseBackupStorageController):
         print(" Medium size : ", parameters.backup_parameters.medium_size)
         self._general_settings = general_settings
         self._hook_helper = HookHelper(general_settings)
-        self.disc_directories = list()
+        self.disc_directories = dict()
+        """Directories of the mediums of this backup {disc id: directory}"""
         self.disc_directory = None
+        self._placer = ArchivePlacer(parameters.backup_parameters.copy_buffer_size, parameters.backup_parameters.fsync)
+        self._writer = None
+        if parameters.backup_parameters.write_buffers > 0:
+            self._writer = AsyncArchiveWriter(parameters.backup_parameters.write_buffers)
+
+        self._parity = None
+        """Encoder of the current parity group, used by the writer"""
+        self._parity_group = None
+        self._parity_count = 0
+        """Archives in the current parity group"""
+        self._parity_size = 0
+        """Size of the parity archives of the current group (largest archive)"""
 
     def next_medium_needed(self) -> bool:
         bp = self._parameters.backup_parameters
@@ -62,6 +102,11 @@ class BackupDirectoryStorageController(BaseBackupStorageController):
 
     def finish_medium(self, parameters, disc_domain: DiscEntry):
         super(BackupDirectoryStorageController, self).finish_medium(parameters, disc_domain)
+        self._finish_parity_group()
+        if self._writer:
+            self._writer.flush()  # the medium has to be complete before the hooks run
+        self._placer.sync()
+
         out_file = self.disc_directory + os.sep + self._general_settings.index_filename
         DiscId(disc_domain.id).serialize(out_file)
 
@@ -80,47 +125,109 @@ class BackupDirectoryStorageController(BaseBackupStorageController):
 
         src_file = archive_package.archive_file
         final_archive_name = archive_name + "." + archive_package.final_file_extension
-
+        self._current_medium_size += archive_domain.size  # recorded by the backup controller
+        parity = self._add_to_parity_group(disc_domain, archive_domain)
+
+        def write():
+            if parity:
+                parity.add(src_file)  # before the archive is placed, it might be moved
+            self._write_archive(archive_package, final_archive_name, pressure)
+
+        def written():
+            archive_domain.name = os.path.basename(final_archive_name)
+            archive_domain.save()
+
+        self._submit(write, written)
+
+    def _submit(self, write, written=None):
+        if self._writer:
+            self._writer.submit(write, written)
+        else:
+            write()
+            if written:
+                written()
+
+    def _add_to_parity_group(self, disc_domain: DiscEntry, archive_domain: ArchiveEntry) -> ParityEncoder:
+        """Registers the archive in the parity group of the medium, returns the encoder or None without parity."""
+        bp = self._parameters.backup_parameters
+        if bp.parity_archives <= 0:
+            return None
+
+        if self._parity is not None and self._parity_count >= min(bp.parity_group_size, self._parity.max_count):
+            self._finish_parity_group()
+        if self._parity is None:
+            self._parity_group = ParityGroupEntry.create(disc=disc_domain)
+            names = list()
+            for number in range(bp.parity_archives):
+                name = NUMBER_TO_FILE_FORMAT % self._parity_group.id + ".%i.%s" % (number, PARITY_EXTENSION)
+                ParityEntry.create(group=self._parity_group, number=number, name=name)
+                names.append(self.disc_directory + os.sep + name)
+            self._parity = ParityEncoder(names)
+            self._parity_count = 0
+            self._parity_size = 0
+
+        # the writer adds the archives in this order, so the index in the group is known already
+        ArchiveDiscMap.update(parity_group=self._parity_group, parity_index=self._parity_count) \
+            .where((ArchiveDiscMap.archive == archive_domain) & (ArchiveDiscMap.disc == disc_domain)).execute()
+        self._parity_count += 1
+
+        # the parity archives grow with the largest archive of the group
+        self._current_medium_size += bp.parity_archives * max(0, archive_domain.size - self._parity_size)
+        self._parity_size = max(self._parity_size, archive_domain.size)
+        return self._parity
+
+    def _finish_parity_group(self):
+        if self._parity is None:
+            return
+
+        parity, fsync = self._parity, self._parameters.backup_parameters.fsync
+        self._submit(lambda: parity.close(fsync))  # after the writer has added all archives
+        self._parity = self._parity_group = None
+
+    def _write_archive(self, archive_package, final_archive_name, pressure):
+        temp_file = getattr(archive_package, "tempfile", None)
         with create_pg(total=-1, leave=False, unit='B', unit_scale=True, unit_divisor=1024,
                        desc='Copy archive to destination') as t:
-            copy_with_progress(src_file, final_archive_name, t)
-            pressure.unregister_pressure()
+            # only temporary archives can be moved, the scratch space doesn't mind if they are gone
+            self._placer.place(archive_package.archive_file, final_archive_name, t, move=temp_file is not None)
+            pressure.unregister_pressure(getattr(archive_package, "pending_bytes", 1))
 
-        temp_file = getattr(archive_package, "tempfile", None)
         if temp_file:
             temp_file.close()  # empty the temporary directory
 
-        archive_domain.name = os.path.basename(final_archive_name)
-        archive_domain.save()
-
-        self._current_medium_size += self._get_size(final_archive_name)
-
-    def _get_size(self, file):
-        return os.stat(file).st_size
-
     def create_next_medium(self, disc_domain: DiscEntry):
         super(BackupDirectoryStorageController, self).create_next_medium(disc_domain)
         self.disc_directory = _create_disc_dir(self._parameters, disc_domain)
-        self.disc_directories.append(self.disc_directory)
+        self.disc_directories[disc_domain.id] = self.disc_directory
         self._current_medium_size = 0
 
     def finish_backup(self, db: DatabaseManager, params: BackupParameters, encryptor: GpgEncryptor):
         super(BackupDirectoryStorageController, self).finish_backup(db, params, encryptor)
-        db_file = db.file_name
-
-        ext = ""
-        db_tmp_file = None
-        if encryptor:
-            db_tmp_file = tempfile.NamedTemporaryFile()
+        if self._writer:
+            self._writer.close()
+
+        ext = "." + encryptor.extension if encryptor else ""
+        if params.backup_parameters.full_index_on_medium:
+            with self._encrypted(db.file_name, encryptor) as db_file:
+                for disc in self.disc_directories.values():
+                    shutil.copy(db_file, disc + os.sep + self._general_settings.database_name + ext)
+            return
+
+        for disc_id, disc in self.disc_directories.items():
+            with tempfile.NamedTemporaryFile() as shard_file:
+                DatabaseManager.create_shard(db.file_name, shard_file.name, [disc_id])
+                with self._encrypted(shard_file.name, encryptor) as db_file:
+                    shutil.copy(db_file, disc + os.sep + self._general_settings.database_name + ext)
+
+    @contextlib.contextmanager
+    def _encrypted(self, db_file: str, encryptor: GpgEncryptor):
+        if not encryptor:
+            yield db_file
+            return
+
+        with tempfile.NamedTemporaryFile() as db_tmp_file:
             encryptor.encrypt_file(db_file, db_tmp_file.name)
-            db_file = db_tmp_file.name
-            ext = "." + encryptor.extension
-
-        for disc in self.disc_directories:
-            shutil.copy(db_file, disc + os.sep + self._general_settings.database_name + ext)
-
-        if db_tmp_file:
-            db_tmp_file.close()
+            yield db_tmp_file.name
 
 
 class BackupDirectoryRestoreController(BaseRestoreStorageController):
@@ -128,39 +235,141 @@ class BackupDirectoryRestoreController(BaseRestoreStorageController):
         self._parameters = parameters
         self._general_settings = general_settings
         self._hook_helper = HookHelper(general_settings)
+        self._locator = ArchiveLocator(parameters.source, general_settings.index_filename,
+                                       locator_state_file(general_settings.index_cache_directory, parameters.source))
+        self._file_archives = dict()
+        """Archive ids of the files to restore {relative_file: [archive id]}"""
+        self._ext = None
+        self._verified = dict()
+        """Result of the checksum check of archives used to repair others {archive id: intact}"""
 
     def available_sources(self, backup_reader: BackupDatabaseReader, restore_files: [str],
                           ext) -> [str]:
-        # Every archive file name is like an ID. Try to find it in the specified directory or subdirectories.
-
-        all_files = dict()
-        for subdir, dirs, files in os.walk(self._parameters.source):
-            for file in files:
-                if file.endswith(ext):
-                    # extract id from file name
-                    pos_id, could_parse = try_parse_int(file[:-len(ext) - 1])
-
-                    if could_parse:
-                        f = os.path.join(subdir, file)
-                        all_files[pos_id] = f
+        # Every archive file name is like an ID. The locator finds them in the specified directory or subdirectories,
+        # only new or changed directories (e.g. an inserted medium) are listed again.
+        self._locator.refresh()
+        self._ext = ext
+        all_files = self._locator.archives(ext)
+
+        repairable = dict()  # missing archives that can be rebuilt from their parity group {archive id: bool}
+
+        def available(archive_id):
+            if archive_id in all_files:
+                return True
+            if not self._parameters.repair_archives:
+                return False
+            if archive_id not in repairable:
+                repairable[archive_id] = self._repair_sources(archive_id) is not None
+            return repairable[archive_id]
 
         found_files = list()
         for relative_file in restore_files:
-            file, state, archives, backup = backup_reader.find_coordinates(
-                backup_reader.find_relative_file(relative_file)
-            )
-
-            found_all = True
-            for archive in archives:
-                found_all = found_all and archive.id in all_files
-
-            if found_all:
+            archive_ids = self._file_archives.get(relative_file)
+            if archive_ids is None:
+                file, state, archives, backup = backup_reader.find_coordinates(
+                    backup_reader.find_relative_file(relative_file)
+                )
+                archive_ids = self._file_archives[relative_file] = [archive.id for archive in archives]
+
+            if all(available(archive_id) for archive_id in archive_ids):
                 found_files.append(relative_file)
             else:
                 print(relative_file)
 
+        if any(repairable.values()):  # the listing of the locator stays untouched
+            all_files = dict(all_files)
+            all_files.update((archive_id, None) for archive_id, can_repair in repairable.items() if can_repair)
         return found_files, all_files
 
+    def open_archives(self, archive_ids: [int], sources: {int: str}):
+        for archive_id in archive_ids:
+            path = sources[archive_id]
+            repair = self._parameters.repair_archives
+            if path is not None and (not repair or self._intact(archive_id, path)):
+                yield archive_id, path
+                continue
+            if not repair:
+                continue
+
+            repaired = self.repair_archive(archive_id)
+            if repaired is None:
+                logger.warning("Archive %i is damaged or missing and can't be repaired" % archive_id)
+                if path is not None:
+                    yield archive_id, path
+                continue
+
+            with repaired:
+                yield archive_id, repaired.name
+
+    def medium_groups(self, archive_ids: [int], sources: {int: str}) -> [[int]]:
+        groups = dict()
+        for archive_id in archive_ids:  # one group per medium directory
+            path = sources[archive_id]
+            groups.setdefault(os.path.dirname(path) if path else None, list()).append(archive_id)
+        return list(groups.values())
+
+    def repair_archive(self, archive_id: int):
+        sources = self._repair_sources(archive_id)
+        if sources is None:
+            return None
+
+        count, index, intact, parity = sources
+        repaired = tempfile.NamedTemporaryFile()
+        try:
+            reconstruct(count, intact, parity, {index: (repaired.name, self._archive_size(archive_id))})
+        except BaseException:
+            repaired.close()
+            raise
+        return repaired
+
+    def _repair_sources(self, archive_id: int) -> (int, int, {int: str}, {int: str}):
+        """
+        Parity group of the archive that can rebuild it from the available mediums: (archives in the group, index of
+        the archive, intact archives {index: path}, parity archives {number: path}). None if there is none.
+        """
+        archives = self._locator.archives(self._ext)
+        parity_files = None
+        copies = ArchiveDiscMap.select().where((ArchiveDiscMap.archive == archive_id)
+                                               & ArchiveDiscMap.parity_group.is_null(False))
+        for archive_copy in copies:
+            members = ArchiveDiscMap.select(ArchiveDiscMap.archive, ArchiveDiscMap.parity_index) \
+                .where(ArchiveDiscMap.parity_group == archive_copy.parity_group_id)
+            count, intact = 0, dict()
+            for member in members:
+                count += 1
+                path = archives.get(member.archive_id)
+                if member.archive_id != archive_id and path and self._intact(member.archive_id, path, True):
+                    intact[member.parity_index] = path
+
+            if parity_files is None:
+                parity_files = self._locator.files(PARITY_EXTENSION)
+            parity = {p.number: parity_files[p.name]
+                      for p in ParityEntry.select().where(ParityEntry.group == archive_copy.parity_group_id)
+                      if p.name in parity_files}
+
+            if len(intact) + len(parity) >= count:
+                return count, archive_copy.parity_index, intact, parity
+        return None
+
+    def _intact(self, archive_id: int, path: str, checksum: bool = False) -> bool:
+        """Archives that are gone or don't have the size (checksum) they were stored with are damaged."""
+        size, sha512 = ArchiveEntry.select(ArchiveEntry.size, ArchiveEntry.sha512) \
+            .where(ArchiveEntry.id == archive_id).tuples().get()
+        try:
+            if size is not None and os.path.getsize(path) != size:
+                return False
+        except OSError:
+            return False
+
+        if not checksum or sha512 is None:
+            return True
+        if archive_id not in self._verified:  # repairs of the same group use the same archives
+            self._verified[archive_id] = calculate_file_hash(path, "sha512") == sha512
+        return self._verified[archive_id]
+
+    def _archive_size(self, archive_id: int) -> int:
+        return ArchiveEntry.select(ArchiveEntry.size).where(ArchiveEntry.id == archive_id).scalar()
+
     def find_archive(self, params: RestoreParameters, backup_reader: BackupDatabaseReader, archive: ArchiveEntry, ext) \
             -> str:
         return _create_archive_name(params, archive.disc, archive)
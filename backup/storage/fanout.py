@@ -0,0 +1,49 @@
+import copy
+import threading
+
+from backup.core.parameters import BackupParameters
+from backup.db.domain import DestinationEntry
+from backup.storage.base import BaseBackupStorageController
+
+
+class BackupDestination:
+    """One destination of a backup: its parameters, storage and the medium that is currently written."""
+
+    def __init__(self, params: BackupParameters, entry: DestinationEntry, storage: BaseBackupStorageController):
+        self.params = params
+        """Backup parameters with the destination and storage parameters of this destination"""
+        self.entry = entry
+        self.storage = storage
+        self.disc_domain = None
+        """Medium that is currently written"""
+
+
+class SharedArchive:
+    """
+    Archive that is stored on several destinations. Every destination gets its own view of the archive package, which
+    doesn't own the temporary file (the archive is copied, never moved). The destinations release the archive through
+    this object instead of the backpressure manager, after the last one has written it the temporary file is removed
+    and the backpressure released. Destinations with write buffers write the archive concurrently.
+    """
+
+    def __init__(self, archive_package, pressure, copies: int):
+        self._archive_package = archive_package
+        self._pressure = pressure
+        self._copies = copies
+        self._lock = threading.Lock()
+
+    def package(self):
+        view = copy.copy(self._archive_package)
+        view.tempfile = None
+        return view
+
+    def unregister_pressure(self, amount=1):
+        with self._lock:  # destinations write in their own threads
+            self._copies -= 1
+            last = self._copies == 0
+
+        if last:
+            self._pressure.unregister_pressure(amount)
+            temp_file = getattr(self._archive_package, "tempfile", None)
+            if temp_file:
+                temp_file.close()  # empty the temporary directory
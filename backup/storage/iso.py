@@ -0,0 +1,499 @@
+import datetime
+import logging
+import os
+import re
+import struct
+import tempfile
+import time
+
+from backup.common.hookhelper import HookHelper
+from backup.common.logger import configure_logger
+from backup.common.progressbar import create_pg, ProgressBar
+from backup.common.util import try_parse_int
+from backup.core.encryptor import GpgEncryptor
+from backup.core.parameters import BackupParameters, GeneralSettings, RestoreParameters
+from backup.db.db import DatabaseManager, BackupDatabaseReader
+from backup.db.disc_id import DiscId
+from backup.db.domain import DiscEntry
+from backup.storage.base import BaseStorageController
+from backup.storage.base import BaseRestoreStorageController, BaseBackupStorageController
+from backup.storage.writer import AsyncArchiveWriter
+
+logger = configure_logger(logging.getLogger(__name__))
+
+NUMBER_TO_FILE_FORMAT = "%010i"
+ISO_EXTENSION = "iso"
+
+SECTOR_SIZE = 2048
+_DESCRIPTOR_SECTOR = 16
+"""Sectors 0-15 are the system area, the volume descriptors follow"""
+_DATA_SECTOR = _DESCRIPTOR_SECTOR + 3
+"""Primary, Joliet and terminator descriptor, the file data starts right after them"""
+_MAX_EXTENT_SIZE = 0xFFFFF800
+"""Largest extent that fits into the 32 bit size of a directory record, larger files get several extents"""
+
+
+def _both16(value: int) -> bytes:
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value: int) -> bytes:
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _sectors(size: int) -> int:
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _record_date(timestamp: float) -> bytes:
+    t = time.gmtime(timestamp)
+    return bytes([t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0])
+
+
+def _volume_date(timestamp: float) -> bytes:
+    t = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return t.strftime("%Y%m%d%H%M%S00").encode('ascii') + b"\x00"
+
+
+def iso_name(name: str) -> str:
+    """ISO 9660 (level 2) name: d-characters and a single dot, e.g. 0000000001.tar.bz2 -> 0000000001_TAR.BZ2;1"""
+    base, _, ext = name.upper().rpartition(".")
+    if not base:
+        base, ext = ext, ""
+    base = re.sub(r"[^A-Z0-9_]", "_", base)
+    ext = re.sub(r"[^A-Z0-9_]", "_", ext)
+    return (base[:30 - len(ext) - 1] if ext else base[:30]) + "." + ext + ";1"
+
+
+class IsoEntry:
+    def __init__(self, name: str, extents: [(int, int)], mtime: float):
+        self.name = name
+        self.extents = extents
+        """(first sector, size) of every extent of the file"""
+        self.mtime = mtime
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, size in self.extents)
+
+
+class IsoImageWriter:
+    """
+    Writes an ISO 9660 image (with Joliet names) while the files are added, the file data is never copied twice.
+
+    The data of the files is appended to the image one after the other. close() appends the directories and path
+    tables and then writes the volume descriptors into the sectors that have been kept free at the start, so only
+    three sectors are written out of order. An image that has been closed can be opened again with append to add more
+    files, the old directories are left behind as unused sectors.
+    """
+
+    def __init__(self, file_name: str, volume_id: str, buffer_size: int = 1024 * 1024, append: bool = False):
+        self.file_name = file_name
+        self.volume_id = volume_id
+        self.buffer_size = buffer_size
+        self.entries = list()
+
+        if append:
+            self.entries = list(IsoImageReader(file_name).entries.values())
+            self._file = open(file_name, 'r+b')
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(file_name, 'w+b')
+            self._file.write(bytes(_DATA_SECTOR * SECTOR_SIZE))
+
+    @property
+    def size(self) -> int:
+        """Size of the image so far"""
+        return self._file.tell()
+
+    def add_file(self, name: str, src_file: str, t: ProgressBar = None):
+        """Appends the file to the image, name is the (Joliet) name inside of the image."""
+        start = self._file.tell() // SECTOR_SIZE
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        size = 0
+        with open(src_file, 'rb') as f:
+            while True:
+                read = f.readinto(buf)
+                if not read:
+                    break
+                self._file.write(view[:read])
+                size += read
+                if t:
+                    t.update(read)
+        self._pad()
+
+        extents = list()
+        for offset in range(0, max(size, 1), _MAX_EXTENT_SIZE):
+            extents.append((start + offset // SECTOR_SIZE, min(_MAX_EXTENT_SIZE, size - offset)))
+        self.entries.append(IsoEntry(name, extents, os.path.getmtime(src_file)))
+
+    def close(self):
+        now = time.time()
+        self.entries.sort(key=lambda e: iso_name(e.name))
+        primary = self._write_tree(now, lambda e: iso_name(e.name).encode('ascii'))
+        self.entries.sort(key=lambda e: e.name)
+        joliet = self._write_tree(now, lambda e: e.name.encode('utf-16-be'))
+        total = self._file.tell() // SECTOR_SIZE
+
+        self._file.seek(_DESCRIPTOR_SECTOR * SECTOR_SIZE)
+        self._file.write(self._descriptor(1, total, primary, now))
+        self._file.write(self._descriptor(2, total, joliet, now))
+        self._file.write(b"\xff" + b"CD001" + b"\x01" + bytes(SECTOR_SIZE - 7))  # terminator
+        self._file.close()
+
+    def _pad(self):
+        self._file.write(bytes(-self._file.tell() % SECTOR_SIZE))
+
+    def _write_tree(self, now: float, identifier) -> (int, int, int):
+        """Appends the root directory and its path tables, returns (root sector, root size, path table sector)."""
+        records = list()
+        for entry in self.entries:
+            for idx, (sector, size) in enumerate(entry.extents):
+                last = idx == len(entry.extents) - 1
+                records.append(self._record(identifier(entry), sector, size, entry.mtime, 0 if last else 0x80))
+
+        # records must not cross sector boundaries
+        root_size = 2 * 34
+        for record in records:
+            if root_size % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+                root_size += -root_size % SECTOR_SIZE
+            root_size += len(record)
+        root_size = _sectors(root_size) * SECTOR_SIZE
+
+        root_sector = self._file.tell() // SECTOR_SIZE
+        data = bytearray(self._record(b"\x00", root_sector, root_size, now, 0x02))
+        data += self._record(b"\x01", root_sector, root_size, now, 0x02)
+        for record in records:
+            if len(data) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+                data += bytes(-len(data) % SECTOR_SIZE)
+            data += record
+        self._file.write(data)
+        self._pad()
+
+        # one path table entry (the root), little endian and big endian version in one sector each
+        path_table_sector = self._file.tell() // SECTOR_SIZE
+        self._file.write(b"\x01\x00" + struct.pack('<I', root_sector) + struct.pack('<H', 1) + b"\x00\x00")
+        self._pad()
+        self._file.write(b"\x01\x00" + struct.pack('>I', root_sector) + struct.pack('>H', 1) + b"\x00\x00")
+        self._pad()
+        return root_sector, root_size, path_table_sector
+
+    @staticmethod
+    def _record(identifier: bytes, sector: int, size: int, mtime: float, flags: int) -> bytes:
+        length = 33 + len(identifier) + (1 - len(identifier) % 2)  # even length
+        record = bytes([length, 0]) + _both32(sector) + _both32(size) + _record_date(mtime) + bytes([flags, 0, 0]) \
+            + _both16(1) + bytes([len(identifier)]) + identifier
+        return record + bytes(length - len(record))
+
+    def _descriptor(self, descriptor_type: int, total: int, tree: (int, int, int), now: float) -> bytes:
+        root_sector, root_size, path_table_sector = tree
+        if descriptor_type == 2:  # Joliet: UCS-2 identifiers
+            def text(value, length):
+                return (value + " " * length).encode('utf-16-be')[:length]
+            escape = b"%/E"
+        else:
+            def text(value, length):
+                return value.encode('ascii').ljust(length, b" ")[:length]
+            escape = b""
+
+        d = bytearray(SECTOR_SIZE)
+        d[0:7] = bytes([descriptor_type]) + b"CD001" + b"\x01"
+        d[8:40] = text("LINUX", 32)
+        d[40:72] = text(self.volume_id, 32)
+        d[80:88] = _both32(total)
+        d[88:88 + len(escape)] = escape
+        d[120:124] = _both16(1)
+        d[124:128] = _both16(1)
+        d[128:132] = _both16(SECTOR_SIZE)
+        d[132:140] = _both32(10)
+        d[140:144] = struct.pack('<I', path_table_sector)
+        d[148:152] = struct.pack('>I', path_table_sector + 1)
+        d[156:190] = self._record(b"\x00", root_sector, root_size, now, 0x02)
+        for start, length in ((190, 128), (318, 128), (446, 128), (702, 37), (739, 37), (776, 37)):
+            d[start:start + length] = text("", length)
+        d[574:702] = text("PYBUTCHERBACKUP", 128)
+        d[813:830] = _volume_date(now)
+        d[830:847] = _volume_date(now)
+        d[847:864] = b"0" * 16 + b"\x00"
+        d[864:881] = b"0" * 16 + b"\x00"
+        d[881] = 1
+        return bytes(d)
+
+
+class IsoImageReader:
+    """Reads the files of the root directory of an ISO 9660 image, with the Joliet names if there are any."""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.volume_id = None
+        self.entries = dict()
+        """{name: IsoEntry}"""
+
+        with open(file_name, 'rb') as f:
+            root, joliet = None, False
+            sector = _DESCRIPTOR_SECTOR
+            while True:
+                f.seek(sector * SECTOR_SIZE)
+                d = f.read(SECTOR_SIZE)
+                if len(d) < SECTOR_SIZE or d[1:6] != b"CD001":
+                    raise ValueError("<%s> is not an ISO 9660 image" % file_name)
+                if d[0] == 255:
+                    break
+                if d[0] == 1 and root is None:
+                    root, self.volume_id = d[156:190], d[40:72].decode('ascii').strip()
+                elif d[0] == 2 and d[88:91] in (b"%/@", b"%/C", b"%/E"):
+                    root, joliet = d[156:190], True
+                    self.volume_id = d[40:72].decode('utf-16-be').strip()
+                sector += 1
+
+            if root is None:
+                raise ValueError("<%s> has no primary volume descriptor" % file_name)
+            root_sector, root_size = struct.unpack_from('<I', root, 2)[0], struct.unpack_from('<I', root, 10)[0]
+            f.seek(root_sector * SECTOR_SIZE)
+            self._read_directory(f.read(root_size), joliet)
+
+    def _read_directory(self, data: bytes, joliet: bool):
+        pending = list()  # extents of a multi extent file
+        pos = 0
+        while pos < len(data):
+            length = data[pos]
+            if length == 0:  # rest of the sector is empty
+                pos += -pos % SECTOR_SIZE or SECTOR_SIZE
+                continue
+
+            record = data[pos:pos + length]
+            pos += length
+            identifier = record[33:33 + record[32]]
+            flags = record[25]
+            if identifier in (b"\x00", b"\x01") or flags & 0x02:
+                continue  # self, parent and sub directories
+
+            name = identifier.decode('utf-16-be' if joliet else 'ascii')
+            if name.endswith(";1"):
+                name = name[:-2]
+            pending.append((struct.unpack_from('<I', record, 2)[0], struct.unpack_from('<I', record, 10)[0]))
+            if flags & 0x80:
+                continue
+
+            y, mo, d, h, mi, s = record[18:24]
+            mtime = datetime.datetime(1900 + y, mo, d, h, mi, s, tzinfo=datetime.timezone.utc).timestamp()
+            self.entries[name] = IsoEntry(name, pending, mtime)
+            pending = list()
+
+    def extract(self, name: str, dest_file: str, t: ProgressBar = None, buffer_size: int = 1024 * 1024):
+        entry = self.entries[name]
+        with open(self.file_name, 'rb') as src, open(dest_file, 'wb') as dest:
+            for sector, size in entry.extents:
+                src.seek(sector * SECTOR_SIZE)
+                while size > 0:
+                    data = src.read(min(buffer_size, size))
+                    if not data:
+                        raise IOError("<%s> is truncated" % self.file_name)
+                    dest.write(data)
+                    size -= len(data)
+                    if t:
+                        t.update(len(data))
+
+
+class IsoStorageBackupParameters:
+    def __init__(self):
+        self.medium_size = 25025314816  # BD-R single layer
+        """Size of one image. Can be -1 = unlimited"""
+
+        self.slack_size = 1024 * 1024 * 100  # 100 MB
+        """The amount of space that is always left empty in each image (directories and the index shard)"""
+
+        self.write_buffers = 1
+        """Archives that can wait for or be in writing while the next one is produced, 0 = write synchronously"""
+
+
+class BackupIsoStorageController(BaseBackupStorageController):
+    """
+    Writes every medium as ISO 9660 image (with Joliet names) that can be burned directly, e.g. with growisofs.
+
+    The archives are written into the image as they are produced. The image is finished with the disc id file in
+    finish_medium, the index shard of the medium can only be created from the closed index and is added in
+    finish_backup. The finish_medium hook of every image runs after its shard was added, so a disc burned from the hook
+    is complete.
+    """
+
+    def __init__(self, parameters: BackupParameters, general_settings: GeneralSettings):
+        super(BackupIsoStorageController, self).__init__()
+        self._parameters = parameters
+        self._general_settings = general_settings
+        self._hook_helper = HookHelper(general_settings)
+        self._image = None
+        self.image_names = dict()
+        """Image of every medium of this backup {disc id: image file}"""
+        self._finished_images = list()
+        """Images waiting for their index shard and the finish_medium hook [(disc id, image file)]"""
+
+        self._writer = None
+        if parameters.backup_parameters.write_buffers > 0:
+            self._writer = AsyncArchiveWriter(parameters.backup_parameters.write_buffers)
+        self._current_medium_size = 0
+
+    def next_medium_needed(self) -> bool:
+        bp = self._parameters.backup_parameters
+
+        if bp.medium_size < 0:
+            return True
+        return self._current_medium_size + bp.slack_size >= bp.medium_size
+
+    def create_next_medium(self, disc_domain: DiscEntry):
+        super(BackupIsoStorageController, self).create_next_medium(disc_domain)
+        name = os.path.join(self._parameters.destination, NUMBER_TO_FILE_FORMAT % disc_domain.id + "." + ISO_EXTENSION)
+        self.image_names[disc_domain.id] = name
+        self._image = IsoImageWriter(name, _volume_id(disc_domain.id))
+        self._current_medium_size = self._image.size
+
+    def store_archive(self, archive_package, disc_domain, archive_domain, pressure):
+        super(BackupIsoStorageController, self).store_archive(archive_package, disc_domain, archive_domain, pressure)
+        name = NUMBER_TO_FILE_FORMAT % archive_domain.id + "." + archive_package.final_file_extension
+        self._current_medium_size += _sectors(os.stat(archive_package.archive_file).st_size) * SECTOR_SIZE
+        image = self._image
+
+        def write():
+            with create_pg(total=os.stat(archive_package.archive_file).st_size, leave=False, unit='B',
+                           unit_scale=True, unit_divisor=1024, desc='Write archive to image') as t:
+                image.add_file(name, archive_package.archive_file, t)
+            pressure.unregister_pressure(getattr(archive_package, "pending_bytes", 1))
+
+            temp_file = getattr(archive_package, "tempfile", None)
+            if temp_file:
+                temp_file.close()  # empty the temporary directory
+
+        def written():
+            archive_domain.name = name
+            archive_domain.save()
+
+        if self._writer:
+            self._writer.submit(write, written)
+        else:
+            write()
+            written()
+
+    def finish_medium(self, parameters, disc_domain: DiscEntry):
+        super(BackupIsoStorageController, self).finish_medium(parameters, disc_domain)
+        if self._writer:
+            self._writer.flush()
+
+        with tempfile.NamedTemporaryFile() as disc_id_file:
+            DiscId(disc_domain.id).serialize(disc_id_file.name)
+            self._image.add_file(self._general_settings.index_filename, disc_id_file.name)
+        self._image.close()
+        self._image = None
+        self._finished_images.append((disc_domain.id, self.image_names[disc_domain.id]))
+
+    def finish_backup(self, db: DatabaseManager, params: BackupParameters, encryptor: GpgEncryptor):
+        super(BackupIsoStorageController, self).finish_backup(db, params, encryptor)
+        if self._writer:
+            self._writer.close()
+
+        ext = "." + encryptor.extension if encryptor else ""
+        for disc_id, image_name in self._finished_images:
+            with tempfile.NamedTemporaryFile() as shard_file, tempfile.NamedTemporaryFile() as encrypted_file:
+                DatabaseManager.create_shard(db.file_name, shard_file.name, [disc_id])
+                if encryptor:
+                    encryptor.encrypt_file(shard_file.name, encrypted_file.name)
+
+                image = IsoImageWriter(image_name, _volume_id(disc_id), append=True)
+                image.add_file(self._general_settings.database_name + ext,
+                               encrypted_file.name if encryptor else shard_file.name)
+                image.close()
+
+            self._hook_helper.execute_hook("finish_medium", [image_name])
+        self._finished_images.clear()
+
+
+def _volume_id(disc_id: int) -> str:
+    return "PBB_" + NUMBER_TO_FILE_FORMAT % disc_id  # fits into the 16 characters of Joliet
+
+
+class IsoRestoreController(BaseRestoreStorageController):
+    """
+    Restores from ISO images written by BackupIsoStorageController, without mounting them. The source is an image, a
+    directory with images or the optical drive itself. Mounted or copied mediums can be restored like directories.
+    """
+
+    def __init__(self, general_settings: GeneralSettings, parameters: RestoreParameters):
+        self._parameters = parameters
+        self._general_settings = general_settings
+        self._images = dict()
+        """{image file: IsoImageReader}"""
+        self._archives = dict()
+        """Location of every archive {archive id: (image file, name)}"""
+
+    def available_sources(self, backup_reader: BackupDatabaseReader, restore_files: [str],
+                          ext) -> [str]:
+        self._read_images(ext)
+        all_files = {archive_id: image for archive_id, (image, name) in self._archives.items()}
+
+        found_files = list()
+        for relative_file in restore_files:
+            file, state, archives, backup = backup_reader.find_coordinates(
+                backup_reader.find_relative_file(relative_file)
+            )
+
+            if all(archive.id in all_files for archive in archives):
+                found_files.append(relative_file)
+            else:
+                logger.debug("Archives of <%s> are not available" % relative_file)
+
+        return found_files, all_files
+
+    def open_archives(self, archive_ids: [int], sources: {int: str}):
+        def position(archive_id):  # image by image, front to back
+            image, name = self._archives[archive_id]
+            return image, self._images[image].entries[name].extents[0][0]
+
+        for archive_id in sorted(archive_ids, key=position):
+            image, name = self._archives[archive_id]
+            with tempfile.NamedTemporaryFile() as archive_file:
+                reader = self._images[image]
+                with create_pg(total=reader.entries[name].size, leave=False, unit='B', unit_scale=True,
+                               unit_divisor=1024, desc='Read archive from image') as t:
+                    reader.extract(name, archive_file.name, t)
+                yield archive_id, archive_file.name
+
+    def medium_groups(self, archive_ids: [int], sources: {int: str}) -> [[int]]:
+        groups = dict()
+        for archive_id in archive_ids:  # one group per image
+            groups.setdefault(sources[archive_id], list()).append(archive_id)
+        return list(groups.values())
+
+    def _read_images(self, ext):
+        source = self._parameters.source
+        names = [source]
+        if os.path.isdir(source):
+            names = sorted(os.path.join(source, name) for name in os.listdir(source)
+                           if name.endswith("." + ISO_EXTENSION))
+
+        self._images.clear()
+        self._archives.clear()
+        suffix = "." + ext
+        for name in names:
+            try:
+                reader = IsoImageReader(name)
+            except (ValueError, OSError) as e:
+                logger.warning("Skipping <%s>: %s" % (name, e))
+                continue
+
+            self._images[name] = reader
+            for entry_name in reader.entries:
+                if entry_name.endswith(suffix):
+                    archive_id, could_parse = try_parse_int(entry_name[:-len(suffix)])
+                    if could_parse:
+                        self._archives[archive_id] = (name, entry_name)
+
+
+class IsoStorageController(BaseStorageController):
+    """Optical mediums (Blu-ray), every medium is an ISO image."""
+
+    def start_backup(self, params: BackupParameters, general_settings: GeneralSettings) -> BackupIsoStorageController:
+        return BackupIsoStorageController(params, general_settings)
+
+    def start_restore(self, general_settings: GeneralSettings,
+                      parameters: RestoreParameters) -> BaseRestoreStorageController:
+        return IsoRestoreController(general_settings, parameters)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+
+from backup.common.logger import configure_logger
+from backup.common.util import try_parse_int
+from backup.db.disc_id import DiscId
+
+logger = configure_logger(logging.getLogger(__name__))
+
+
+class ArchiveLocator:
+    """
+    Knows where the archives of a restore source are, without walking the whole source on every lookup.
+
+    Every directory below the source is listed once and remembered with its modification time. refresh() only lists
+    directories that are new or changed (e.g. a medium has been inserted), all others cost one stat. Mediums are the
+    directories with a disc id file. With a state file the listing survives between restores of the same source.
+    """
+
+    def __init__(self, source: str, disc_id_filename: str = "disc_id.yml", state_file: str = None):
+        self.source = os.path.abspath(source)
+        self.disc_id_filename = disc_id_filename
+        self.state_file = state_file
+
+        self._directories = dict()
+        """{directory: {"mtime": ns, "disc": disc id or None, "files": [name], "dirs": [name]}}"""
+        self._archives = dict()
+        """Archive ids per extension {ext: {archive id: path}}, built on demand"""
+
+        self._load()
+
+    def refresh(self) -> bool:
+        """Updates the listing, returns True if anything changed."""
+        directories = dict()
+        changed = False
+
+        stack = [self.source]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            entry = self._directories.get(directory)
+            if entry is None or entry["mtime"] != mtime:
+                entry = self._list(directory, mtime)
+                changed = True
+
+            directories[directory] = entry
+            stack.extend(os.path.join(directory, name) for name in entry["dirs"])
+
+        changed = changed or directories.keys() != self._directories.keys()
+        self._directories = directories
+        if changed:
+            self._archives.clear()
+            self._save()
+        return changed
+
+    def archives(self, ext: str) -> {int: str}:
+        """All archives with the extension (without leading dot) {archive id: path}."""
+        if ext not in self._archives:
+            suffix = "." + ext
+            archives = dict()
+            for directory, entry in self._directories.items():
+                for name in entry["files"]:
+                    if name.endswith(suffix):
+                        archive_id, could_parse = try_parse_int(name[:-len(suffix)])
+                        if could_parse:
+                            archives[archive_id] = os.path.join(directory, name)
+            self._archives[ext] = archives
+
+        return self._archives[ext]
+
+    def files(self, ext: str) -> {str: str}:
+        """All files with the extension (without leading dot) {name: path}, e.g. parity archives."""
+        suffix = "." + ext
+        return {name: os.path.join(directory, name) for directory, entry in self._directories.items()
+                for name in entry["files"] if name.endswith(suffix)}
+
+    def mediums(self) -> {int: str}:
+        """Directories of the available mediums {disc id: directory}."""
+        return {entry["disc"]: directory for directory, entry in self._directories.items()
+                if entry["disc"] is not None}
+
+    def _list(self, directory: str, mtime: int) -> dict:
+        files, dirs = list(), list()
+        with os.scandir(directory) as it:
+            for item in it:
+                if item.is_dir():
+                    dirs.append(item.name)
+                elif item.is_file():
+                    files.append(item.name)
+
+        disc = None
+        if self.disc_id_filename in files:
+            try:
+                disc = DiscId.deserialize(os.path.join(directory, self.disc_id_filename)).db_id
+            except Exception as e:
+                logger.warning("Unreadable disc id in <%s>: %s" % (directory, e))
+
+        return {"mtime": mtime, "disc": disc, "files": files, "dirs": dirs}
+
+    def _load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except ValueError as e:
+            logger.warning("Ignoring broken locator state <%s>: %s" % (self.state_file, e))
+            return
+
+        if state.get("source") == self.source:
+            self._directories = state["directories"]
+
+    def _save(self):
+        if self.state_file is None:
+            return
+
+        os.makedirs(os.path.dirname(self.state_file), mode=0o700, exist_ok=True)
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"source": self.source, "directories": self._directories}, f)
+        os.replace(tmp_file, self.state_file)
+
+
+def locator_state_file(directory: str, source: str) -> str:
+    """State file of the source inside of directory (e.g. the index cache directory), None if directory is None."""
+    if directory is None:
+        return None
+    key = hashlib.sha256(os.path.abspath(source).encode('utf-8')).hexdigest()
+    return os.path.join(directory, "locator-%s.json" % key)
@@ -0,0 +1,121 @@
+import errno
+import logging
+import os
+
+from backup.common.logger import configure_logger
+from backup.common.progressbar import ProgressBar
+
+logger = configure_logger(logging.getLogger(__name__))
+
+
+def _default_file_mode() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+_FILE_MODE = _default_file_mode()
+"""Mode of newly created files, read once at import (changing the umask isn't thread safe)."""
+
+
+class ArchivePlacer:
+    """
+    Puts finished archives onto the medium.
+
+    Temporary archives on the same file system as the medium are renamed (no data is copied at all). Otherwise the
+    kernel copies the data (copy_file_range, sendfile) in chunks of buffer_size, with a plain read/write loop as last
+    resort. With fsync the placed archives are not synced one by one, but all together by sync() when the medium is
+    finished.
+    """
+
+    def __init__(self, buffer_size: int = 8 * 1024 * 1024, fsync: bool = False):
+        self.buffer_size = max(1, buffer_size // (1024 * 1024)) * 1024 * 1024  # whole MiB, page aligned
+        self.fsync = fsync
+
+        self._unsynced = list()
+        """Files (and directories) that have been placed but not synced yet"""
+
+    def place(self, src_file: str, dest_file: str, t: ProgressBar, move: bool = False) -> str:
+        """
+        Places src_file at dest_file. With move the source may be consumed (it has to be a temporary file).
+
+        :return: how the archive has been placed: 'rename', 'copy_file_range', 'sendfile' or 'copy'
+        """
+        size = os.stat(src_file).st_size
+        t.total = size
+
+        if move and self._rename(src_file, dest_file):
+            t.update(size)
+            method = 'rename'
+        else:
+            method = self._copy(src_file, dest_file, size, t)
+
+        if self.fsync:
+            self._unsynced.append(dest_file)
+            self._unsynced.append(os.path.dirname(os.path.abspath(dest_file)))
+        return method
+
+    def sync(self):
+        """Flushes all placed archives and their directories to the disk."""
+        for name in dict.fromkeys(self._unsynced):  # unique, in order
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._unsynced.clear()
+
+    def _rename(self, src_file: str, dest_file: str) -> bool:
+        try:
+            os.rename(src_file, dest_file)
+        except OSError as e:
+            if e.errno == errno.EXDEV:  # different file systems
+                return False
+            raise
+
+        os.chmod(dest_file, _FILE_MODE)  # temporary files are only readable by the owner
+        return True
+
+    def _copy(self, src_file: str, dest_file: str, size: int, t: ProgressBar) -> str:
+        with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+            for method, func in (('copy_file_range', getattr(os, 'copy_file_range', None)),
+                                 ('sendfile', getattr(os, 'sendfile', None))):
+                if func is None:
+                    continue
+                try:
+                    self._copy_kernel(func, fsrc.fileno(), fdst.fileno(), size, t)
+                    return method
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                        raise
+                    logger.debug("%s not possible for <%s>: %s" % (method, dest_file, e))
+
+            self._copy_buffered(fsrc, fdst, t)
+            return 'copy'
+
+    def _copy_kernel(self, func, src_fd: int, dest_fd: int, size: int, t: ProgressBar):
+        offset = 0
+        while offset < size:
+            try:
+                if func is os.sendfile:
+                    copied = func(dest_fd, src_fd, offset, min(self.buffer_size, size - offset))
+                else:
+                    copied = func(src_fd, dest_fd, min(self.buffer_size, size - offset), offset, offset)
+            except OSError as e:
+                if offset > 0:  # no fallback after a partial copy
+                    raise IOError("Copy failed after %i of %i bytes: %s" % (offset, size, e)) from e
+                raise
+            if copied == 0:
+                break
+            offset += copied
+            t.update(copied)
+
+    def _copy_buffered(self, fsrc, fdst, t: ProgressBar):
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        while True:
+            read = fsrc.readinto(buf)
+            if not read:
+                return
+            fdst.write(view[:read])
+            t.update(read)
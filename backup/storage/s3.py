@@ -0,0 +1,243 @@
+import logging
+import os
+import tempfile
+
+from backup.common.hookhelper import HookHelper
+from backup.common.logger import configure_logger
+from backup.common.progressbar import create_pg
+from backup.common.util import try_parse_int
+from backup.core.encryptor import GpgEncryptor
+from backup.core.parameters import BackupParameters, GeneralSettings, RestoreParameters
+from backup.db.db import DatabaseManager, BackupDatabaseReader
+from backup.db.disc_id import DiscId
+from backup.db.domain import DiscEntry
+from backup.storage.base import BaseStorageController
+from backup.storage.base import BaseRestoreStorageController, BaseBackupStorageController
+from backup.storage.writer import AsyncArchiveWriter
+
+logger = configure_logger(logging.getLogger(__name__))
+
+NUMBER_TO_FILE_FORMAT = "%010i"
+S3_SCHEME = "s3://"
+
+
+class S3StorageBackupParameters:
+    def __init__(self):
+        self.endpoint_url = None
+        """Endpoint of an S3 compatible store (MinIO, Ceph, ...), None = AWS"""
+        self.region = None
+
+        self.medium_size = 1024 * 1024 * 1024 * 44  # 44 GB
+        """Size of one medium (key prefix), the index shard covers one medium. Can be -1 = unlimited"""
+
+        self.max_concurrency = 8
+        """Parts that are uploaded/downloaded at the same time, also the size of the HTTP connection pool"""
+        self.multipart_threshold = 64 * 1024 * 1024
+        """Archives from this size on are transferred in parts"""
+        self.multipart_chunksize = 16 * 1024 * 1024
+        """Size of one part (ranged GET on download)"""
+
+        self.write_buffers = 1
+        """Archives that can wait for or be in upload while the next one is produced, 0 = upload synchronously"""
+
+
+def parse_s3_url(url: str) -> (str, str):
+    """s3://bucket/some/prefix -> (bucket, 'some/prefix')"""
+    if not url.startswith(S3_SCHEME):
+        raise ValueError("Not an s3 url <%s>" % url)
+
+    bucket, _, prefix = url[len(S3_SCHEME):].partition("/")
+    return bucket, prefix.strip("/")
+
+
+def _create_client(parameters: S3StorageBackupParameters):
+    """Client with a connection pool for all concurrent transfers, and the transfer config that uses them."""
+    try:
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+    except ImportError:
+        raise RuntimeError("The s3 storage needs boto3 (pip install boto3)")
+
+    client = boto3.client('s3', endpoint_url=parameters.endpoint_url, region_name=parameters.region,
+                          config=Config(max_pool_connections=parameters.max_concurrency + 2))
+    transfer = TransferConfig(multipart_threshold=parameters.multipart_threshold,
+                              multipart_chunksize=parameters.multipart_chunksize,
+                              max_concurrency=parameters.max_concurrency, use_threads=True)
+    return client, transfer
+
+
+def _key(prefix: str, *parts) -> str:
+    return "/".join(p for p in (prefix,) + parts if p)
+
+
+class BackupS3StorageController(BaseBackupStorageController):
+    """
+    Uploads the archives directly to an S3 compatible object store, without staging the mediums locally.
+
+    A medium is a key prefix (like a medium directory) with the archives, the disc id file and the index shard of the
+    medium. Archives are uploaded in the background while the next one is produced, large ones as multipart upload
+    with max_concurrency parts at the same time.
+    """
+
+    def __init__(self, parameters: BackupParameters, general_settings: GeneralSettings):
+        super(BackupS3StorageController, self).__init__()
+        self._parameters = parameters
+        self._general_settings = general_settings
+        self._hook_helper = HookHelper(general_settings)
+        self._bucket, self._prefix = parse_s3_url(parameters.destination)
+        self._client, self._transfer = _create_client(parameters.backup_parameters)
+        self._current_medium_size = 0
+        self.medium_prefixes = dict()
+        """Key prefix of every medium of this backup {disc id: prefix}"""
+
+        self._writer = None
+        if parameters.backup_parameters.write_buffers > 0:
+            self._writer = AsyncArchiveWriter(parameters.backup_parameters.write_buffers)
+
+    def next_medium_needed(self) -> bool:
+        bp = self._parameters.backup_parameters
+
+        if bp.medium_size < 0:
+            return True
+        return self._current_medium_size >= bp.medium_size
+
+    def create_next_medium(self, disc_domain: DiscEntry):
+        super(BackupS3StorageController, self).create_next_medium(disc_domain)
+        self.medium_prefixes[disc_domain.id] = _key(self._prefix, NUMBER_TO_FILE_FORMAT % disc_domain.id)
+        self._current_medium_size = 0
+
+    def store_archive(self, archive_package, disc_domain, archive_domain, pressure):
+        super(BackupS3StorageController, self).store_archive(archive_package, disc_domain, archive_domain, pressure)
+        name = NUMBER_TO_FILE_FORMAT % archive_domain.id + "." + archive_package.final_file_extension
+        key = _key(self.medium_prefixes[disc_domain.id], name)
+        self._current_medium_size += os.stat(archive_package.archive_file).st_size
+
+        def write():
+            self._upload(archive_package.archive_file, key)
+            pressure.unregister_pressure(getattr(archive_package, "pending_bytes", 1))
+
+            temp_file = getattr(archive_package, "tempfile", None)
+            if temp_file:
+                temp_file.close()  # empty the temporary directory
+
+        def written():
+            archive_domain.name = name
+            archive_domain.save()
+
+        if self._writer:
+            self._writer.submit(write, written)
+        else:
+            write()
+            written()
+
+    def finish_medium(self, parameters, disc_domain: DiscEntry):
+        super(BackupS3StorageController, self).finish_medium(parameters, disc_domain)
+        if self._writer:
+            self._writer.flush()  # the medium has to be complete before the hooks run
+
+        with tempfile.NamedTemporaryFile() as disc_id_file:
+            DiscId(disc_domain.id).serialize(disc_id_file.name)
+            self._upload(disc_id_file.name,
+                         _key(self.medium_prefixes[disc_domain.id], self._general_settings.index_filename))
+
+        self._hook_helper.execute_hook("finish_medium", [S3_SCHEME + self._bucket + "/" +
+                                                         self.medium_prefixes[disc_domain.id]])
+
+    def finish_backup(self, db: DatabaseManager, params: BackupParameters, encryptor: GpgEncryptor):
+        super(BackupS3StorageController, self).finish_backup(db, params, encryptor)
+        if self._writer:
+            self._writer.close()
+
+        ext = "." + encryptor.extension if encryptor else ""
+        for disc_id, prefix in self.medium_prefixes.items():
+            with tempfile.NamedTemporaryFile() as shard_file:
+                DatabaseManager.create_shard(db.file_name, shard_file.name, [disc_id])
+                if encryptor:
+                    with tempfile.NamedTemporaryFile() as encrypted_file:
+                        encryptor.encrypt_file(shard_file.name, encrypted_file.name)
+                        self._upload(encrypted_file.name, _key(prefix, self._general_settings.database_name + ext))
+                else:
+                    self._upload(shard_file.name, _key(prefix, self._general_settings.database_name))
+
+    def _upload(self, file_name: str, key: str):
+        with create_pg(total=os.stat(file_name).st_size, leave=False, unit='B', unit_scale=True, unit_divisor=1024,
+                       desc='Upload archive') as t:
+            self._client.upload_file(file_name, self._bucket, key, Config=self._transfer, Callback=t.update)
+
+
+class S3RestoreController(BaseRestoreStorageController):
+    """
+    Restores from an S3 compatible object store. The archives are listed once, downloaded one by one (large ones with
+    parallel ranged GETs) and removed locally after they have been restored.
+    """
+
+    def __init__(self, general_settings: GeneralSettings, parameters: RestoreParameters):
+        self._parameters = parameters
+        self._general_settings = general_settings
+        self._bucket, self._prefix = parse_s3_url(parameters.source)
+        self._client, self._transfer = _create_client(parameters.backup_parameters)
+        self._keys = None
+        """All objects below the prefix {name: key}"""
+
+    def available_sources(self, backup_reader: BackupDatabaseReader, restore_files: [str],
+                          ext) -> [str]:
+        if self._keys is None:
+            self._keys = self._list()
+
+        suffix = "." + ext
+        all_files = dict()
+        for name, key in self._keys.items():
+            if name.endswith(suffix):
+                archive_id, could_parse = try_parse_int(name[:-len(suffix)])
+                if could_parse:
+                    all_files[archive_id] = key
+
+        found_files = list()
+        for relative_file in restore_files:
+            file, state, archives, backup = backup_reader.find_coordinates(
+                backup_reader.find_relative_file(relative_file)
+            )
+
+            if all(archive.id in all_files for archive in archives):
+                found_files.append(relative_file)
+            else:
+                logger.debug("Archives of <%s> are not available" % relative_file)
+
+        return found_files, all_files
+
+    def open_archives(self, archive_ids: [int], sources: {int: str}):
+        for archive_id in archive_ids:
+            with tempfile.NamedTemporaryFile() as archive_file:
+                key = sources[archive_id]
+                with create_pg(total=-1, leave=False, unit='B', unit_scale=True, unit_divisor=1024,
+                               desc='Download archive') as t:
+                    self._client.download_file(self._bucket, key, archive_file.name, Config=self._transfer,
+                                               Callback=t.update)
+                yield archive_id, archive_file.name
+
+    def medium_groups(self, archive_ids: [int], sources: {int: str}) -> [[int]]:
+        groups = dict()
+        for archive_id in archive_ids:  # one group per medium prefix
+            groups.setdefault(sources[archive_id].rpartition("/")[0], list()).append(archive_id)
+        return list(groups.values())
+
+    def _list(self) -> {str: str}:
+        keys = dict()
+        paginator = self._client.get_paginator('list_objects_v2')
+        prefix = self._prefix + "/" if self._prefix else ""
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                keys[obj['Key'].rsplit("/", 1)[-1]] = obj['Key']
+        return keys
+
+
+class S3StorageController(BaseStorageController):
+    """S3 compatible object store, every medium is a key prefix."""
+
+    def start_backup(self, params: BackupParameters, general_settings: GeneralSettings) -> BackupS3StorageController:
+        return BackupS3StorageController(params, general_settings)
+
+    def start_restore(self, general_settings: GeneralSettings,
+                      parameters: RestoreParameters) -> BaseRestoreStorageController:
+        return S3RestoreController(general_settings, parameters)
@@ -0,0 +1,300 @@
+import io
+import logging
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+
+import yaml
+
+from backup.common.hookhelper import HookHelper
+from backup.common.logger import configure_logger
+from backup.common.progressbar import create_pg, ProgressBar
+from backup.common.util import try_parse_int
+from backup.core.encryptor import GpgEncryptor
+from backup.core.parameters import BackupParameters, GeneralSettings, RestoreParameters
+from backup.db.db import DatabaseManager, BackupDatabaseReader
+from backup.db.disc_id import DiscId
+from backup.db.domain import DiscEntry, ArchiveDiscMap
+from backup.storage.base import BaseStorageController
+from backup.storage.base import BaseRestoreStorageController, BaseBackupStorageController
+
+logger = configure_logger(logging.getLogger(__name__))
+
+NUMBER_TO_FILE_FORMAT = "%010i"
+STREAM_EXTENSION = "tar"
+CATALOG_NAME = "catalog.yml"
+
+
+class StreamStorageBackupParameters:
+    def __init__(self):
+        self.medium_size = 1024 * 1024 * 1024 * 1024 * 6  # 6 TB (LTO-7)
+        """Size of one stream/tape. Can be -1 = unlimited"""
+
+        self.slack_size = 1024 * 1024 * 100  # 100 MB
+        """The amount of space that is always left empty in each single medium"""
+
+        self.block_size = 1024 * 1024
+        """The stream is written and read in blocks of this size"""
+
+
+def _stream_name(destination: str, disc_domain: DiscEntry) -> str:
+    """
+    A directory holds one stream file per medium, a (tape) device is reused for every medium. Anything else (e.g. a
+    regular file) is the stream of a single medium.
+    """
+    if os.path.isdir(destination):
+        return os.path.join(destination, (NUMBER_TO_FILE_FORMAT % disc_domain.id) + "." + STREAM_EXTENSION)
+    return destination
+
+
+def _is_device(name: str) -> bool:
+    try:
+        mode = os.stat(name).st_mode
+    except OSError:
+        return False
+    return stat.S_ISCHR(mode) or stat.S_ISBLK(mode)
+
+
+class _ProgressReader(io.RawIOBase):
+    """Reports the bytes that are read from the wrapped file."""
+
+    def __init__(self, f, t: ProgressBar):
+        self._f = f
+        self._t = t
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._t.update(len(data))
+        return data
+
+
+class BackupStreamStorageController(BaseBackupStorageController):
+    """
+    Writes all archives of a medium as one sequential stream, which can be a file or a (tape) device.
+
+    The stream is a plain tar stream, so it can be restored by hand: the disc id file as header, the archives in the
+    order they have been stored and a catalog of all archives (id, name, size) as last member. Nothing is ever read
+    back or seeked.
+    """
+
+    def __init__(self, parameters: BackupParameters, general_settings: GeneralSettings):
+        super(BackupStreamStorageController, self).__init__()
+        self._parameters = parameters
+        self._general_settings = general_settings
+        self._hook_helper = HookHelper(general_settings)
+        self._current_medium_size = 0
+        self._stream = None
+        self._catalog = None
+        self.stream_names = dict()
+        """Stream of every medium of this backup {disc id: stream name}"""
+
+    def next_medium_needed(self) -> bool:
+        bp = self._parameters.backup_parameters
+
+        if bp.medium_size < 0:
+            return True
+        return self._current_medium_size + bp.slack_size >= bp.medium_size
+
+    def create_next_medium(self, disc_domain: DiscEntry):
+        super(BackupStreamStorageController, self).create_next_medium(disc_domain)
+        name = _stream_name(self._parameters.destination, disc_domain)
+        if name in self.stream_names.values() and not _is_device(name):  # would overwrite the previous medium
+            raise ValueError("<%s> holds a single medium, use a directory or a device for more than one medium (or a "
+                             "larger medium size)" % name)
+        self.stream_names[disc_domain.id] = name
+
+        self._stream = tarfile.open(name, 'w|', bufsize=self._parameters.backup_parameters.block_size,
+                                    format=tarfile.PAX_FORMAT)
+        self._catalog = list()
+        self._current_medium_size = 0
+
+        with tempfile.NamedTemporaryFile() as header:  # header of the stream
+            DiscId(disc_domain.id).serialize(header.name)
+            self._add(header.name, self._general_settings.index_filename)
+
+    def store_archive(self, archive_package, disc_domain, archive_domain, pressure):
+        super(BackupStreamStorageController, self).store_archive(archive_package, disc_domain, archive_domain,
+                                                                 pressure)
+        name = NUMBER_TO_FILE_FORMAT % archive_domain.id + "." + archive_package.final_file_extension
+        size = self._add(archive_package.archive_file, name)
+        pressure.unregister_pressure(getattr(archive_package, "pending_bytes", 1))
+
+        temp_file = getattr(archive_package, "tempfile", None)
+        if temp_file:
+            temp_file.close()  # empty the temporary directory
+
+        self._catalog.append({"id": archive_domain.id, "name": name, "size": size})
+        archive_domain.name = name
+        archive_domain.save()
+
+    def finish_medium(self, parameters, disc_domain: DiscEntry):
+        super(BackupStreamStorageController, self).finish_medium(parameters, disc_domain)
+
+        catalog = yaml.safe_dump({"disc": disc_domain.id, "archives": self._catalog}).encode('utf-8')
+        info = tarfile.TarInfo(CATALOG_NAME)
+        info.size = len(catalog)
+        info.mtime = time.time()
+        info.mode = 0o644
+        self._stream.addfile(info, io.BytesIO(catalog))
+        self._stream.close()
+        self._stream = None
+
+        self._hook_helper.execute_hook("finish_medium", [self.stream_names[disc_domain.id]])
+
+    def finish_backup(self, db: DatabaseManager, params: BackupParameters, encryptor: GpgEncryptor):
+        super(BackupStreamStorageController, self).finish_backup(db, params, encryptor)
+        if not os.path.isdir(params.destination):
+            return  # the index of a device stays at the index location
+
+        # index shards next to the stream files
+        ext = "." + encryptor.extension if encryptor else ""
+        for disc_id, stream_name in self.stream_names.items():
+            shard_name = stream_name[:-len(STREAM_EXTENSION) - 1] + ".sqlite" + ext
+            with tempfile.NamedTemporaryFile() as shard_file:
+                DatabaseManager.create_shard(db.file_name, shard_file.name, [disc_id])
+                if encryptor:
+                    encryptor.encrypt_file(shard_file.name, shard_name)
+                else:
+                    shutil.copyfile(shard_file.name, shard_name)
+
+    def _add(self, src_file: str, name: str) -> int:
+        info = self._stream.gettarinfo(src_file, arcname=name)
+        info.mode = 0o644
+        with create_pg(total=info.size, leave=False, unit='B', unit_scale=True, unit_divisor=1024,
+                       desc='Write archive to stream') as t:
+            with open(src_file, 'rb') as f:
+                self._stream.addfile(info, _ProgressReader(f, t))
+
+        self._current_medium_size += info.size + tarfile.BLOCKSIZE
+        return info.size
+
+
+class StreamRestoreController(BaseRestoreStorageController):
+    """
+    Restores from streams written by BackupStreamStorageController in a single forward pass per stream.
+
+    The source is a directory with stream files or a single stream (device). Only the header of every stream is read
+    to find out which medium it is, the archives that are on it are known from the index. The needed archives are
+    then extracted one by one in stream order. A stream stays open and positioned between the restore iterations
+    until it was read to its end, so a (non-rewinding) device is never opened again for the same medium.
+    """
+
+    def __init__(self, general_settings: GeneralSettings, parameters: RestoreParameters):
+        self._parameters = parameters
+        self._general_settings = general_settings
+        self._streams = dict()
+        """Opened streams, positioned after the header {stream name: (tarfile, disc id)}"""
+
+    def available_sources(self, backup_reader: BackupDatabaseReader, restore_files: [str],
+                          ext) -> [str]:
+        self._open_streams()
+
+        all_files = dict()
+        for name, (stream, disc_id) in self._streams.items():
+            for archive_copy in ArchiveDiscMap.select(ArchiveDiscMap.archive).where(ArchiveDiscMap.disc == disc_id):
+                all_files[archive_copy.archive_id] = name
+
+        found_files = list()
+        for relative_file in restore_files:
+            file, state, archives, backup = backup_reader.find_coordinates(
+                backup_reader.find_relative_file(relative_file)
+            )
+
+            if all(archive.id in all_files for archive in archives):
+                found_files.append(relative_file)
+            else:
+                logger.debug("Archives of <%s> are not available" % relative_file)
+
+        return found_files, all_files
+
+    def open_archives(self, archive_ids: [int], sources: {int: str}):
+        needed = dict()
+        for archive_id in archive_ids:
+            needed.setdefault(sources[archive_id], set()).add(archive_id)
+
+        try:
+            for name, (stream, disc_id) in list(self._streams.items()):
+                if name in needed and (yield from self._read_stream(stream, needed[name])):
+                    del self._streams[name]  # read to its end, the next medium can be inserted
+                    stream.close()
+        except BaseException:
+            self._close_streams()  # the position in the streams is unknown
+            raise
+
+    def _read_stream(self, stream: tarfile.TarFile, archive_ids: set) -> bool:
+        """Yields the archives in stream order, returns True if the stream was read to its end."""
+        for member in stream:
+            archive_id, could_parse = try_parse_int(member.name.split(".", 1)[0])
+            if not could_parse or archive_id not in archive_ids:
+                continue  # tar streams skip forward over the content
+
+            with tempfile.NamedTemporaryFile() as archive_file:
+                with create_pg(total=member.size, leave=False, unit='B', unit_scale=True, unit_divisor=1024,
+                               desc='Read archive from stream') as t:
+                    with open(archive_file.name, 'wb') as f:
+                        shutil.copyfileobj(_ProgressReader(stream.extractfile(member), t), f,
+                                           self._block_size())
+                yield archive_id, archive_file.name
+
+            archive_ids.remove(archive_id)
+            if len(archive_ids) == 0:
+                return False  # no need to read the rest of the stream
+        return True
+
+    def _open_streams(self):
+        """Opens the streams of the source that aren't open yet, open streams keep their position."""
+        source = self._parameters.source
+        names = [source]
+        if os.path.isdir(source):
+            names = sorted(os.path.join(source, name) for name in os.listdir(source)
+                           if name.endswith("." + STREAM_EXTENSION))
+
+        for name in [name for name in self._streams if name not in names]:  # removed from the directory
+            self._streams.pop(name)[0].close()
+
+        for name in names:
+            if name in self._streams:
+                continue
+
+            stream = tarfile.open(name, 'r|', bufsize=self._block_size())
+            header = stream.next()
+            if header is None or header.name != self._general_settings.index_filename:
+                logger.warning("<%s> is not a backup stream" % name)
+                stream.close()
+                continue
+
+            with tempfile.NamedTemporaryFile() as disc_id_file:
+                with open(disc_id_file.name, 'wb') as f:
+                    shutil.copyfileobj(stream.extractfile(header), f)
+                disc_id = DiscId.deserialize(disc_id_file.name).db_id
+            self._streams[name] = (stream, disc_id)
+
+    def close(self):
+        self._close_streams()
+
+    def _close_streams(self):
+        for stream, disc_id in self._streams.values():
+            stream.close()
+        self._streams.clear()
+
+    def _block_size(self) -> int:
+        bp = getattr(self._parameters, 'backup_parameters', None)
+        return getattr(bp, 'block_size', StreamStorageBackupParameters().block_size)
+
+
+class StreamStorageController(BaseStorageController):
+    """Sequential medium (tape), every medium is one stream."""
+
+    def start_backup(self, params: BackupParameters,
+                     general_settings: GeneralSettings) -> BackupStreamStorageController:
+        return BackupStreamStorageController(params, general_settings)
+
+    def start_restore(self, general_settings: GeneralSettings,
+                      parameters: RestoreParameters) -> BaseRestoreStorageController:
+        return StreamRestoreController(general_settings, parameters)
@@ -0,0 +1,97 @@
+import logging
+import queue
+import threading
+
+from backup.common.logger import configure_logger
+
+logger = configure_logger(logging.getLogger(__name__))
+
+
+class AsyncArchiveWriter:
+    """
+    Writes finished archives to the medium in a background thread, while the next archive is produced.
+
+    At most buffers archives are submitted but not yet written, submit blocks if all buffers are in use (buffers=1 is
+    classic double buffering: one archive is written while the next one is produced). The completion callbacks are
+    executed on the thread calling submit, process_completed or flush, because the database connection (and
+    transaction) belongs to that thread.
+    """
+
+    def __init__(self, buffers: int = 1):
+        self._slots = threading.Semaphore(max(1, buffers))
+        self._jobs = queue.Queue()
+        self._completed = queue.Queue()
+        self._pending = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="archive-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, write_func, on_complete=None):
+        """Queue write_func for the background thread, on_complete is called on this thread after it succeeded."""
+        self._check_error()
+        while not self._slots.acquire(timeout=0.1):
+            self.process_completed()
+
+        self._pending += 1
+        self._jobs.put((write_func, on_complete))
+        self.process_completed()
+
+    def process_completed(self):
+        """Executes the callbacks of all completed writes. Raises the error of a failed write."""
+        while True:
+            try:
+                on_complete = self._completed.get_nowait()
+            except queue.Empty:
+                break
+
+            self._pending -= 1
+            if on_complete:
+                on_complete()
+
+        self._check_error()
+
+    def flush(self):
+        """Waits until all submitted archives are written and their callbacks are executed."""
+        while self._pending > 0:
+            self._check_error()
+            try:
+                on_complete = self._completed.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            self._pending -= 1
+            if on_complete:
+                on_complete()
+
+        self._check_error()
+
+    def close(self):
+        """Flushes and stops the background thread."""
+        try:
+            self.flush()
+        finally:
+            self._jobs.put(None)
+            self._thread.join()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            write_func, on_complete = job
+            if self._error is None:  # after the first error everything else is skipped
+                try:
+                    write_func()
+                except BaseException as e:
+                    logger.error("Writing archive failed: %s" % e)
+                    self._error = e
+
+            self._slots.release()
+            if self._error is None:
+                self._completed.put(on_complete)
@@ -4,9 +4,9 @@ set -xe
 
 DOCKER=docker
 
-cp requirements.txt cicd/requirements.txt
+cp requirements.txt requirements-test.txt cicd/
 ${DOCKER} build cicd -f cicd/Dockerfile_python --tag pybutcherbackup-python
-rm cicd/requirements.txt
+rm cicd/requirements.txt cicd/requirements-test.txt
 
 ${DOCKER} run --rm --name pybutcherbackup-python -v "$PWD":/usr/src/myapp -w /usr/src/myapp pybutcherbackup-python  "./cicd/run_coverage_docker.sh"
 
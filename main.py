@@ -1,18 +1,28 @@
+import contextlib
+import json
 import logging
 import os
+import shutil
+import sys
 
 import tempfile
 import re
 
 import click
 
-from backup.core.parameters import GeneralSettings, BackupParameters, RestoreParameters
+from backup.core.parameters import GeneralSettings, BackupParameters, RestoreParameters, VerifyParameters, \
+    DEFAULT_DATABASE_FILENAME
 from backup.core.basecontroller import BackupController
 from backup.core.basecontroller import RestoreController
+from backup.core.verify import VerifyController, month_round, STATUS_DAMAGED, STATUS_MISSING
 from backup.core.encryptor import GpgEncryptor
 from backup.common.logger import configure_logger
+from backup.db.cache import IndexCache, DEFAULT_INDEX_CACHE_DIRECTORY
 from backup.db.db import DatabaseManager
 from backup.storage.directory import DirectoryStorageBackupParameters
+from backup.storage.iso import IsoStorageBackupParameters
+from backup.storage.s3 import S3StorageBackupParameters, S3_SCHEME
+from backup.storage.stream import StreamStorageBackupParameters
 
 from backup.terminal.table import Table, TableColumn
 from backup.common.progressbar import set_pg_type
@@ -37,31 +47,94 @@ def cli_restore():
 
 @cli_backup.command('backup')
 @click.argument('src', type=click.Path(exists=True))
-@click.argument('dest', type=click.Path(exists=True))
-@click.option("--index", help='Path to the index to use.', default=None)
+@click.argument('dest', nargs=-1, required=True)
+@click.option("--index", help='Path to the index to use, relative paths are inside of the first destination.',
+              default=None)
 @click.option("--passphrase", help='Passphrase to use on the backup', default=None)
 @click.option("--threading/--no-threading", help='Use threading if specified, no threading is default '
                                                  'but will change in the future. '
                                                  'Currently threading is *experimental*.', default=False)
+@click.option("--processes/--no-processes", help='Compress and encrypt in worker processes instead of threads '
+                                                   '(needs --threading).', default=False)
+@click.option("--threads", help='Number of workers per stage, default is the number of available CPUs.', type=int,
+              default=None)
+@click.option("--autotune/--no-autotune", help='Adjust the workers per stage during the backup (needs --threading). '
+                                               'The final configuration is logged.', default=False)
+@click.option("--scratch-dir", help='Directory for temporary files, can be given multiple times. With '
+                                    '--scratch-small-size the first one is used for small files only.', multiple=True)
+@click.option("--scratch-budget", help='Maximum temporary space in MB, producers wait if it is used up.', type=int,
+              default=None)
+@click.option("--scratch-small-size", help='Temporary files up to this size in MB go to the first scratch directory.',
+              type=int, default=None)
+@click.option("--lazy-index/--no-lazy-index", help='Query the index per directory instead of loading it into memory '
+                                                 '(for very large indexes).', default=False)
+@click.option("--index-cache", help='Directory that keeps decrypted indexes between commands (readable only by the '
+                                      'owner, can be a tmpfs).', default=DEFAULT_INDEX_CACHE_DIRECTORY)
+@click.option("--no-index-cache", help='Decrypt the index on every command, nothing is kept on disk.', is_flag=True)
 @click.option("--name", help="User name for that backup repository", default=None)
 @click.option("--terminal", help="Switch the progress type between SIMPLE, SILENT and TQDM", default="tqdm")
 @click.option("--dir-medium-size", help="Maximum size of a medium directory in GB", type=int, default=44)
+@click.option("--stream-medium-size", help="Maximum size of a stream medium (tape) in GB", type=int, default=6000)
+@click.option("--stream-block-size", help="Block size of a stream medium in KB", type=int, default=1024)
+@click.option("--bluray-medium-size", help="Maximum size of a Blu-ray image in MB (default single layer BD-R)",
+              type=int, default=23866)
+@click.option("--s3-endpoint", help="Endpoint URL of an S3 compatible store (default AWS)", default=None)
+@click.option("--s3-concurrency", help="Parallel part uploads/downloads for s3://", type=int, default=8)
+@click.option("--s3-part-size", help="Part size of multipart uploads and ranged downloads in MB", type=int, default=16)
+@click.option("--dir-fsync/--no-dir-fsync", help="Sync the archives of a medium directory to the disk when it is "
+                                                  "finished.", default=False)
+@click.option("--dir-full-index/--dir-index-shard", help="Copy the whole index to every medium directory instead of "
+                                                          "the index shard of the medium.", default=False)
+@click.option("--dir-parity", help="Reed-Solomon parity archives per parity group of a medium directory, that many "
+                                   "damaged archives of the group can be repaired (0 = none).", type=int, default=0)
+@click.option("--dir-parity-group", help="Archives per parity group.", type=int, default=16)
 @click.option("--dummy", help="Internal Helper - do not use", type=bool, default=False)
-def action_backup(src: str, dest: str, index: str, passphrase: str, threading: bool, name: str, terminal: str,
-                  dir_medium_size: int, dummy: bool):
+def action_backup(src: str, dest: [str], index: str, passphrase: str, threading: bool, processes: bool, threads: int,
+                  autotune: bool, scratch_dir: [str], scratch_budget: int, scratch_small_size: int, lazy_index: bool,
+                  index_cache: str, no_index_cache: bool, name: str, terminal: str, dir_medium_size: int,
+                  stream_medium_size: int, stream_block_size: int, bluray_medium_size: int, s3_endpoint: str,
+                  s3_concurrency: int, s3_part_size: int, dir_fsync: bool, dir_full_index: bool, dir_parity: int,
+                  dir_parity_group: int, dummy: bool):
     bp = BackupParameters()
     bp.source = src
     bp.encryption_key = passphrase
     bp.use_threading = threading
+    bp.use_processes = processes
+    bp.autotune = autotune
+    if threads:
+        bp.threads = threads
+    bp.scratch_directories = list(scratch_dir) or None
+    if scratch_budget:
+        bp.scratch_budget = scratch_budget * 1024 * 1024
+    if scratch_small_size is not None:
+        bp.scratch_small_file_size = scratch_small_size * 1024 * 1024
+    bp.lazy_index = lazy_index
     bp.backup_name = name
 
-    if str(dest).startswith('dir://'):
-        dest = dest[len('dir://'):]
-        dp = DirectoryStorageBackupParameters()
-        dp.medium_size = dir_medium_size * 1024 * 1024 * 1024
-        bp.backup_parameters = dp
+    destinations = list()
+    for destination in dest:
+        destination, backup_parameters = _backup_destination(
+            destination, dir_medium_size, dir_fsync, dir_full_index, dir_parity, dir_parity_group, stream_medium_size,
+            stream_block_size, bluray_medium_size, s3_endpoint, s3_concurrency, s3_part_size
+        )
+        if not isinstance(backup_parameters, S3StorageBackupParameters) and not os.path.exists(destination):
+            print("Destination not found <%s>" % destination)
+            return
+        destinations.append((destination, backup_parameters))
+
+    if isinstance(destinations[0][1], S3StorageBackupParameters):
+        if not index:
+            print("An s3:// destination needs a local --index")
+            return
+        index = os.path.abspath(index)
+    elif isinstance(destinations[0][1], StreamStorageBackupParameters) and not os.path.isdir(destinations[0][0]):
+        if not index:
+            print("A stream:// destination that isn't a directory (e.g. a tape device) needs --index")
+            return
+        index = os.path.abspath(index)
 
-    bp.destination = dest
+    bp.destination, bp.backup_parameters = destinations[0]
+    bp.additional_destinations = destinations[1:]
 
     if index:
         bp.database_location = index  # TODO path should be relative to source?
@@ -70,35 +143,37 @@ def action_backup(src: str, dest: str, index: str, passphrase: str, threading: b
 
     g = GeneralSettings()
     g.dummy = dummy
+    g.index_cache_directory = None if no_index_cache else index_cache
     bc = BackupController(g)
     bc.execute(bp)
 
 
 @cli_base.command('list-files')
 @click.option("--passphrase", help='Passphrase to use on the backup', default=None)
+@click.option("--lazy-index/--no-lazy-index", help='Query the index per directory instead of loading it into memory '
+                                                 '(for very large indexes).', default=False)
+@click.option("--index-cache", help='Directory that keeps decrypted indexes between commands (readable only by the '
+                                      'owner, can be a tmpfs).', default=DEFAULT_INDEX_CACHE_DIRECTORY)
+@click.option("--no-index-cache", help='Decrypt the index on every command, nothing is kept on disk.', is_flag=True)
 @click.argument("index")
-def action_list_files(passphrase: str, index: str):
+def action_list_files(passphrase: str, lazy_index: bool, index_cache: str, no_index_cache: bool, index: str):
     if not os.path.exists(index):
         print("Database not found <%s>" % index)
         return
 
-    index_file = index
-    if passphrase:
-        e = GpgEncryptor(passphrase)
-        index_file = tempfile.NamedTemporaryFile().name
-        e.decrypt_file(index, index_file)
-        print(index_file)
+    with _decrypted_index(index, passphrase, None if no_index_cache else index_cache) as index_file:
+        _list_files(index_file, lazy_index)
 
-    db = DatabaseManager(index_file)
-    reader = db.read_backup(None)
+
+def _list_files(index_file: str, lazy_index: bool):
+    db = DatabaseManager(index_file, read_only=True)
+    reader = db.read_backup(None, lazy_index)
 
     af = reader.all_files
-    af_keys = af.keys()
-    sorted_af_keys = sorted(af_keys)
+    items = af.items() if lazy_index else sorted(af.items())  # the lazy reader iterates sorted
 
     table_data = list()
-    for original_file in sorted_af_keys:
-        file_entry = af[original_file]
+    for original_file, file_entry in items:
         table_data.append([
             file_entry.relative_file,
             file_entry.size,
@@ -115,17 +190,88 @@ def action_list_files(passphrase: str, index: str):
             TableColumn('SHA')
         ]
     ).print()
+    db.close_database()
+
+
+@cli_base.command('rebuild-index')
+@click.option("--passphrase", help='Passphrase to use on the backup', default=None)
+@click.option("--index-cache", help='Directory that keeps decrypted indexes between commands (readable only by the '
+                                      'owner, can be a tmpfs).', default=DEFAULT_INDEX_CACHE_DIRECTORY)
+@click.option("--no-index-cache", help='Decrypt the index on every command, nothing is kept on disk.', is_flag=True)
+@click.argument("index")
+def action_rebuild_index(passphrase: str, index_cache: str, no_index_cache: bool, index: str):
+    """Recreates the current state of the index from the backup history."""
+    if not os.path.exists(index):
+        print("Database not found <%s>" % index)
+        return
+
+    if not passphrase:
+        _rebuild_index(index)
+        return
+
+    e = GpgEncryptor(passphrase)
+    cache = None if no_index_cache else IndexCache(index_cache)
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        if cache:
+            shutil.copyfile(cache.decrypted(index, e), tmp_file.name)
+        else:
+            e.decrypt_file(index, tmp_file.name)
+
+        _rebuild_index(tmp_file.name)
+        tmp_index = index + ".tmp"
+        e.encrypt_file(tmp_file.name, tmp_index)
+        os.replace(tmp_index, index)  # the old index stays intact if the encryption fails
+        if cache:  # the cache entry belongs to the new encrypted index
+            cache.store(index, e, tmp_file.name)
+
+
+def _rebuild_index(index_file: str):
+    db = DatabaseManager(index_file)
+    with db.transaction():
+        db.rebuild_current_state()
+    db.close_database()
+
+
+@contextlib.contextmanager
+def _decrypted_index(index: str, passphrase: str, index_cache: str):
+    """Yields the location of the decrypted index, a temporary copy is removed afterwards."""
+    if not passphrase:
+        yield index
+        return
+
+    e = GpgEncryptor(passphrase)
+    if index_cache:
+        yield IndexCache(index_cache).decrypted(index, e)
+        return
+
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        e.decrypt_file(index, tmp_file.name)
+        yield tmp_file.name
 
 
 @cli_restore.command('restore')
-@click.argument('src', type=click.Path(exists=True))
+@click.argument('src')
 @click.argument('dest', type=click.Path(exists=True))
 @click.option("--index", help='Path to the index to use.', default=None)
 @click.option("--passphrase", help='Passphrase to use on the backup', default=None)
 @click.option("--filter", help='Regex to filter the restored filepath/name for. Use quotes to escape the string.',
               default=".*")
+@click.option("--lazy-index/--no-lazy-index", help='Query the index per directory instead of loading it into memory '
+                                                 '(for very large indexes).', default=False)
+@click.option("--index-cache", help='Directory that keeps decrypted indexes between commands (readable only by the '
+                                      'owner, can be a tmpfs).', default=DEFAULT_INDEX_CACHE_DIRECTORY)
+@click.option("--no-index-cache", help='Decrypt the index on every command, nothing is kept on disk.', is_flag=True)
+@click.option("--skip-unavailable", help='Skip files whose archives are not available, e.g. to restore a single '
+                                         'medium with its index.', is_flag=True)
+@click.option("--verify/--no-verify", help='Check size and checksum of every archive before it is decrypted. '
+                                           '--no-verify tries to restore from damaged archives.', default=True)
+@click.option("--s3-endpoint", help="Endpoint URL of an S3 compatible store (default AWS)", default=None)
+@click.option("--s3-concurrency", help="Parallel ranged downloads for s3://", type=int, default=8)
+@click.option("--s3-part-size", help="Part size of ranged downloads in MB", type=int, default=16)
 @click.option("--terminal", help="Switch the progress type between SIMPLE, SILENT and TQDM", default="TQDM")
-def action_restore(src: str, dest: str, index: str, passphrase: str, filter: str, terminal: str):
+def action_restore(src: str, dest: str, index: str, passphrase: str, filter: str, lazy_index: bool, index_cache: str,
+                   no_index_cache: bool, skip_unavailable: bool, verify: bool, s3_endpoint: str, s3_concurrency: int,
+                   s3_part_size: int, terminal: str):
     # input validation
     if filter:
         regex = re.compile(filter)  # if this fails, regex is incorrect
@@ -135,19 +281,147 @@ def action_restore(src: str, dest: str, index: str, passphrase: str, filter: str
 
     # dummy restore code
     rp = RestoreParameters()
+    src, rp.backup_parameters = _restore_source(src, s3_endpoint, s3_concurrency, s3_part_size)
+    if src is None:
+        return
     rp.source = src
     rp.destination = dest
     rp.encryption_key = passphrase
     rp.restore_glob = filter
+    rp.lazy_index = lazy_index
+    rp.skip_unavailable = skip_unavailable
+    rp.verify_archives = verify
     if index:
         rp.database_location = index
 
     set_pg_type(terminal)
 
-    rc = RestoreController(GeneralSettings())
+    g = GeneralSettings()
+    g.index_cache_directory = None if no_index_cache else index_cache
+    rc = RestoreController(g)
     rc.execute(rp)
 
 
+@cli_restore.command('verify')
+@click.argument('src')
+@click.option("--index", help='Path to the index to use (default: index.sqlite in the source directory).',
+              default=None)
+@click.option("--passphrase", help='Passphrase to use on the backup', default=None)
+@click.option("--deep", help='Also decrypt and decompress every archive and compare every file with its sha sum.',
+              is_flag=True)
+@click.option("--sample", help='Percentage of the archives to verify, e.g. 5 = 5%.', type=float, default=100)
+@click.option("--sample-round", help='Which sample is verified, every round verifies other archives until all are '
+                                     'verified (default: the current month).', type=int, default=None)
+@click.option("--parallel", help='Mediums that are read at the same time.', type=int, default=4)
+@click.option("--report", help='Write a JSON report to this file ("-" = stdout).', default=None)
+@click.option("--index-cache", help='Directory that keeps decrypted indexes between commands (readable only by the '
+                                      'owner, can be a tmpfs).', default=DEFAULT_INDEX_CACHE_DIRECTORY)
+@click.option("--no-index-cache", help='Decrypt the index on every command, nothing is kept on disk.', is_flag=True)
+@click.option("--skip-unavailable", help='Only verify the archives that are available, e.g. a single medium.',
+              is_flag=True)
+@click.option("--s3-endpoint", help="Endpoint URL of an S3 compatible store (default AWS)", default=None)
+@click.option("--s3-concurrency", help="Parallel ranged downloads for s3://", type=int, default=8)
+@click.option("--s3-part-size", help="Part size of ranged downloads in MB", type=int, default=16)
+@click.option("--terminal", help="Switch the progress type between SIMPLE, SILENT and TQDM", default="TQDM")
+def action_verify(src: str, index: str, passphrase: str, deep: bool, sample: float, sample_round: int, parallel: int,
+                  report: str, index_cache: str, no_index_cache: bool, skip_unavailable: bool, s3_endpoint: str,
+                  s3_concurrency: int, s3_part_size: int, terminal: str):
+    vp = VerifyParameters()
+    src, vp.backup_parameters = _restore_source(src, s3_endpoint, s3_concurrency, s3_part_size)
+    if src is None:
+        return
+    vp.source = src
+    vp.encryption_key = passphrase
+    vp.deep = deep
+    vp.sample = sample / 100
+    vp.sample_round = month_round() if sample_round is None else sample_round
+    vp.parallel_mediums = parallel
+    vp.skip_unavailable = skip_unavailable
+    if report and report != "-":
+        vp.report_file = report
+    if not index and not os.path.isdir(src):
+        print("Verifying <%s> needs --index, only a backup directory has the index next to its mediums" % src)
+        return
+    vp.database_location = os.path.abspath(index) if index else os.path.join(src, DEFAULT_DATABASE_FILENAME)
+    if not os.path.exists(vp.database_location):
+        print("Database not found <%s>" % vp.database_location)
+        return
+
+    set_pg_type(terminal)
+
+    g = GeneralSettings()
+    g.index_cache_directory = None if no_index_cache else index_cache
+    result = VerifyController(g).execute(vp)
+
+    if report == "-":
+        print(json.dumps(result, indent=2))
+    else:
+        for archive in result["results"]:
+            if archive["status"] in (STATUS_DAMAGED, STATUS_MISSING):
+                print("%s: %s %s" % (archive["status"], archive["name"], archive.get("error", "")))
+        print("Verified %i of %i archives in %.1fs: %s" % (
+            result["verified"], result["archives"], result["seconds"],
+            ", ".join("%i %s" % (count, status) for status, count in result["summary"].items())))
+
+    if result["summary"][STATUS_DAMAGED] > 0 or result["summary"][STATUS_MISSING] > 0:
+        sys.exit(1)
+
+
+def _restore_source(src: str, s3_endpoint: str, s3_concurrency: int, s3_part_size: int):
+    """Source without scheme and the storage parameters for it, (None, None) if the source doesn't exist."""
+    backup_parameters = None
+    if str(src).startswith('stream://'):
+        src = src[len('stream://'):]
+        backup_parameters = StreamStorageBackupParameters()
+    elif str(src).startswith('bluray://'):
+        src = src[len('bluray://'):]
+        backup_parameters = IsoStorageBackupParameters()
+    elif str(src).startswith(S3_SCHEME):
+        backup_parameters = _s3_parameters(s3_endpoint, s3_concurrency, s3_part_size)
+    if not isinstance(backup_parameters, S3StorageBackupParameters) and not os.path.exists(src):
+        print("Source not found <%s>" % src)
+        return None, None
+    return src, backup_parameters
+
+
+def _backup_destination(dest: str, dir_medium_size: int, dir_fsync: bool, dir_full_index: bool, dir_parity: int,
+                        dir_parity_group: int, stream_medium_size: int, stream_block_size: int,
+                        bluray_medium_size: int, s3_endpoint: str, s3_concurrency: int, s3_part_size: int):
+    """(destination, storage parameters) of a backup destination argument"""
+    if dest.startswith('dir://'):
+        dp = DirectoryStorageBackupParameters()
+        dp.medium_size = dir_medium_size * 1024 * 1024 * 1024
+        dp.fsync = dir_fsync
+        dp.full_index_on_medium = dir_full_index
+        dp.parity_archives = dir_parity
+        dp.parity_group_size = dir_parity_group
+        return dest[len('dir://'):], dp
+    if dest.startswith('stream://'):
+        sp = StreamStorageBackupParameters()
+        sp.medium_size = stream_medium_size * 1024 * 1024 * 1024
+        sp.block_size = stream_block_size * 1024
+        return dest[len('stream://'):], sp
+    if dest.startswith('bluray://'):
+        ip = IsoStorageBackupParameters()
+        ip.medium_size = bluray_medium_size * 1024 * 1024
+        return dest[len('bluray://'):], ip
+    if dest.startswith(S3_SCHEME):
+        return dest, _s3_parameters(s3_endpoint, s3_concurrency, s3_part_size, dir_medium_size)
+    return dest, None
+
+
+def _s3_parameters(endpoint: str, concurrency: int, part_size: int, medium_size: int = None) \
+        -> S3StorageBackupParameters:
+    sp = S3StorageBackupParameters()
+    sp.endpoint_url = endpoint
+    sp.max_concurrency = concurrency
+    sp.multipart_chunksize = part_size * 1024 * 1024
+    sp.multipart_threshold = 4 * sp.multipart_chunksize
+    if medium_size:
+        sp.medium_size = medium_size * 1024 * 1024 * 1024
+    return sp
+
+
 cli = click.CommandCollection(sources=[cli_base, cli_backup, cli_restore])
 
 # backup "/Volumes/right-hemi/butch_src/" "/Volumes/right-hemi/butch_dest/" asdfasdf
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import threading
+from unittest import main
+
+from backup.common.scratch import ScratchSpace
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestScratchSpace(CustomTestCase):
+    def test_create_and_close(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scratch = ScratchSpace([directory])
+            f = scratch.create_file()
+            assert os.path.dirname(os.path.dirname(f.name)) == directory
+            assert os.path.exists(f.name)
+
+            f.close()
+            assert not os.path.exists(f.name or "")
+            f.close()  # closing twice is fine
+
+            scratch.close()
+            assert os.listdir(directory) == []
+
+    def test_close_removes_leftovers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scratch = ScratchSpace([directory])
+            names = [scratch.create_file().name for _ in range(3)]
+
+            scratch.close()
+            for name in names:
+                assert not os.path.exists(name)
+            assert os.listdir(directory) == []
+
+    def test_small_files_directory(self):
+        with tempfile.TemporaryDirectory() as small, tempfile.TemporaryDirectory() as large:
+            scratch = ScratchSpace([small, large], small_file_size=100)
+
+            with scratch.create_file(10) as f:
+                assert f.name.startswith(small + os.sep)
+            with scratch.create_file(1000) as f:
+                assert f.name.startswith(large + os.sep)
+
+            scratch.close()
+
+    def test_budget_blocks(self):
+        scratch = ScratchSpace(budget=100)
+        assert scratch.register_pressure(80)
+        assert not scratch.register_pressure(30, timeout=0.1)
+
+        t = threading.Timer(0.1, scratch.unregister_pressure, (80,))
+        t.start()
+        assert scratch.register_pressure(30, timeout=5)
+        t.join()
+
+        assert scratch.pressure == 30
+        scratch.close()
+
+    def test_no_budget(self):
+        scratch = ScratchSpace()
+        assert scratch.register_pressure(10 ** 12, timeout=0.1)
+        assert scratch.register_pressure(10 ** 12, timeout=0.1)
+        scratch.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import os
+import tempfile
+from unittest import main
+
+from backup.common.util import available_cpu_count, cgroup_cpu_quota
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestUtil(CustomTestCase):
+    def write(self, name, content):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'w') as f:
+            f.write(content)
+
+    def test_cgroup_v2_quota(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.write(root + "/cpu.max", "150000 100000\n")
+
+            assert cgroup_cpu_quota(root) == 1.5
+            assert available_cpu_count(root) <= 2
+
+    def test_cgroup_v2_unlimited(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.write(root + "/cpu.max", "max 100000\n")
+
+            assert cgroup_cpu_quota(root) is None
+
+    def test_cgroup_v1_quota(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.write(root + "/cpu/cpu.cfs_quota_us", "100000\n")
+            self.write(root + "/cpu/cpu.cfs_period_us", "100000\n")
+
+            assert cgroup_cpu_quota(root) == 1.0
+            assert available_cpu_count(root) == 1
+
+    def test_no_cgroup(self):
+        with tempfile.TemporaryDirectory() as root:
+            assert cgroup_cpu_quota(root) is None
+            assert available_cpu_count(root) >= 1
+
+
+if __name__ == '__main__':
+    main()
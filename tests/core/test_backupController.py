@@ -1,10 +1,29 @@
 from unittest import TestCase
-import os, tempfile
+from unittest.mock import patch
+from click.testing import CliRunner
+import os, shutil, sqlite3, tarfile, tempfile, threading
 from backup.common.dircompare import DirCompare
+from backup.common.hookhelper import HookHelper
 from backup.core.basecontroller import BackupController, RestoreController
 from backup.core.parameters import GeneralSettings, BackupParameters, RestoreParameters
 from backup.db.db import DatabaseManager
+from backup.common.util import calculate_file_hash
+from backup.db.domain import ArchiveDiscMap, ArchiveEntry
+from backup.storage.directory import DirectoryStorageBackupParameters
+from backup.storage.iso import IsoStorageBackupParameters, IsoImageReader
+from backup.storage.stream import StreamStorageBackupParameters, StreamRestoreController
+from backup.core.encryptor import GpgEncryptor
+from main import cli
 from tests.common.customtestcase import CustomTestCase
+from tests.db.test_databaseManager import VERSION_1_INDEX
+
+
+class NoDecryptEncryptor(GpgEncryptor):
+    """Only decrypts archives, the index has to come from the index cache."""
+
+    def decrypt_file(self, in_filename, out_filename):
+        assert not in_filename.endswith(".sqlite.gpg"), "Index was decrypted again"
+        super().decrypt_file(in_filename, out_filename)
 
 
 class TestBackupRestoreController(CustomTestCase):
@@ -185,9 +204,433 @@ class TestBackupRestoreController(CustomTestCase):
 
         self.do_backup_for_configuration(bck_params)
 
+    def test_full_backup_threading_00(self):
+        """ Backup (threaded pipeline, fragmented files, encrypted) -> Restore -> check result """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 600  # this ensures that each file will have two archives
+        bck_params.disc_size = bck_params.single_archive_size
+        bck_params.encryption_key = "my awesome encryption key!&"
+        bck_params.use_threading = True
+        bck_params.threads = 3
+        bck_params.scratch_budget = 2000
+
+        self.do_backup_for_configuration(bck_params)
+
+    def test_full_backup_index_cache_00(self):
+        """ Backup (encrypted index, index cache) -> Restore without decrypting the index again """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.encryption_key = "my awesome encryption key!&"
+
+        with tempfile.TemporaryDirectory() as cache_dir, tempfile.TemporaryDirectory() as index_dir:
+            settings = GeneralSettings()
+            settings.index_cache_directory = cache_dir
+
+            # start with an empty encrypted index
+            plain_index = os.path.join(index_dir, "index.sqlite")
+            encrypted_index = plain_index + ".gpg"
+            DatabaseManager(plain_index).close_database()
+            GpgEncryptor(bck_params.encryption_key).encrypt_file(plain_index, encrypted_index)
+
+            with tempfile.TemporaryDirectory() as destination_dir:
+                with tempfile.TemporaryDirectory() as source_dir:
+                    bck_params.database_location = encrypted_index
+                    bck_params.source = source_dir
+                    bck_params.destination = destination_dir
+
+                    self.create_sourceStructure(source_dir, [2, 2])
+                    BackupController(settings).execute(bck_params)
+                    # the old and the updated index
+                    assert len([name for name in os.listdir(cache_dir) if name.endswith(".sqlite")]) == 2
+
+                    with tempfile.TemporaryDirectory() as restore_dir:
+                        rst_params = RestoreParameters()
+                        rst_params.database_location = encrypted_index
+                        rst_params.source = destination_dir
+                        rst_params.destination = restore_dir
+                        rst_params.encryption_key = bck_params.encryption_key
+
+                        ctrl = RestoreController(settings)
+                        ctrl._create_encryptor = lambda params: NoDecryptEncryptor(params.encryption_key)
+                        ctrl.execute(rst_params)
+
+                        assert DirCompare(source_dir, restore_dir).compare()
+
+    def test_restore_medium_shard_00(self):
+        """ Backup (many mediums) -> Restore one medium with its index shard only """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.backup_parameters = DirectoryStorageBackupParameters()
+        bck_params.backup_parameters.medium_size = 500  # compressed archives are ~200 bytes
+        bck_params.backup_parameters.slack_size = 0
+
+        with tempfile.NamedTemporaryFile() as db_filename:
+            with tempfile.TemporaryDirectory() as destination_dir:
+                with tempfile.TemporaryDirectory() as source_dir:
+                    bck_params.database_location = db_filename.name
+                    bck_params.source = source_dir
+                    bck_params.destination = destination_dir
+
+                    self.create_sourceStructure(source_dir, [2, 5])
+                    BackupController(GeneralSettings()).execute(bck_params)
+
+                    mediums = sorted(os.listdir(destination_dir))
+                    assert len(mediums) > 1
+                    medium_dir = os.path.join(destination_dir, mediums[0])
+
+                    shard = DatabaseManager(os.path.join(medium_dir, GeneralSettings().database_name), True)
+                    shard_files = set(shard.read_backup(None).relative_files())
+                    shard.close_database()
+                    assert 0 < len(shard_files) < 10
+
+                    with tempfile.TemporaryDirectory() as restore_dir:
+                        rst_params = RestoreParameters()
+                        rst_params.database_location = os.path.join(medium_dir, GeneralSettings().database_name)
+                        rst_params.source = medium_dir
+                        rst_params.destination = restore_dir
+                        rst_params.skip_unavailable = True
+                        RestoreController(GeneralSettings()).execute(rst_params)
+
+                        restored = set()
+                        for subdir, dirs, files in os.walk(restore_dir):
+                            for file in files:
+                                relative_file = os.path.join(subdir, file)[len(restore_dir):]
+                                restored.add(relative_file)
+                                with open(os.path.join(subdir, file)) as a, open(source_dir + relative_file) as b:
+                                    assert a.read() == b.read()
+
+                        assert 0 < len(restored) and restored <= shard_files
+
+    def test_stream_backup_00(self):
+        """ Backup (encrypted, stream mediums) -> Restore in stream order -> check result """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.encryption_key = "my awesome encryption key!&"
+        bck_params.backup_parameters = StreamStorageBackupParameters()
+        bck_params.backup_parameters.medium_size = 1500
+        bck_params.backup_parameters.slack_size = 0
+
+        with tempfile.NamedTemporaryFile() as db_filename:
+            with tempfile.TemporaryDirectory() as destination_dir:
+                with tempfile.TemporaryDirectory() as source_dir:
+                    bck_params.database_location = db_filename.name
+                    bck_params.source = source_dir
+                    bck_params.destination = destination_dir
+
+                    self.create_sourceStructure(source_dir, [2, 5])
+                    BackupController(GeneralSettings()).execute(bck_params)
+
+                    streams = sorted(name for name in os.listdir(destination_dir) if name.endswith(".tar"))
+                    assert len(streams) > 1
+                    for name in streams:  # plain tar: header, archives, catalog
+                        with tarfile.open(os.path.join(destination_dir, name)) as tar:
+                            names = tar.getnames()
+                        assert names[0] == GeneralSettings().index_filename
+                        assert names[-1] == "catalog.yml"
+                        assert all(n.endswith(".tar.bz2.gpg") for n in names[1:-1])
+
+                    with tempfile.TemporaryDirectory() as restore_dir:
+                        rst_params = RestoreParameters()
+                        rst_params.database_location = db_filename.name
+                        rst_params.source = destination_dir
+                        rst_params.destination = restore_dir
+                        rst_params.encryption_key = bck_params.encryption_key
+                        rst_params.backup_parameters = StreamStorageBackupParameters()
+                        RestoreController(GeneralSettings()).execute(rst_params)
+
+                        assert DirCompare(source_dir, restore_dir).compare()
+
+                    # a pipe can't seek at all: restore the files of the first medium from it
+                    with tempfile.TemporaryDirectory() as restore_dir:
+                        fifo = os.path.join(restore_dir, "..", os.path.basename(restore_dir) + ".fifo")
+                        os.mkfifo(fifo)
+
+                        def feed():
+                            try:
+                                with open(os.path.join(destination_dir, streams[0]), 'rb') as src, \
+                                        open(fifo, 'wb') as f:
+                                    shutil.copyfileobj(src, f)
+                            except BrokenPipeError:
+                                pass  # the restore stops reading after the last needed archive
+
+                        feeder = threading.Thread(target=feed)
+                        feeder.start()
+                        try:
+                            rst_params = RestoreParameters()
+                            rst_params.database_location = db_filename.name
+                            rst_params.source = fifo
+                            rst_params.destination = restore_dir
+                            rst_params.encryption_key = bck_params.encryption_key
+                            rst_params.backup_parameters = StreamStorageBackupParameters()
+                            rst_params.skip_unavailable = True
+                            RestoreController(GeneralSettings()).execute(rst_params)
+                        finally:
+                            feeder.join()
+                            os.remove(fifo)
+
+                        restored = [files for _, _, files in os.walk(restore_dir) if files]
+                        assert 0 < sum(len(files) for files in restored) < 10
+
+    def test_stream_file_backup_00(self):
+        """ Backup into a single stream file -> Restore from it, a second medium is refused instead of overwriting """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.backup_parameters = StreamStorageBackupParameters()
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.NamedTemporaryFile() as stream_file, \
+                tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as restore_dir:
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = stream_file.name
+
+            self.create_sourceStructure(source_dir, [2, 5])
+            BackupController(GeneralSettings()).execute(bck_params)
+
+            rst_params = RestoreParameters()
+            rst_params.database_location = db_filename.name
+            rst_params.source = stream_file.name
+            rst_params.destination = restore_dir
+            rst_params.backup_parameters = StreamStorageBackupParameters()
+            RestoreController(GeneralSettings()).execute(rst_params)
+            assert DirCompare(source_dir, restore_dir).compare()
+
+            # the stream stays positioned between the restore iterations instead of being opened again
+            storage = StreamRestoreController(GeneralSettings(), rst_params)
+            db = DatabaseManager(db_filename.name, read_only=True)
+            with patch("backup.storage.stream.tarfile.open", side_effect=tarfile.open) as opened:
+                _, sources = storage.available_sources(db.read_backup(None), [], "tar.bz2")
+                archive_ids = sorted(sources)
+                assert [a for a, path in storage.open_archives(archive_ids[:1], sources)] == archive_ids[:1]
+                storage.available_sources(db.read_backup(None), [], "tar.bz2")
+                assert opened.call_count == 1
+                assert [a for a, path in storage.open_archives(archive_ids[1:], sources)] == archive_ids[1:]
+                assert opened.call_count == 1
+            storage.close()
+            db.close_database()
+
+            result = CliRunner().invoke(cli, ["backup", source_dir, "stream://" + stream_file.name])
+            assert result.exception is None and "needs --index" in result.output
+
+            with tempfile.NamedTemporaryFile() as other_db:
+                bck_params.database_location = other_db.name
+                bck_params.backup_parameters.medium_size = 1500
+                bck_params.backup_parameters.slack_size = 0
+                with self.assertRaises(ValueError):
+                    BackupController(GeneralSettings()).execute(bck_params)
+
+    def test_bluray_backup_00(self):
+        """ Backup (encrypted) into ISO images -> Restore from the images -> check result """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.encryption_key = "my awesome encryption key!&"
+        bck_params.backup_parameters = IsoStorageBackupParameters()
+        bck_params.backup_parameters.medium_size = (19 + 3) * 2048  # 19 sectors header, three archives
+        bck_params.backup_parameters.slack_size = 0
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.TemporaryDirectory() as destination_dir, \
+                tempfile.TemporaryDirectory() as source_dir:
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = destination_dir
+
+            hooked = dict()
+
+            def execute_hook(hook_helper, name, parameters):  # what a burn hook would find in the image
+                hooked[os.path.basename(parameters[0])] = set(IsoImageReader(parameters[0]).entries)
+
+            self.create_sourceStructure(source_dir, [2, 5])
+            with patch.object(HookHelper, "execute_hook", execute_hook):
+                BackupController(GeneralSettings()).execute(bck_params)
+
+            images = sorted(os.listdir(destination_dir))
+            assert len(images) > 1 and all(name.endswith(".iso") for name in images)
+            assert sorted(hooked) == images
+            for name in images:
+                entries = IsoImageReader(os.path.join(destination_dir, name)).entries
+                assert GeneralSettings().index_filename in entries
+                assert GeneralSettings().database_name + ".gpg" in entries  # index shard
+                assert hooked[name] == set(entries)
+
+            with tempfile.TemporaryDirectory() as restore_dir:
+                rst_params = RestoreParameters()
+                rst_params.database_location = db_filename.name
+                rst_params.source = destination_dir
+                rst_params.destination = restore_dir
+                rst_params.encryption_key = bck_params.encryption_key
+                rst_params.backup_parameters = IsoStorageBackupParameters()
+                RestoreController(GeneralSettings()).execute(rst_params)
+
+                assert DirCompare(source_dir, restore_dir).compare()
+
+    def test_parity_repair_00(self):
+        """ Backup with parity archives -> lose one archive and damage another one -> Restore repairs both """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.backup_parameters = DirectoryStorageBackupParameters()
+        bck_params.backup_parameters.parity_archives = 2
+        bck_params.backup_parameters.parity_group_size = 4
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.TemporaryDirectory() as destination_dir, \
+                tempfile.TemporaryDirectory() as source_dir:
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = destination_dir
+
+            self.create_sourceStructure(source_dir, [2, 5])
+            BackupController(GeneralSettings()).execute(bck_params)
+
+            medium_dir = os.path.join(destination_dir, os.listdir(destination_dir)[0])
+            archives = sorted(name for name in os.listdir(medium_dir) if name.endswith(".tar.bz2"))
+            parity = [name for name in os.listdir(medium_dir) if name.endswith(".par")]
+            assert len(archives) > 4
+            assert len(parity) == 2 * ((len(archives) + 3) // 4)
+
+            os.remove(os.path.join(medium_dir, archives[0]))
+            # bit rot in the next group, the size stays the same (only read errors reveal it)
+            with open(os.path.join(medium_dir, archives[4]), 'r+b') as f:
+                f.seek(50)
+                data = f.read(20)
+                f.seek(50)
+                f.write(bytes(b ^ 0xff for b in data))
+
+            with tempfile.TemporaryDirectory() as restore_dir:
+                rst_params = RestoreParameters()
+                rst_params.database_location = db_filename.name
+                rst_params.source = destination_dir
+                rst_params.destination = restore_dir
+                RestoreController(GeneralSettings()).execute(rst_params)
+
+                assert DirCompare(source_dir, restore_dir).compare()
+
+    def test_upgraded_index_backup_00(self):
+        """ Index of the first release -> incremental backup migrates it and writes a shard onto the medium """
+        bck_params = BackupParameters()
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.TemporaryDirectory() as destination_dir, \
+                tempfile.TemporaryDirectory() as source_dir:
+            with sqlite3.connect(db_filename.name) as con:
+                con.executescript(VERSION_1_INDEX)
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = destination_dir
+
+            self.create_sourceStructure(source_dir, [2, 2])
+            BackupController(GeneralSettings()).execute(bck_params)
+
+            medium_dir = os.path.join(destination_dir, os.listdir(destination_dir)[0])
+            shard = os.path.join(medium_dir, GeneralSettings().database_name)
+            assert os.path.exists(os.path.join(medium_dir, GeneralSettings().index_filename))
+            with sqlite3.connect(shard) as con:
+                assert con.execute("SELECT COUNT(*) FROM file_entry").fetchone()[0] == 4
+
+            with tempfile.TemporaryDirectory() as restore_dir:
+                rst_params = RestoreParameters()
+                rst_params.database_location = shard
+                rst_params.source = destination_dir
+                rst_params.destination = restore_dir
+                RestoreController(GeneralSettings()).execute(rst_params)
+
+                assert DirCompare(source_dir, restore_dir).compare()
+
+    def test_archive_checksum_00(self):
+        """ Backup -> damage one archive -> Restore rejects it before decompressing, unless verification is off """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.use_threading = True
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.TemporaryDirectory() as destination_dir, \
+                tempfile.TemporaryDirectory() as source_dir:
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = destination_dir
+
+            self.create_sourceStructure(source_dir, [2, 5])
+            BackupController(GeneralSettings()).execute(bck_params)
+
+            medium_dir = os.path.join(destination_dir, os.listdir(destination_dir)[0])
+            db = DatabaseManager(db_filename.name)
+            archives = list(ArchiveEntry.select())
+            db.close_database()
+            for archive in archives:
+                path = os.path.join(medium_dir, archive.name)
+                assert archive.size == os.path.getsize(path)
+                assert archive.sha512 == calculate_file_hash(path, "sha512")
+                assert archive.codec == "tar.bz2"
+
+            with open(os.path.join(medium_dir, archives[0].name), 'r+b') as f:  # same size, other content
+                f.seek(50)
+                data = f.read(20)
+                f.seek(50)
+                f.write(bytes(b ^ 0xff for b in data))
+
+            rst_params = RestoreParameters()
+            rst_params.database_location = db_filename.name
+            rst_params.source = destination_dir
+            with tempfile.TemporaryDirectory() as restore_dir:
+                rst_params.destination = restore_dir
+                with self.assertRaisesRegex(RuntimeError, "checksum"):
+                    RestoreController(GeneralSettings()).execute(rst_params)
+
+            with tempfile.TemporaryDirectory() as restore_dir:
+                rst_params.destination = restore_dir
+                rst_params.verify_archives = False
+                with self.assertRaises(Exception) as cm:  # the damage is only noticed by decompressing
+                    RestoreController(GeneralSettings()).execute(rst_params)
+                assert "checksum" not in str(cm.exception)
+
+    def test_fan_out_backup_00(self):
+        """ Backup (threading) to a directory and a stream destination at once -> Restore from each of them """
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 1050
+        bck_params.use_threading = True
+        bck_params.backup_parameters = DirectoryStorageBackupParameters()
+        bck_params.backup_parameters.medium_size = 500  # compressed archives are ~200 bytes
+        bck_params.backup_parameters.slack_size = 0
+        stream_params = StreamStorageBackupParameters()  # everything on one medium
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.TemporaryDirectory() as onsite_dir, \
+                tempfile.TemporaryDirectory() as offsite_dir, tempfile.TemporaryDirectory() as source_dir:
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = onsite_dir
+            bck_params.additional_destinations = [(offsite_dir, stream_params)]
+
+            self.create_sourceStructure(source_dir, [2, 5])
+            BackupController(GeneralSettings()).execute(bck_params)
+
+            assert len(os.listdir(onsite_dir)) > 1
+            assert len([name for name in os.listdir(offsite_dir) if name.endswith(".tar")]) == 1
+
+            db = DatabaseManager(db_filename.name, read_only=True)
+            copies = dict()
+            for archive_copy in ArchiveDiscMap.select():
+                copies.setdefault(archive_copy.archive_id, set()).add(archive_copy.disc.destination.name)
+            db.close_database()
+            assert len(copies) > 1
+            assert all(names == {onsite_dir, offsite_dir} for names in copies.values())
+
+            for source, backup_parameters in ((onsite_dir, None), (offsite_dir, stream_params)):
+                with tempfile.TemporaryDirectory() as restore_dir:
+                    rst_params = RestoreParameters()
+                    rst_params.database_location = db_filename.name
+                    rst_params.source = source
+                    rst_params.destination = restore_dir
+                    rst_params.backup_parameters = backup_parameters
+                    RestoreController(GeneralSettings()).execute(rst_params)
+
+                    assert DirCompare(source_dir, restore_dir).compare()
+
     def test_full_backup_03(self):
         """ Backup -> Backup -> check if 2nd backup is empty """
+        self.do_unchanged_backup(False)
+
+    def test_full_backup_threading_02(self):
+        """ Backup (threaded) -> Backup (threaded) -> check if 2nd backup is empty """
+        self.do_unchanged_backup(True)
+
+    def do_unchanged_backup(self, use_threading):
         bck_params = BackupParameters()
+        bck_params.use_threading = use_threading
         # Every archive will be one(1) disc.
         bck_params.single_archive_size = 1050
         bck_params.disc_size = bck_params.single_archive_size
@@ -208,6 +651,7 @@ class TestBackupRestoreController(CustomTestCase):
 
                     with tempfile.TemporaryDirectory() as destination_dir2:
                         bck_params = BackupParameters()
+                        bck_params.use_threading = use_threading
                         bck_params.database_location = db_filename.name
                         bck_params.source = source_dir
                         bck_params.single_archive_size = 1050
@@ -225,7 +669,25 @@ class TestBackupRestoreController(CustomTestCase):
 
     def test_full_backup_04(self):
         """ Backup -> change one file -> Backup -> check if 2nd backup """
+        self.do_incremental_backup(False)
+
+    def test_full_backup_threading_01(self):
+        """ Backup (threaded) -> change one file -> Backup (threaded, incremental) -> check if 2nd backup """
+        self.do_incremental_backup(True)
+
+    def test_full_backup_lazy_index_01(self):
+        """ Backup -> change one file -> Backup (incremental) -> restore, with the lazy index reader """
+        self.do_incremental_backup(False, lazy_index=True)
+
+    def test_full_backup_lazy_index_02(self):
+        """ Backup (threaded) -> change one file -> Backup (threaded, incremental) -> restore, with the lazy index """
+        self.do_incremental_backup(True, lazy_index=True)
+
+    def do_incremental_backup(self, use_threading, lazy_index=False):
         bck_params = BackupParameters()
+        bck_params.use_threading = use_threading
+        bck_params.autotune = use_threading
+        bck_params.lazy_index = lazy_index
         # Every archive will be one(1) disc.
         bck_params.single_archive_size = 1050
         bck_params.disc_size = bck_params.single_archive_size
@@ -253,6 +715,8 @@ class TestBackupRestoreController(CustomTestCase):
                     self.create_test_file(src_file_list[0], -1)
 
                     bck_params = BackupParameters()
+                    bck_params.use_threading = use_threading
+                    bck_params.lazy_index = lazy_index
                     bck_params.database_location = db_filename.name
                     bck_params.source = source_dir
                     bck_params.single_archive_size = 1050
@@ -275,6 +739,7 @@ class TestBackupRestoreController(CustomTestCase):
                         rst_params.source = destination_root
                         rst_params.destination = restore_dir
                         rst_params.encryption_key = bck_params.encryption_key
+                        rst_params.lazy_index = lazy_index
 
                         ctrl = RestoreController(GeneralSettings())
                         ctrl.execute(rst_params)
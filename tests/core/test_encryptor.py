@@ -1,6 +1,10 @@
+import errno
 import os
 import tempfile
+import threading
 from unittest import TestCase
+from unittest.mock import patch
+from backup.common.util import calculate_file_hash, HashingWriter
 from backup.core.encryptor import PyCryptoEncryptor, GpgEncryptor
 from tests.common.customtestcase import CustomTestCase
 
@@ -42,10 +46,36 @@ class TestGpgEncryptor(CustomTestCase):
 
                     self.create_test_file(source_file.name, 20)
 
-                    tar.encrypt_file(source_file.name, encrypt_file.name)
+                    sha512 = tar.encrypt_file(source_file.name, encrypt_file.name)
+                    assert sha512 == calculate_file_hash(encrypt_file.name, "sha512")
                     tar.decrypt_file(encrypt_file.name, decrypt_file.name)
 
                     assert os.path.getsize(decrypt_file.name) == os.path.getsize(source_file.name)
 
                     with open(source_file.name, 'r') as f:
                         assert 'aaaaaaaaaaaaaaaaaaaa' == f.readline()
+
+    def test_encrypt_full_disk(self):
+        """ A failing write of the encrypted file is raised, GPG doesn't block on the full pipe """
+        with tempfile.NamedTemporaryFile() as source_file, tempfile.NamedTemporaryFile() as encrypt_file:
+            with open(source_file.name, 'wb') as f:
+                f.write(os.urandom(4 * 1024 * 1024))  # more than the pipe buffer
+
+            def full_disk(writer, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+            errors = list()
+
+            def encrypt():
+                try:
+                    GpgEncryptor("01 2345678 91234 56&/!@ö").encrypt_file(source_file.name, encrypt_file.name)
+                except OSError as e:
+                    errors.append(e)
+
+            with patch.object(HashingWriter, "write", full_disk):
+                encryptor = threading.Thread(target=encrypt, daemon=True)
+                encryptor.start()
+                encryptor.join(60)
+
+            assert not encryptor.is_alive(), "encrypt_file hangs"
+            assert len(errors) == 1 and errors[0].errno == errno.ENOSPC
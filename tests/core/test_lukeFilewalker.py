@@ -1,4 +1,5 @@
 from unittest import TestCase, main
+import os
 import tempfile
 
 from backup.core.luke import LukeFilewalker
@@ -35,6 +36,19 @@ class TestLukeFilewalker(CustomTestCase):
             assert f.original_path == temp_dir
             assert f.sha_sum == "c7be1ed902fb8dd4d48997c6452f5d7e509fbcdbe2808b16bcf4edce4c07d14e"
 
+    def test_filewalker_order(self):
+        """ Files come sorted by (directory path, name), like the sorted cursor of the lazy index reader """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for directory in ("a", "a/b", "a-b", "a0"):
+                os.mkdir(os.path.join(temp_dir, directory))
+            for relative_file in ("z", "a/2", "a/1", "a/b/1", "a-b/1", "a0/1"):
+                self.create_test_file(os.path.join(temp_dir, relative_file))
+
+            files = [f.relative_file for f in LukeFilewalker().walk_directory_list(temp_dir, False)]
+
+            assert files == ["/z", "/a-b/1", "/a/1", "/a/2", "/a/b/1", "/a0/1"]
+            assert files == sorted(files, key=lambda f: (f[:f.rfind("/") + 1], f[f.rfind("/") + 1:]))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+from unittest import main
+
+from backup.core.parity import ParityEncoder, reconstruct, gf_mul, gf_inv
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestParity(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def file(self, name, content=None) -> str:
+        name = os.path.join(self.directory.name, name)
+        if content is not None:
+            with open(name, 'wb') as f:
+                f.write(content)
+        return name
+
+    def read(self, name) -> bytes:
+        with open(name, 'rb') as f:
+            return f.read()
+
+    def encode(self, sizes, parity_count):
+        archives = [self.file("archive_%i" % i, os.urandom(size)) for i, size in enumerate(sizes)]
+        parity = [self.file("parity_%i" % j) for j in range(parity_count)]
+
+        encoder = ParityEncoder(parity, block_size=1000)  # several blocks per archive
+        for i, archive in enumerate(archives):
+            assert encoder.add(archive) == i
+        encoder.close()
+
+        assert encoder.size == max(sizes)
+        assert all(os.path.getsize(name) == max(sizes) for name in parity)
+        return archives, parity
+
+    def test_field(self):
+        for a in range(1, 256):
+            assert gf_mul(a, gf_inv(a)) == 1
+        assert gf_mul(0, 7) == 0
+
+    def test_reconstruct(self):
+        sizes = [4500, 1, 0, 3999, 4500, 2048]
+        archives, parity = self.encode(sizes, 3)
+
+        for missing in ([0], [1, 3], [0, 4, 5], [2]):
+            intact = {i: name for i, name in enumerate(archives) if i not in missing}
+            targets = {i: (self.file("rebuilt_%i" % i), sizes[i]) for i in missing}
+            # the first parity archive is damaged as well, if there are enough others
+            parity_files = {j: name for j, name in enumerate(parity) if len(missing) == 3 or j > 0}
+
+            reconstruct(len(archives), intact, parity_files, targets, block_size=700)
+            for i in missing:
+                assert self.read(targets[i][0]) == self.read(archives[i]), missing
+
+    def test_not_enough_shards(self):
+        archives, parity = self.encode([100, 200, 300], 1)
+
+        with self.assertRaises(ValueError):
+            reconstruct(3, {0: archives[0]}, {0: parity[0]}, {1: (self.file("a"), 200), 2: (self.file("b"), 300)})
+
+    def test_group_size(self):
+        encoder = ParityEncoder([self.file("parity_%i" % j) for j in range(250)])
+        archive = self.file("archive", b"x")
+        for _ in range(6):
+            encoder.add(archive)
+
+        with self.assertRaises(ValueError):
+            encoder.add(archive)
+        encoder.close()
+
+
+if __name__ == '__main__':
+    main()
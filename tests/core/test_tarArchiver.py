@@ -3,6 +3,7 @@ import tarfile
 import tempfile
 from unittest import TestCase, main
 from unittest.mock import Mock
+from backup.common.util import calculate_file_hash
 from backup.core.archive import ArchiveManager, DefaultArchiver, FileBulker
 from backup.core.luke import FileEntryDTO, LukeFilewalker
 from tests.common.customtestcase import CustomTestCase
@@ -62,7 +63,8 @@ class TestDefaultArchiver(CustomTestCase):
                 file_entry.original_filename = os.path.split(src_file.name)[1]
                 file_entry.relative_file = relative_file
 
-                tar.compress_files([file_entry], archive_file.name)
+                sha512 = tar.compress_files([file_entry], archive_file.name)
+                assert sha512 == calculate_file_hash(archive_file.name, "sha512")
 
                 with tempfile.TemporaryDirectory() as dest_dir:
                     tar.decompress_files(archive_file.name, [file_entry.relative_file], dest_dir)
@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import tempfile
+
+from click.testing import CliRunner
+
+from backup.core.basecontroller import BackupController
+from backup.core.parameters import GeneralSettings, BackupParameters, VerifyParameters
+from backup.core.verify import VerifyController, sample_archives, STATUS_OK, STATUS_DAMAGED, STATUS_MISSING
+from backup.db.db import DatabaseManager
+from backup.db.domain import FileEntry
+from backup.storage.directory import DirectoryStorageBackupParameters
+from main import cli
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestSampleArchives(CustomTestCase):
+    def test_rounds_cover_all(self):
+        archive_ids = list(range(1, 1001))
+        verified = list()
+        for sample_round in range(20):
+            sample = sample_archives(archive_ids, 0.05, sample_round)
+            assert 20 < len(sample) < 80
+            verified.extend(sample)
+
+        assert sorted(verified) == archive_ids  # every archive exactly once in 20 rounds
+        assert sample_archives(archive_ids, 1, 7) == archive_ids
+
+
+class TestVerifyController(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_file = tempfile.NamedTemporaryFile()
+        self.destination_dir = tempfile.TemporaryDirectory()
+        self.source_dir = tempfile.TemporaryDirectory()
+
+        for i in range(10):
+            with open(os.path.join(self.source_dir.name, "file_%02i" % i), 'w') as f:
+                f.write("%i%s" % (i, "a" * 1024))
+
+        bck_params = BackupParameters()
+        bck_params.database_location = self.db_file.name
+        bck_params.source = self.source_dir.name
+        bck_params.destination = self.destination_dir.name
+        bck_params.single_archive_size = 1050
+        bck_params.backup_parameters = DirectoryStorageBackupParameters()
+        bck_params.backup_parameters.medium_size = 500  # compressed archives are ~200 bytes
+        bck_params.backup_parameters.slack_size = 0
+        BackupController(GeneralSettings()).execute(bck_params)
+
+    def tearDown(self):
+        self.db_file.close()
+        self.destination_dir.cleanup()
+        self.source_dir.cleanup()
+
+    def verify(self, **kwargs) -> dict:
+        params = VerifyParameters()
+        params.database_location = self.db_file.name
+        params.source = self.destination_dir.name
+        for key, value in kwargs.items():
+            setattr(params, key, value)
+        return VerifyController(GeneralSettings()).execute(params)
+
+    def archive_files(self) -> [str]:
+        return sorted(os.path.join(subdir, name) for subdir, dirs, files in os.walk(self.destination_dir.name)
+                      for name in files if name.endswith(".tar.bz2"))
+
+    def test_verify_00(self):
+        """ Intact mediums, with and without deep verification """
+        assert len(os.listdir(self.destination_dir.name)) > 1  # mediums are read in parallel
+
+        report = self.verify()
+        assert report["archives"] == 10
+        assert report["summary"][STATUS_OK] == 10
+        assert report["bytes"] == sum(os.path.getsize(f) for f in self.archive_files())
+
+        report = self.verify(deep=True, sample=0.5)
+        assert 0 < report["verified"] < 10
+        assert all(r["status"] == STATUS_OK and r["files"] == 1 for r in report["results"])
+
+    def test_verify_damaged_00(self):
+        """ Damaged and missing archive are reported, the report is written as JSON """
+        archives = self.archive_files()
+        with open(archives[0], 'r+b') as f:  # same size, other content
+            f.seek(50)
+            data = f.read(10)
+            f.seek(50)
+            f.write(bytes(b ^ 0xff for b in data))
+        os.remove(archives[1])
+
+        with tempfile.NamedTemporaryFile() as report_file:
+            report = self.verify(report_file=report_file.name)
+            with open(report_file.name) as f:
+                assert json.load(f) == report
+
+        status = {r["name"]: r["status"] for r in report["results"]}
+        assert status[os.path.basename(archives[0])] == STATUS_DAMAGED
+        assert status[os.path.basename(archives[1])] == STATUS_MISSING
+        assert report["summary"][STATUS_OK] == 8
+
+        report = self.verify(skip_unavailable=True)
+        assert report["archives"] == 9 and report["summary"][STATUS_DAMAGED] == 1
+
+    def test_verify_deep_00(self):
+        """ Deep verification compares the files with the index """
+        db = DatabaseManager(self.db_file.name)
+        with db.transaction():
+            FileEntry.update(sha_sum="0" * 64).where(FileEntry.name == "file_03").execute()
+        db.close_database()
+
+        report = self.verify()
+        assert report["summary"][STATUS_OK] == 10  # the archives themselves are intact
+
+        report = self.verify(deep=True)
+        damaged = [r for r in report["results"] if r["status"] == STATUS_DAMAGED]
+        assert len(damaged) == 1
+        assert damaged[0]["bad_files"] == ["/file_03"]
+
+    def test_verify_cli_00(self):
+        """ Without --index the index next to the mediums is verified """
+        runner = CliRunner()
+        args = ["verify", self.destination_dir.name, "--no-index-cache", "--terminal", "SILENT"]
+
+        result = runner.invoke(cli, args)
+        assert result.exception is None and "Database not found" in result.output
+
+        shutil.copyfile(self.db_file.name, os.path.join(self.destination_dir.name, "index.sqlite"))
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0, result.output
+        assert "Verified 10 of 10 archives" in result.output
+
+        result = runner.invoke(cli, ["verify", self.archive_files()[0], "--terminal", "SILENT"])
+        assert result.exception is None and "needs --index" in result.output
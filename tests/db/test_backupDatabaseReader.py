@@ -1,9 +1,10 @@
 import tempfile
+import threading
 import unittest
 import time
 
 from backup.db.domain import *
-from backup.db.db import DatabaseManager, BackupType
+from backup.db.db import DatabaseManager, BackupDatabaseReader, BackupType
 from backup.core.luke import FileEntryDTO
 from tests.common.customtestcase import CustomTestCase
 
@@ -20,6 +21,7 @@ class TestBackupDatabaseReader(CustomTestCase):
             with db_manager.transaction():
                 backup_manager = db_manager.create_backup(BackupType.FULL, None)
                 # empty FULL backup
+                db_manager.update_current_state(backup_manager.backup_root)
 
             time.sleep(0.1)  # this ensures that the diff backup is a few milliseconds older. Helps in sorting backups
 
@@ -36,6 +38,7 @@ class TestBackupDatabaseReader(CustomTestCase):
                 archive01_02 = backup_manager.create_archive(disc01)
                 file01_02_01 = backup_manager.create_file_from_dto(dto_file01_full_02_01, FileState.NEW)
                 backup_manager.map_file_to_archive(file01_02_01, archive01_02)
+                db_manager.update_current_state(backup_manager.backup_root)
 
             dto_file01_diff_01_01 = self.create_dummy_file(3)
 
@@ -52,6 +55,7 @@ class TestBackupDatabaseReader(CustomTestCase):
                 archive01_02 = backup_manager.create_archive(disc01)
                 file01_02_01 = backup_manager.create_file_from_dto(dto_file01_diff_01_01, FileState.NEW)
                 backup_manager.map_file_to_archive(file01_02_01, archive01_02)
+                db_manager.update_current_state(backup_manager.backup_root)
 
             time.sleep(0.1)  # this ensures that the diff backup is a few milliseconds older. Helps in sorting backups
 
@@ -64,14 +68,157 @@ class TestBackupDatabaseReader(CustomTestCase):
                 archive01_02 = backup_manager.create_archive(disc01)
                 file01_02_01 = backup_manager.create_file_from_dto(dto_file01_full_02_01, FileState.NEW)
                 backup_manager.map_file_to_archive(file01_02_01, archive01_02)
+                db_manager.update_current_state(backup_manager.backup_root)
 
-            bm = db_manager.read_backup(None)
-            af = bm.all_files
+            self.assert_files(db_manager.read_backup(None), dto_file01_diff_01_01, dto_file01_full_01_01,
+                              dto_file01_full_02_01)
 
+            # the replayed backup chain has to match the current state
+            replayed = BackupDatabaseReader.create_reader_from_backup(db_manager.backups_root(None, False), None)
+            self.assert_files(replayed, dto_file01_diff_01_01, dto_file01_full_01_01, dto_file01_full_02_01)
+
+            with db_manager.transaction():
+                db_manager.rebuild_current_state()
+            self.assert_files(db_manager.read_backup(None), dto_file01_diff_01_01, dto_file01_full_01_01,
+                              dto_file01_full_02_01)
+
+            reader = db_manager.read_backup(None)
+            file, state, archives, backup = reader.find_coordinates(
+                reader.find_relative_file(dto_file01_full_01_01.relative_file))
+            assert backup.type == BackupType.FULL
+            assert len(archives) == 1
+
+            # database of the previous version without current state table
+            db_manager.database.execute_sql("DELETE FROM current_file_entry")
+            db_manager.database.execute_sql("PRAGMA user_version = 1")
+            db_manager.close_database()
+
+            db_manager = DatabaseManager(tmp_filename.name)
+            self.assert_files(db_manager.read_backup(None), dto_file01_diff_01_01, dto_file01_full_01_01,
+                              dto_file01_full_02_01)
+            db_manager.close_database()
+
+    def assert_files(self, reader, dto_file01_diff_01_01, dto_file01_full_01_01, dto_file01_full_02_01):
+        af = reader.all_files
+
+        assert len(af) == 3
+        assert dto_file01_diff_01_01.relative_file in af  # file created in 1. diff backup
+        assert dto_file01_full_01_01.relative_file in af  # file created in 1 full, and not mentioned in 2. diff
+        assert dto_file01_full_02_01.relative_file in af  # file created - deleted - created
+
+    def test_archives(self):
+        with tempfile.NamedTemporaryFile() as tmp_filename:
+            db_manager = DatabaseManager(tmp_filename.name)
+
+            dto_small = self.create_dummy_file(1)
+            dto_split = self.create_dummy_file(2)
+
+            with db_manager.transaction():
+                backup_manager = db_manager.create_backup(BackupType.FULL, None)
+                disc01 = backup_manager.create_disc()
+
+                archive01 = backup_manager.create_archive(disc01)
+                archive02 = backup_manager.create_archive(disc01)
+                small = backup_manager.create_file_from_dto(dto_small, FileState.NEW)
+                backup_manager.map_file_to_archive(small, archive01)
+
+                # file split into two archives
+                split = backup_manager.create_file_from_dto(dto_split, FileState.NEW)
+                backup_manager.map_file_to_archive(split, archive01)
+                backup_manager.map_file_to_archive(split, archive02)
+                db_manager.update_current_state(backup_manager.backup_root)
+
+            reader = db_manager.read_backup(None)
+
+            file, state, archives, backup = reader.find_coordinates(reader.find_relative_file(dto_small.relative_file))
+            assert state == FileState.NEW
+            assert [a.id for a in archives] == [archive01.id]
+            assert archives[0].disc.id == disc01.id
+            assert backup.id == backup_manager.backup_root.id
+
+            file, state, archives, backup = reader.find_coordinates(reader.find_relative_file(dto_split.relative_file))
+            assert file.sha_sum == str(dto_split.sha_sum)
+            assert [a.id for a in archives] == [archive01.id, archive02.id]
+
+    def test_views(self):
+        with tempfile.NamedTemporaryFile() as tmp_filename:
+            db_manager = DatabaseManager(tmp_filename.name)
+
+            with db_manager.transaction():
+                backup_manager = db_manager.create_backup(BackupType.FULL, None)
+                archive = backup_manager.create_archive(backup_manager.create_disc())
+                for idx in range(3):
+                    file = backup_manager.create_file_from_dto(self.create_dummy_file(idx), FileState.NEW)
+                    backup_manager.map_file_to_archive(file, archive)
+                db_manager.update_current_state(backup_manager.backup_root)
+
+            reader = db_manager.read_backup(None)
+            af = reader.all_files
+            assert af is reader.all_files  # no copy per access
             assert len(af) == 3
-            assert dto_file01_diff_01_01.relative_file in af  # file created in 1. diff backup
-            assert dto_file01_full_01_01.relative_file in af  # file created in 1 full, and not mentioned in 2. diff
-            assert dto_file01_full_02_01.relative_file in af  # file created - deleted - created
+            assert "/path/1" in af
+            assert af["/path/1"].size == 1
+            assert sorted(af.keys()) == ["/path/0", "/path/1", "/path/2"]
+            with self.assertRaises(TypeError):
+                af["/path/3"] = None
+
+            assert reader.relative_files() - {"/path/0", "/path/2"} == {"/path/1"}
+
+    def test_lazy_reader(self):
+        with tempfile.NamedTemporaryFile() as tmp_filename:
+            db_manager = DatabaseManager(tmp_filename.name)
+
+            with db_manager.transaction():
+                backup_manager = db_manager.create_backup(BackupType.FULL, None)
+                archive = backup_manager.create_archive(backup_manager.create_disc())
+                for directory in ("/b/", "/a/", "/a/c/"):
+                    for name in ("2", "1"):
+                        file = backup_manager.create_file("sha", 1, directory + name, 1, FileState.NEW)
+                        backup_manager.map_file_to_archive(file, archive)
+                db_manager.update_current_state(backup_manager.backup_root)
+
+            loaded = db_manager.read_backup(None)
+            reader = db_manager.read_backup(None, lazy=True)
+            reader.max_directories = 2
+
+            assert not reader.is_empty
+            expected = ["/a/1", "/a/2", "/a/c/1", "/a/c/2", "/b/1", "/b/2"]
+            assert list(reader.relative_files()) == expected
+            assert [key for key, _ in reader.all_files.items()] == expected
+            assert len(reader.all_files) == 6
+
+            for relative_file in expected:
+                file, state, archives, backup = reader.find_coordinates(reader.find_relative_file(relative_file))
+                loaded_file, loaded_state, loaded_archives, loaded_backup = \
+                    loaded.find_coordinates(loaded.find_relative_file(relative_file))
+
+                assert file.id == loaded_file.id
+                assert file.relative_file == relative_file
+                assert state == loaded_state
+                assert [a.id for a in archives] == [a.id for a in loaded_archives]
+                assert backup.id == loaded_backup.id
+
+            assert len(reader._directories) == 2  # LRU
+            assert reader.find_relative_file("/a/3") is None
+            assert reader.find_relative_file("/x/1") is None
+            assert "/b/1" in reader.all_files
+            with self.assertRaises(KeyError):
+                reader.all_files["/x/1"]
+
+            # merge join in walker order, on another thread with its own connection
+            files = list()
+            for relative_file in ["/a/0", "/a/1", "/a/c/2", "/a/d/1", "/b/1", "/c/1"]:
+                files.append(FileEntryDTO())
+                files[-1].relative_file = relative_file
+            expected = [("/a/0", None), ("/a/1", "sha"), ("/a/c/2", "sha"), ("/a/d/1", None), ("/b/1", "sha"),
+                        ("/c/1", None)]
+            joined = list()
+            joiner = threading.Thread(target=lambda: joined.extend(
+                (file.relative_file, sha_sum) for file, sha_sum in reader.join_sha_sums(iter(files))))
+            joiner.start()
+            joiner.join()
+            assert joined == expected
+            assert [(file.relative_file, sha_sum) for file, sha_sum in loaded.join_sha_sums(files)] == expected
 
     def create_dummy_file(self, idx) -> FileEntryDTO:
         ret = FileEntryDTO()
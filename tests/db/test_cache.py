@@ -0,0 +1,123 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import main
+
+from backup.core.encryptor import Encryptor
+from backup.db.cache import IndexCache
+from tests.common.customtestcase import CustomTestCase
+
+
+class CountingEncryptor(Encryptor):
+    """Reverses the file content and counts the decryptions."""
+
+    def __init__(self, key="key"):
+        self.key = key
+        self.decryptions = 0
+
+    def encrypt_file(self, in_filename, out_filename):
+        with open(in_filename, 'rb') as src, open(out_filename, 'wb') as dest:
+            dest.write(src.read()[::-1])
+
+    def decrypt_file(self, in_filename, out_filename):
+        self.decryptions += 1
+        self.encrypt_file(in_filename, out_filename)
+
+    @property
+    def extension(self):
+        return "rev"
+
+
+class TestIndexCache(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.cache = IndexCache(os.path.join(self.directory, "cache"), max_entries=2)
+        self.encryptor = CountingEncryptor()
+        self.encrypted = os.path.join(self.directory, "index.sqlite.rev")
+        self.write(self.encrypted, b"index")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        with open(name, 'wb') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(name, 'rb') as f:
+            return f.read()
+
+    def test_decrypts_once(self):
+        first = self.cache.decrypted(self.encrypted, self.encryptor)
+        second = self.cache.decrypted(self.encrypted, self.encryptor)
+
+        assert first == second
+        assert self.read(first) == b"xedni"
+        assert self.encryptor.decryptions == 1
+        assert os.stat(self.cache.directory).st_mode & 0o077 == 0
+
+    def test_invalidated_on_change(self):
+        first = self.cache.decrypted(self.encrypted, self.encryptor)
+        self.write(self.encrypted, b"index2")
+        second = self.cache.decrypted(self.encrypted, self.encryptor)
+
+        assert first != second
+        assert self.read(second) == b"2xedni"
+        assert self.encryptor.decryptions == 2
+
+    def test_keyed_by_passphrase(self):
+        first = self.cache.decrypted(self.encrypted, self.encryptor)
+        second = self.cache.decrypted(self.encrypted, CountingEncryptor("other key"))
+        assert self.encryptor.decryptions == 1  # the other passphrase has to decrypt again
+
+        # the name doesn't depend on the passphrase, the tag is salted
+        assert first == second == os.path.join(self.cache.directory, hashlib.sha256(b"index").hexdigest() + ".sqlite")
+        tag = self.read(first[:-len(".sqlite")] + ".key")
+        assert tag[16:] == hashlib.pbkdf2_hmac('sha256', b"other key", tag[:16], self.cache.kdf_iterations)
+
+    def test_older_entries_removed(self):
+        """ Entries without passphrase tag are decrypted again and evicted """
+        old_entry = os.path.join(self.cache.directory, "0" * 64 + ".sqlite")
+        os.makedirs(self.cache.directory)
+        self.write(old_entry, b"plain")
+        self.write(self.cache._entry(self.encrypted), b"xedni")
+
+        assert self.read(self.cache.decrypted(self.encrypted, self.encryptor)) == b"xedni"
+        assert self.encryptor.decryptions == 1
+        assert not os.path.exists(old_entry)
+
+    def test_store(self):
+        plain = os.path.join(self.directory, "plain")
+        self.write(plain, b"new index")
+        self.encryptor.encrypt_file(plain, self.encrypted)
+
+        self.cache.store(self.encrypted, self.encryptor, plain)
+        assert self.read(self.cache.decrypted(self.encrypted, self.encryptor)) == b"new index"
+        assert self.encryptor.decryptions == 0
+
+    def test_eviction(self):
+        entries = list()
+        for idx in range(3):
+            self.write(self.encrypted, b"index%i" % idx)
+            entries.append(self.cache.decrypted(self.encrypted, self.encryptor))
+            os.utime(entries[-1], (idx, idx))
+
+        # only the two most recent entries are kept
+        assert not os.path.exists(entries[0])
+        assert sorted(os.listdir(self.cache.directory)) == sorted(
+            os.path.basename(entry)[:-len(".sqlite")] + ext for entry in entries[1:] for ext in (".sqlite", ".key"))
+
+    def test_failed_decryption(self):
+        class FailingEncryptor(CountingEncryptor):
+            def decrypt_file(self, in_filename, out_filename):
+                raise RuntimeError("wrong passphrase")
+
+        with self.assertRaises(RuntimeError):
+            self.cache.decrypted(self.encrypted, FailingEncryptor())
+        assert os.listdir(self.cache.directory) == []
+
+
+if __name__ == '__main__':
+    main()
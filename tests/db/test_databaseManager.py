@@ -1,9 +1,37 @@
+import os
+import sqlite3
 import tempfile
 from unittest import TestCase
 
-from backup.db.db import DatabaseManager
+from backup.db.db import DatabaseManager, BackupType
+from backup.db.domain import FileState, FileEntry, ArchiveDiscMap, DiscEntry, ArchiveEntry
 from tests.common.customtestcase import CustomTestCase
 
+# index of the first release: one full backup with two files in one archive
+VERSION_1_INDEX = """
+    CREATE TABLE backups_entry (id INTEGER NOT NULL PRIMARY KEY, name TEXT);
+    CREATE TABLE backup_entry (id INTEGER NOT NULL PRIMARY KEY, created DATETIME NOT NULL,
+        backups_id INTEGER NOT NULL, _type TEXT NOT NULL, version INTEGER NOT NULL);
+    CREATE TABLE disc_entry (id INTEGER NOT NULL PRIMARY KEY, backup_id INTEGER NOT NULL);
+    CREATE TABLE archive_entry (id INTEGER NOT NULL PRIMARY KEY, disc_id INTEGER NOT NULL, name TEXT);
+    CREATE TABLE file_entry (id INTEGER NOT NULL PRIMARY KEY, sha_sum TEXT NOT NULL,
+        modified_time DATETIME NOT NULL, size INTEGER NOT NULL, relative_file TEXT NOT NULL);
+    CREATE TABLE archive_file_map (id INTEGER NOT NULL PRIMARY KEY, archive_id INTEGER NOT NULL,
+        file_id INTEGER NOT NULL);
+    CREATE TABLE backup_file_map (id INTEGER NOT NULL PRIMARY KEY, backup_id INTEGER NOT NULL,
+        file_id INTEGER NOT NULL, _state TEXT NOT NULL);
+
+    INSERT INTO backups_entry VALUES (1, 'old');
+    INSERT INTO backup_entry VALUES (1, '2020-01-01 00:00:00', 1, 'FULL', 1);
+    INSERT INTO disc_entry VALUES (1, 1);
+    INSERT INTO archive_entry VALUES (1, 1, NULL);
+    INSERT INTO file_entry VALUES (1, 'sha1', 1600000000.25, 10, '/dir/sub/file1');
+    INSERT INTO file_entry VALUES (2, 'sha2', 1600000001, 20, '/file2');
+    INSERT INTO archive_file_map VALUES (1, 1, 1), (2, 1, 2);
+    INSERT INTO backup_file_map VALUES (1, 1, 1, 'NEW'), (2, 1, 2, 'NEW');
+    PRAGMA user_version = 1;
+"""
+
 
 class TestDatabaseManager(CustomTestCase):
     def test_open_close_database(self):
@@ -13,3 +41,151 @@ class TestDatabaseManager(CustomTestCase):
 
             db = DatabaseManager(db_file.name)
             db.close_database()
+
+    def pragma(self, file_name, name):
+        with sqlite3.connect(file_name) as con:
+            return con.execute("PRAGMA %s" % name).fetchone()[0]
+
+    def test_profile(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            db = DatabaseManager(db_file.name)
+            assert db.database.execute_sql('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert db.database.execute_sql('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+            assert db.database.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == 2  # INCREMENTAL
+            assert db.database.execute_sql('PRAGMA page_size').fetchone()[0] == DatabaseManager.page_size
+            db.close_database()
+
+            # single self-contained file after closing
+            assert not os.path.exists(db_file.name + "-wal")
+            assert self.pragma(db_file.name, 'journal_mode') == 'delete'
+
+    def test_convert_old_database(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            with sqlite3.connect(db_file.name) as con:
+                con.execute("PRAGMA page_size = 4096")
+                con.execute("CREATE TABLE dummy (id INTEGER)")
+            assert self.pragma(db_file.name, 'auto_vacuum') == 0
+
+            DatabaseManager(db_file.name).close_database()
+
+            assert self.pragma(db_file.name, 'auto_vacuum') == 2
+            assert self.pragma(db_file.name, 'page_size') == DatabaseManager.page_size
+
+    def test_read_only_keeps_journal(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            DatabaseManager(db_file.name).close_database()
+
+            db = DatabaseManager(db_file.name, read_only=True)
+            assert db.database.execute_sql('PRAGMA journal_mode').fetchone()[0] == 'delete'
+            db.close_database()
+
+    def test_read_only_migrates_copy(self):
+        """ An old index opened read only (e.g. on a burned medium) is migrated in a temporary copy """
+        with tempfile.NamedTemporaryFile() as db_file:
+            with sqlite3.connect(db_file.name) as con:
+                con.executescript(VERSION_1_INDEX)
+            with open(db_file.name, 'rb') as f:
+                content = f.read()
+
+            db = DatabaseManager(db_file.name, read_only=True)
+            assert db.file_name != db_file.name
+            assert sorted(db.read_backup(None).all_files.keys()) == ['/dir/sub/file1', '/file2']
+            migrated_copy = db.file_name
+            db.close_database()
+
+            assert not os.path.exists(migrated_copy)
+            with open(db_file.name, 'rb') as f:
+                assert f.read() == content
+            assert self.pragma(db_file.name, 'user_version') == 1
+
+    def test_migrate_version_1(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            with sqlite3.connect(db_file.name) as con:
+                con.executescript(VERSION_1_INDEX)
+
+            db = DatabaseManager(db_file.name)
+            reader = db.read_backup(None)
+            assert sorted(reader.all_files.keys()) == ['/dir/sub/file1', '/file2']
+
+            file = reader.find_relative_file('/dir/sub/file1')
+            assert file.directory.path == '/dir/sub/'
+            assert file.name == 'file1'
+            assert file.modified_time == 1600000000.25
+            assert reader.find_relative_file('/file2').modified_time == 1600000001
+            assert len(reader.find_coordinates(file)[2]) == 1
+            assert [(c.archive.id, c.disc.id) for c in ArchiveDiscMap.select()] == [(1, 1)]
+            assert DiscEntry.get_by_id(1).destination is None
+            assert ArchiveEntry.get_by_id(1).sha512 is None
+            db.close_database()
+
+            assert self.pragma(db_file.name, 'user_version') == DatabaseManager._database_version
+
+    def test_compact(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            db = DatabaseManager(db_file.name)
+            with db.transaction():
+                writer = db.create_backup(BackupType.FULL, None)
+                for idx in range(5000):
+                    writer.create_file("x" * 64, idx, "/path/%010i" % idx, idx, FileState.NEW)
+
+            with db.transaction():
+                db.database.execute_sql('DELETE FROM backup_file_map')
+                FileEntry.delete().execute()
+            db.database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+            assert db.database.execute_sql('PRAGMA freelist_count').fetchone()[0] > 0
+
+            db.close_database()
+            assert self.pragma(db_file.name, 'freelist_count') == 0
+
+    def test_create_shard(self):
+        with tempfile.NamedTemporaryFile() as db_file, tempfile.NamedTemporaryFile() as shard_file:
+            db = DatabaseManager(db_file.name)
+            with db.transaction():
+                writer = db.create_backup(BackupType.FULL, None)
+                disc_1, disc_2 = writer.create_disc(), writer.create_disc()
+                archive_1, archive_2 = writer.create_archive(disc_1), writer.create_archive(disc_2)
+                for idx in range(10):
+                    file = writer.create_file(str(idx), idx, "/path_%i/%i" % (idx % 3, idx), idx, FileState.NEW)
+                    writer.map_file_to_archive(file, archive_1 if idx < 5 else archive_2)
+                    if idx == 4:  # split over both discs
+                        writer.map_file_to_archive(file, archive_2)
+                db.update_current_state(writer.backup_root)
+            db.close_database()
+
+            DatabaseManager.create_shard(db_file.name, shard_file.name, [disc_1.id])
+            assert self.pragma(shard_file.name, 'user_version') == DatabaseManager._database_version
+            assert self.pragma(shard_file.name, 'page_size') == DatabaseManager.page_size
+
+            shard = DatabaseManager(shard_file.name, read_only=True)
+            reader = shard.read_backup(None)
+            assert sorted(reader.relative_files()) == ["/path_0/0", "/path_0/3", "/path_1/1", "/path_1/4", "/path_2/2"]
+
+            _, _, archives, _ = reader.find_coordinates(reader.find_relative_file("/path_1/4"))
+            assert sorted(a.disc.id for a in archives) == [disc_1.id, disc_2.id]
+            assert shard.database.execute_sql('SELECT COUNT(*) FROM disc_entry').fetchone()[0] == 2  # catalog
+            assert shard.database.execute_sql('PRAGMA foreign_key_check').fetchall() == []
+            shard.close_database()
+
+    def test_create_shard_of_copy(self):
+        with tempfile.NamedTemporaryFile() as db_file, tempfile.NamedTemporaryFile() as shard_file:
+            db = DatabaseManager(db_file.name)
+            with db.transaction():
+                writer = db.create_backup(BackupType.FULL, None)
+                onsite, offsite = db.destination("/onsite"), db.destination("/offsite")
+                disc_1, disc_2 = writer.create_disc(onsite), writer.create_disc(onsite)
+                copy_disc = writer.create_disc(offsite)  # one medium of the other destination holds everything
+                for idx, disc in enumerate((disc_1, disc_2)):
+                    archive = writer.create_archive(disc)
+                    writer.map_archive_to_disc(archive, copy_disc)
+                    file = writer.create_file(str(idx), idx, "/file_%i" % idx, idx, FileState.NEW)
+                    writer.map_file_to_archive(file, archive)
+                db.update_current_state(writer.backup_root)
+            db.close_database()
+
+            DatabaseManager.create_shard(db_file.name, shard_file.name, [copy_disc.id])
+
+            shard = DatabaseManager(shard_file.name, read_only=True)
+            assert sorted(shard.read_backup(None).relative_files()) == ["/file_0", "/file_1"]
+            assert DiscEntry.get_by_id(copy_disc.id).destination.name == "/offsite"
+            assert ArchiveDiscMap.select().where(ArchiveDiscMap.disc == copy_disc.id).count() == 2
+            shard.close_database()
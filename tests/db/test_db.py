@@ -47,6 +47,41 @@ class DomainTest(CustomTestCase):
             assert len(archive01.files) == 1
             assert archive01.files[0].file.size == 2
 
+    def test_batched_write(self):
+        with tempfile.NamedTemporaryFile() as tmp_filename:
+            db_manager = DatabaseManager(tmp_filename.name)
+
+            with db_manager.transaction():
+                backup_manager = db_manager.create_backup(BackupType.FULL, None)
+                backup_manager.batch_size = 1000
+
+                disc01 = backup_manager.create_disc()
+                archive01 = backup_manager.create_archive(disc01)
+                files = list()
+                for idx in range(2500):
+                    file = backup_manager.create_file_from_dto(self.create_dummy_file(idx), FileState.NEW)
+                    backup_manager.map_file_to_archive(file, archive01)
+                    files.append(file)
+
+                assert len(FileEntry.select()) < 2500  # the rest is still buffered
+
+            # the end of the transaction flushes the rest
+            assert len(FileEntry.select()) == 2500
+            assert len(BackupFileMap.select()) == 2500
+            assert len(ArchiveFileMap.select()) == 2500
+            assert len(set(f.id for f in files)) == 2500
+
+            stored = FileEntry.get_by_id(files[1234].id)
+            assert stored.relative_file == files[1234].relative_file
+            assert archive01.files.where(ArchiveFileMap.file == files[1234]).count() == 1
+
+            # the next backup continues with the file ids
+            with db_manager.transaction():
+                backup_manager = db_manager.create_backup(BackupType.INCREMENTAL, None)
+                file = backup_manager.create_file_from_dto(self.create_dummy_file(2500), FileState.NEW)
+            assert file.id == max(f.id for f in files) + 1
+            assert FileEntry.get_by_id(file.id).size == 2500
+
     def create_dummy_file(self, idx) -> FileEntryDTO:
         ret = FileEntryDTO()
 
@@ -0,0 +1,89 @@
+import tempfile
+from unittest import main
+
+from backup.db.domain import *
+from backup.db.db import DatabaseManager, BackupDatabaseReader, LazyBackupDatabaseReader, BackupType
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestQueryPlan(CustomTestCase):
+    """Makes sure that the reader queries use the indexes and don't scan tables they only look up."""
+
+    def setUp(self):
+        self.tmp_file = tempfile.NamedTemporaryFile()
+        self.db_manager = DatabaseManager(self.tmp_file.name)
+
+        with self.db_manager.transaction():
+            writer = self.db_manager.create_backup(BackupType.FULL, None)
+            disc = writer.create_disc()
+            archive = writer.create_archive(disc)
+            for idx in range(100):
+                file = writer.create_file(str(idx), idx, "/path/%i" % idx, idx, FileState.NEW)
+                writer.map_file_to_archive(file, archive)
+            self.db_manager.update_current_state(writer.backup_root)
+
+        self.backup = writer.backup_root
+
+    def tearDown(self):
+        self.db_manager.close_database()
+        self.tmp_file.close()
+
+    def plan(self, query) -> [str]:
+        sql, params = query.sql()
+        return [row[-1] for row in self.db_manager.database.execute_sql("EXPLAIN QUERY PLAN " + sql, params)]
+
+    def assert_no_scan(self, query):
+        plan = self.plan(query)
+        assert not any(step.startswith("SCAN") for step in plan), plan
+
+    def assert_single_scan(self, query):
+        """For queries that read a whole table: only the driving table is scanned, everything else is looked up."""
+        plan = self.plan(query)
+        assert len([step for step in plan if step.startswith("SCAN")]) <= 1, plan
+
+    def test_backup_chain_queries(self):
+        self.assert_no_scan(BackupFileMap.select().where(BackupFileMap.backup.in_([self.backup])))
+        self.assert_no_scan(BackupDatabaseReader._backup_files_query(self.backup))
+        self.assert_no_scan(BackupDatabaseReader._backup_archives_query(self.backup))
+
+    def test_current_state_queries(self):
+        self.assert_single_scan(BackupDatabaseReader._current_files_query())
+        self.assert_single_scan(BackupDatabaseReader._current_archives_query())
+
+    def test_lazy_reader_queries(self):
+        directory = CurrentFileEntry.select().first().directory
+        self.assert_no_scan(DirectoryEntry.select().where(DirectoryEntry.path == "/path/"))
+        self.assert_no_scan(BackupDatabaseReader._current_files_query().where(CurrentFileEntry.directory == directory))
+        self.assert_no_scan(
+            BackupDatabaseReader._current_archives_query().where(CurrentFileEntry.directory == directory)
+        )
+
+        # path sorted cursors come from the indexes
+        for query in (LazyBackupDatabaseReader._sorted_paths_query(), LazyBackupDatabaseReader._sorted_files_query(),
+                      LazyBackupDatabaseReader._sorted_sha_sums_query()):
+            plan = self.plan(query)
+            assert not any("TEMP B-TREE" in step for step in plan), plan
+            self.assert_single_scan(query)
+
+    def test_file_lookups(self):
+        self.assert_no_scan(FileEntry.select().where((FileEntry.directory == 1) & (FileEntry.name == "1")))
+        self.assert_no_scan(DirectoryEntry.select().where(DirectoryEntry.path == "/path/"))
+        self.assert_no_scan(FileEntry.select().where(FileEntry.sha_sum == "1"))
+        self.assert_no_scan(ArchiveFileMap.select().where(ArchiveFileMap.file == 1))
+        self.assert_no_scan(DiscEntry.select().where(DiscEntry.backup == self.backup))
+        self.assert_no_scan(ArchiveDiscMap.select().where(ArchiveDiscMap.disc == 1))
+
+    def test_migration_creates_indexes(self):
+        self.db_manager.database.execute_sql('DROP INDEX file_entry_directory_id_name')
+        self.db_manager.database.execute_sql('DROP INDEX file_entry_sha_sum')
+        self.db_manager.database.execute_sql('PRAGMA user_version = 2')
+        self.db_manager.close_database()
+
+        self.db_manager = DatabaseManager(self.tmp_file.name)
+        assert self.db_manager.database.execute_sql('PRAGMA user_version').fetchone()[0] == 7
+        self.assert_no_scan(FileEntry.select().where((FileEntry.directory == 1) & (FileEntry.name == "1")))
+        self.assert_no_scan(FileEntry.select().where(FileEntry.sha_sum == "1"))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,62 @@
+import os
+import tarfile
 import tempfile
-from unittest import TestCase, main
-from unittest.mock import Mock
-import time
-
-from backup.db.domain import *
-from backup.db.db import DatabaseManager, BackupType
-from backup.core.luke import FileEntryDTO
-from backup.multi.archive import ThreadingArchiveManager
+from unittest import main
+
+from backup.core.archive import DefaultArchiver
+from backup.core.luke import LukeFilewalker
+from backup.multi.archive import PipelineArchiveManager
+from backup.common.scratch import ScratchSpace
 from tests.common.customtestcase import CustomTestCase
 
 
-class TestThreadingArchiveManager(CustomTestCase):
-    def test_iteration_00(self):
-        pass  # todo
+class TestPipelineArchiveManager(CustomTestCase):
+    def create_test_file(self, name, size=14):
+        with open(name, 'w') as temp:
+            for i in range(size):
+                temp.write(chr(ord('a') + i % 26))
+
+    def test_archive_package_iter(self):
+        self.do_archive_package_iter(0)
+
+    def test_archive_package_iter_processes(self):
+        self.do_archive_package_iter(2)
+
+    def do_archive_package_iter(self, processes):
+        with tempfile.TemporaryDirectory() as source_directory:
+            self.create_test_file(source_directory + "/source_1", 2500)
+            self.create_test_file(source_directory + "/source_2", 100)
+            self.create_test_file(source_directory + "/source_3", 100)
+
+            scratch = ScratchSpace(budget=2048)
+            am = PipelineArchiveManager(
+                LukeFilewalker().walk_directory(source_directory, False), 1024, DefaultArchiver(), None, scratch,
+                {"hash": 2, "compress": 3}, processes=processes
+            )
+
+            parts = list()
+            files = list()
+            for archive_package in am.archive_package_iter():
+                assert os.path.exists(archive_package.archive_file)
+
+                for file in archive_package.file_package:
+                    assert file.sha_sum is not None
+
+                if archive_package.part_number >= 0:
+                    parts.append(archive_package.part_number)
+                    with tarfile.open(archive_package.archive_file, 'r:*') as tar:
+                        assert tar.next().size == archive_package.part_size
+                else:
+                    files.extend(f.original_filename for f in archive_package.file_package)
+
+                scratch.unregister_pressure(archive_package.pending_bytes)
+                archive_package.tempfile.close()
+
+            assert parts == [0, 1, 2]
+            assert sorted(files) == ["source_2", "source_3"]
+            assert scratch.pressure == 0
+            scratch.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import tempfile
+import time
+from unittest import main
+
+from backup.multi.autotune import ConcurrencyTuner, Sample, StageSample, read_cpu_times
+from backup.multi.pipeline import Pipeline, PipelineStage
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestConcurrencyTuner(CustomTestCase):
+    def test_tune(self):
+        def work(x):
+            time.sleep(0.001)
+            return x
+
+        pipeline = Pipeline([PipelineStage("hash", work, 1, 4), PipelineStage("compress", work, 2, 4)])
+        results = pipeline.run(range(500))
+        first = next(results)  # pipeline is running
+
+        tuner = ConcurrencyTuner(pipeline, 4)
+
+        # hash is the bottleneck
+        tuner.tune(Sample(0.2, 0.0, [StageSample("hash", 1, 10, 1.0, 1.0), StageSample("compress", 2, 10, 0.6, 0.5)]))
+        assert pipeline.stages[0].workers == 2
+        assert pipeline.stages[0].queue_size == 8
+
+        # disk is saturated
+        tuner.tune(Sample(0.2, 0.6, [StageSample("hash", 2, 10, 1.0, 1.0), StageSample("compress", 2, 10, 0.6, 0.5)]))
+        assert pipeline.stages[0].workers == 1
+
+        # compress is idle
+        tuner.tune(Sample(0.9, 0.0, [StageSample("hash", 1, 10, 1.0, 1.0), StageSample("compress", 2, 10, 0.1, 0.0)]))
+        assert pipeline.stages[1].workers == 1
+
+        assert sorted([first] + list(results)) == list(range(500))
+        assert "hash=1 workers" in tuner.configuration()
+
+    def test_sample(self):
+        pipeline = Pipeline([PipelineStage("work", lambda x: x, 2, 4)])
+        tuner = ConcurrencyTuner(pipeline, 4, interval=0.05)
+        tuner.start()
+
+        assert list(pipeline.run(range(100))) is not None
+        sample = tuner.sample()
+        tuner.stop()
+
+        assert sample.stages[0].name == "work"
+        assert 0.0 <= sample.cpu <= 1.0
+
+    def test_read_cpu_times(self):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write("cpu  100 0 50 800 40 5 5 0 0 0\ncpu0 1 2 3\n")
+            f.flush()
+
+            assert read_cpu_times(f.name) == (160, 40, 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import threading
+import time
+from unittest import main
+
+from backup.multi.backpressure import BackpressureManager
+from backup.multi.pipeline import Pipeline, PipelineStage
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestPipeline(CustomTestCase):
+    def test_stages(self):
+        def pairs(iterator):
+            batch = list()
+            for item in iterator:
+                batch.append(item)
+                if len(batch) == 2:
+                    yield batch
+                    batch = list()
+            if batch:
+                yield batch
+
+        pipeline = Pipeline([
+            PipelineStage("double", lambda x: x * 2, 4, 2),
+            PipelineStage("drop", lambda x: None if x == 10 else x, 2, 2),
+            PipelineStage("pairs", pairs, 1, 4, True),
+            PipelineStage("sum", sum, 3, 1),
+        ])
+
+        results = list(pipeline.run(range(10)))
+
+        assert len(results) == 5
+        assert sum(results) == sum(x * 2 for x in range(10)) - 10
+        assert pipeline.stages[0].processed == 10
+
+    def test_slow_item_does_not_block_others(self):
+        def work(x):
+            if x == 0:
+                time.sleep(0.5)
+            return x
+
+        results = list(Pipeline([PipelineStage("work", work, 2, 2)]).run(range(5)))
+
+        assert results[-1] == 0
+
+    def test_ordered_stage(self):
+        def work(x):
+            time.sleep(0.01 * (x % 3))
+            return None if x == 5 else x
+
+        pipeline = Pipeline([PipelineStage("work", work, 4, 4, ordered=True)])
+
+        assert list(pipeline.run(range(20))) == [x for x in range(20) if x != 5]
+
+    def test_error_is_raised(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError("fail")
+            return x
+
+        with self.assertRaises(ValueError):
+            list(Pipeline([PipelineStage("fail", fail, 2, 1)]).run(range(100)))
+
+
+class TestBackpressureManager(CustomTestCase):
+    def test_bytes_limit(self):
+        pressure = BackpressureManager(100)
+
+        assert pressure.register_pressure(60)
+        assert not pressure.register_pressure(60, 0.01)
+        assert pressure.register_pressure(40)
+        assert pressure.reached()
+
+        pressure.unregister_pressure(100)
+        assert pressure.register_pressure(500, 0.01)  # larger than max, but nothing else is pending
+
+    def test_blocks_until_released(self):
+        pressure = BackpressureManager(10)
+        pressure.register_pressure(10)
+
+        t = threading.Timer(0.1, pressure.unregister_pressure, [10])
+        t.start()
+
+        assert pressure.register_pressure(5, 5)
+        t.join()
+
+
+if __name__ == '__main__':
+    main()
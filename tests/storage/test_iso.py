@@ -0,0 +1,79 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import main
+
+from backup.storage.iso import IsoImageWriter, IsoImageReader, iso_name, SECTOR_SIZE
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestIsoImage(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.directory.name, "0000000001.iso")
+        self.files = {
+            "0000000001.tar.bz2.gpg": os.urandom(5000),
+            "0000000002.tar.bz2.gpg": os.urandom(3 * 1024 * 1024 + 7),
+            "disc_id.yml": b"id: 1\n",
+            "empty": b"",
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, files: dict, append=False):
+        writer = IsoImageWriter(self.image, "PBB_0000000001", buffer_size=4096, append=append)
+        for name, content in files.items():
+            src = os.path.join(self.directory.name, "src")
+            with open(src, 'wb') as f:
+                f.write(content)
+            writer.add_file(name, src)
+        writer.close()
+
+    def assert_image(self, files: dict):
+        reader = IsoImageReader(self.image)
+        assert reader.volume_id == "PBB_0000000001"
+        assert sorted(reader.entries) == sorted(files)
+
+        out = os.path.join(self.directory.name, "out")
+        for name, content in files.items():
+            reader.extract(name, out)
+            with open(out, 'rb') as f:
+                assert f.read() == content, name
+
+    def test_write_read(self):
+        self.write(self.files)
+
+        assert os.path.getsize(self.image) % SECTOR_SIZE == 0
+        self.assert_image(self.files)
+
+    def test_append(self):
+        self.write(self.files)
+        self.write({"index.sqlite": b"index"}, append=True)
+
+        self.files["index.sqlite"] = b"index"
+        self.assert_image(self.files)
+
+    @unittest.skipIf(shutil.which("bsdtar") is None, "bsdtar is needed to read the image independently")
+    def test_read_with_libarchive(self):
+        self.write(self.files)
+
+        out = os.path.join(self.directory.name, "extracted")
+        os.mkdir(out)
+        subprocess.run(["bsdtar", "-xf", self.image, "-C", out], check=True)
+        for name, content in self.files.items():
+            with open(os.path.join(out, name), 'rb') as f:
+                assert f.read() == content, name
+
+    def test_iso_name(self):
+        assert iso_name("0000000001.tar.bz2.gpg") == "0000000001_TAR_BZ2.GPG;1"
+        assert iso_name("disc_id.yml") == "DISC_ID.YML;1"
+        assert iso_name("empty") == "EMPTY.;1"
+        assert len(iso_name("x" * 40 + ".sqlite")) == 30 + 2
+
+
+if __name__ == '__main__':
+    main()
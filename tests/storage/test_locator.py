@@ -0,0 +1,84 @@
+import os
+import tempfile
+from unittest import main, mock
+
+from backup.db.disc_id import DiscId
+from backup.storage.locator import ArchiveLocator, locator_state_file
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestArchiveLocator(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source")
+        self.state_file = locator_state_file(os.path.join(self.directory.name, "cache"), self.source)
+        os.mkdir(self.source)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_medium(self, disc_id, archive_ids):
+        medium = os.path.join(self.source, "%010i" % disc_id)
+        os.mkdir(medium)
+        DiscId(disc_id).serialize(os.path.join(medium, "disc_id.yml"))
+        for archive_id in archive_ids:
+            open(os.path.join(medium, "%010i.tar.bz2" % archive_id), 'w').close()
+        open(os.path.join(medium, "index.sqlite"), 'w').close()
+        return medium
+
+    def test_locate(self):
+        medium_1 = self.create_medium(1, [1, 2])
+        medium_2 = self.create_medium(2, [3])
+
+        locator = ArchiveLocator(self.source)
+        assert locator.refresh()
+        assert locator.archives("tar.bz2") == {
+            1: os.path.join(medium_1, "0000000001.tar.bz2"),
+            2: os.path.join(medium_1, "0000000002.tar.bz2"),
+            3: os.path.join(medium_2, "0000000003.tar.bz2"),
+        }
+        assert locator.archives("tar.bz2.gpg") == {}
+        assert locator.mediums() == {1: medium_1, 2: medium_2}
+
+    def test_incremental_refresh(self):
+        self.create_medium(1, [1, 2])
+        locator = ArchiveLocator(self.source, state_file=self.state_file)
+        locator.refresh()
+
+        with mock.patch('os.scandir', side_effect=AssertionError("listed again")):
+            assert not locator.refresh()
+
+        # a new medium is inserted, only the source and the new medium are listed
+        self.create_medium(2, [3])
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            assert locator.refresh()
+        assert scandir.call_count == 2
+        assert set(locator.archives("tar.bz2")) == {1, 2, 3}
+
+    def test_removed_medium(self):
+        self.create_medium(1, [1])
+        medium_2 = self.create_medium(2, [2])
+        locator = ArchiveLocator(self.source)
+        locator.refresh()
+
+        for name in os.listdir(medium_2):
+            os.remove(os.path.join(medium_2, name))
+        os.rmdir(medium_2)
+
+        assert locator.refresh()
+        assert set(locator.archives("tar.bz2")) == {1}
+
+    def test_persistent_state(self):
+        self.create_medium(1, [1, 2])
+        ArchiveLocator(self.source, state_file=self.state_file).refresh()
+        assert os.path.exists(self.state_file)
+
+        locator = ArchiveLocator(self.source, state_file=self.state_file)
+        with mock.patch('os.scandir', side_effect=AssertionError("listed again")):
+            assert not locator.refresh()
+        assert set(locator.archives("tar.bz2")) == {1, 2}
+
+
+if __name__ == '__main__':
+    main()
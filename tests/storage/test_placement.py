@@ -0,0 +1,82 @@
+import errno
+import os
+import stat
+import tempfile
+from unittest import main, mock
+
+from backup.common.progressbar import ProgressBar
+from backup.storage.placement import ArchivePlacer, _FILE_MODE
+from tests.common.customtestcase import CustomTestCase
+
+
+class RecordingProgressBar(ProgressBar):
+    def __init__(self):
+        self.total = None
+        self.done = 0
+
+    def update(self, value):
+        self.done += value
+
+
+class TestArchivePlacer(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.directory.name, "src")
+        self.dest = os.path.join(self.directory.name, "dest")
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assert_placed(self, t: RecordingProgressBar):
+        with open(self.dest, 'rb') as f:
+            assert f.read() == self.content
+        assert t.total == len(self.content)
+        assert t.done == len(self.content)
+
+    def test_move_renames(self):
+        os.chmod(self.src, 0o600)
+        t = RecordingProgressBar()
+        assert ArchivePlacer().place(self.src, self.dest, t, move=True) == 'rename'
+
+        assert not os.path.exists(self.src)
+        self.assert_placed(t)
+        assert stat.S_IMODE(os.stat(self.dest).st_mode) == _FILE_MODE  # like a newly created file
+
+    def test_copy_keeps_source(self):
+        t = RecordingProgressBar()
+        assert ArchivePlacer(buffer_size=1024 * 1024).place(self.src, self.dest, t) != 'rename'
+
+        assert os.path.exists(self.src)
+        self.assert_placed(t)
+
+    def test_move_across_file_systems(self):
+        with mock.patch('os.rename', side_effect=OSError(errno.EXDEV, "cross-device link")):
+            t = RecordingProgressBar()
+            assert ArchivePlacer().place(self.src, self.dest, t, move=True) != 'rename'
+        self.assert_placed(t)
+
+    def test_buffered_fallback(self):
+        unsupported = OSError(errno.ENOSYS, "not supported")
+        with mock.patch('os.copy_file_range', side_effect=unsupported, create=True), \
+                mock.patch('os.sendfile', side_effect=unsupported, create=True):
+            t = RecordingProgressBar()
+            assert ArchivePlacer(buffer_size=1024 * 1024).place(self.src, self.dest, t) == 'copy'
+        self.assert_placed(t)
+
+    def test_fsync_batched(self):
+        placer = ArchivePlacer(fsync=True)
+        placer.place(self.src, self.dest, RecordingProgressBar())
+        assert placer._unsynced == [self.dest, self.directory.name]
+
+        with mock.patch('os.fsync') as fsync:
+            placer.sync()
+        assert fsync.call_count == 2
+        assert placer._unsynced == []
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from unittest import main
+
+from backup.common.dircompare import DirCompare
+from backup.core.basecontroller import BackupController, RestoreController
+from backup.core.parameters import GeneralSettings, BackupParameters, RestoreParameters
+from backup.storage.s3 import S3StorageBackupParameters, parse_s3_url
+from tests.common.customtestcase import CustomTestCase
+
+try:
+    import boto3
+    import moto
+except ImportError:
+    boto3 = moto = None
+
+
+class TestS3Url(CustomTestCase):
+    def test_parse(self):
+        assert parse_s3_url("s3://bucket") == ("bucket", "")
+        assert parse_s3_url("s3://bucket/some/prefix/") == ("bucket", "some/prefix")
+
+        with self.assertRaises(ValueError):
+            parse_s3_url("/some/dir")
+
+
+@unittest.skipIf(moto is None, "boto3 and moto are needed for the s3 tests")
+class TestS3Storage(CustomTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+            os.environ[name] = "testing"
+        os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+        self.mock = getattr(moto, "mock_aws", None) or getattr(moto, "mock_s3")
+        self.mock = self.mock()
+        self.mock.start()
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="backup")
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def s3_parameters(self) -> S3StorageBackupParameters:
+        sp = S3StorageBackupParameters()
+        sp.region = "us-east-1"
+        sp.multipart_threshold = 5 * 1024 * 1024  # minimum part size of S3
+        sp.multipart_chunksize = 5 * 1024 * 1024
+        sp.max_concurrency = 4
+        return sp
+
+    def test_backup_restore(self):
+        bck_params = BackupParameters()
+        bck_params.single_archive_size = 64 * 1024 * 1024
+        bck_params.backup_parameters = self.s3_parameters()
+
+        with tempfile.NamedTemporaryFile() as db_filename, tempfile.TemporaryDirectory() as source_dir:
+            for idx in range(3):
+                with open(os.path.join(source_dir, "small_%i" % idx), 'w') as f:
+                    f.write("small file %i" % idx)
+            with open(os.path.join(source_dir, "large"), 'wb') as f:
+                f.write(os.urandom(12 * 1024 * 1024))  # uploaded in parts
+
+            bck_params.database_location = db_filename.name
+            bck_params.source = source_dir
+            bck_params.destination = "s3://backup/offsite"
+            BackupController(GeneralSettings()).execute(bck_params)
+
+            objects = boto3.client("s3", region_name="us-east-1").list_objects_v2(Bucket="backup")["Contents"]
+            names = sorted(obj["Key"] for obj in objects)
+            assert names == ["offsite/0000000001/0000000001.tar.bz2", "offsite/0000000001/disc_id.yml",
+                             "offsite/0000000001/index.sqlite"]
+
+            with tempfile.TemporaryDirectory() as restore_dir:
+                rst_params = RestoreParameters()
+                rst_params.database_location = db_filename.name
+                rst_params.source = "s3://backup/offsite"
+                rst_params.destination = restore_dir
+                rst_params.backup_parameters = self.s3_parameters()
+                RestoreController(GeneralSettings()).execute(rst_params)
+
+                assert DirCompare(source_dir, restore_dir).compare()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import threading
+import time
+from unittest import main
+
+from backup.storage.writer import AsyncArchiveWriter
+from tests.common.customtestcase import CustomTestCase
+
+
+class TestAsyncArchiveWriter(CustomTestCase):
+    def test_write_and_complete(self):
+        writer = AsyncArchiveWriter(1)
+        main_thread = threading.current_thread()
+        written = list()
+        completed = list()
+
+        def write(i):
+            time.sleep(0.01)
+            written.append(i)
+
+        def complete(i):
+            assert threading.current_thread() is main_thread
+            completed.append(i)
+
+        for i in range(5):
+            writer.submit(lambda i=i: write(i), lambda i=i: complete(i))
+
+        writer.close()
+
+        assert written == list(range(5))
+        assert completed == list(range(5))
+
+    def test_error_is_raised(self):
+        writer = AsyncArchiveWriter(2)
+
+        def fail():
+            raise IOError("medium full")
+
+        writer.submit(fail)
+        with self.assertRaises(IOError):
+            writer.flush()
+
+
+if __name__ == '__main__':
+    main()